@@ -0,0 +1,129 @@
+"""Admission of jobs by their estimated memory use.
+
+Before a job runs its steps, its peak memory is estimated from the
+dimensions in the headers of its inputs, its ``max_gb``, the cores it was
+granted by ``chickadee.cores``, the engine and the kind of process (see
+``chickadee.cost_model``). Cores are reserved first, as ``num_cores=auto``
+only takes the cores free at that moment. A job only starts while its
+estimate and those of the running jobs fit in ``max_memory_gb``; the others
+wait in order of arrival, so big jobs landing together run one after the
+other instead of being killed for running out of memory. A job estimated
+above the whole budget runs on its own.
+
+The estimate is deliberately rough. ClimDown reads the GCM whole and holds
+one ``max_gb`` chunk per doParallel process, the NumPy engines share
+``max_gb`` between their processes, and CI and CA keep grids of their own in
+memory for the whole step.
+"""
+
+import os
+import time
+import uuid
+import numpy as np
+import psutil
+from contextlib import contextmanager
+from pywps import configuration
+from pywps.app.exceptions import ProcessError
+
+import chickadee.utils as util
+from chickadee import cancellation
+from chickadee.cores import CGROUP_ROOT
+from chickadee.ledger import open_ledger
+
+
+LEDGER = "memory"
+WAIT_POLL = 2
+
+# Python with the NetCDF libraries, per job
+BASE_GB = 0.5
+# R with ClimDown attached, per doParallel process
+R_PROCESS_GB = 0.5
+# Bytes of a double
+ITEM = 8
+
+
+def memory_limit_gb(root=CGROUP_ROOT):
+    """Memory of the host, or the memory limit of the cgroup of the service
+    if it is lower, in GB"""
+    total = psutil.virtual_memory().total
+    for name in ("memory.max", os.path.join("memory", "memory.limit_in_bytes")):
+        try:
+            with open(os.path.join(root, name)) as f:
+                limit = f.read().strip()
+        except OSError:
+            continue
+        if limit.isdigit():
+            total = min(total, int(limit))
+    return total / 2**30
+
+
+def get_budget_gb():
+    # Resolved on every call, the configuration may be loaded after import
+    budget = configuration.get_config_value("chickadee", "max_memory_gb")
+    # Leave room for the service and the system
+    return float(budget) if budget else 0.9 * memory_limit_gb()
+
+
+def _gb(shape):
+    return ITEM * float(np.prod(shape)) / 2**30
+
+
+def estimate_gb(process, engine, gcm_shape, obs_shape, max_gb, num_cores):
+    """Peak memory of a ``process`` job with inputs of the given (time, lat,
+    lon) shapes, in GB"""
+    gcm = _gb(gcm_shape)
+    obs_step = _gb(obs_shape[1:])
+    # Arrays held for the whole step
+    resident = {
+        # The GCM and the monthly climatologies of the observations
+        "ci": gcm + 12 * obs_step,
+        # The GCM and the observations aggregated to the GCM grid
+        "ca": gcm + _gb(obs_shape[:1] + gcm_shape[1:]),
+        "qdm": 0.0,
+        "rerank": 0.0,
+    }
+    # CI and QDM run alongside CA
+    resident["bccaq"] = max(resident["ci"], resident["qdm"]) + resident["ca"]
+    branches = 2 if process == "bccaq" else 1
+
+    if engine == "numpy":
+        working = branches * max_gb
+    else:
+        working = num_cores * (max_gb + R_PROCESS_GB)
+    return BASE_GB + resident[process] + working
+
+
+@contextmanager
+def admit(job_gb, job_id):
+    """Wait until a job estimated at ``job_gb`` fits in the memory budget,
+    and hold its share while it runs"""
+    token = uuid.uuid4().hex
+    budget = get_budget_gb()
+    entry = {"pid": os.getpid(), "gb": job_gb, "since": time.time(), "running": False}
+    with open_ledger(LEDGER) as ledger:
+        ledger[token] = entry
+    util.logger.info(f"Job needs about {job_gb:.1f} GB of {budget:.1f} GB")
+    try:
+        waited = False
+        while True:
+            with open_ledger(LEDGER) as ledger:
+                running = [e for e in ledger.values() if e["running"]]
+                used = sum(e["gb"] for e in running)
+                first = min(
+                    (e["since"], t) for t, e in ledger.items() if not e["running"]
+                )[1]
+                if first == token and (not running or used + job_gb <= budget):
+                    ledger[token]["running"] = True
+                    break
+            if not waited:
+                util.logger.info(
+                    f"Waiting for memory, {used:.1f} GB in use by running jobs"
+                )
+                waited = True
+            if cancellation.is_cancelled(job_id):
+                raise ProcessError("Process failed.")
+            time.sleep(WAIT_POLL)
+        yield
+    finally:
+        with open_ledger(LEDGER) as ledger:
+            ledger.pop(token, None)
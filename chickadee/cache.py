@@ -0,0 +1,227 @@
+"""Content-addressed disk cache shared by the processes of the service.
+
+Entries are files named after the hex digest of their key. Reading an entry
+updates its modification time, and when a new entry takes the cache over
+its size cap the least recently used entries are evicted. Entries are handed
+out as hard links (or copies) so that eviction never breaks a running job.
+"""
+
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+import numpy as np
+from contextlib import contextmanager
+from pywps import configuration
+
+import chickadee.utils as util
+
+
+CHUNK_SIZE = 1 << 20
+# Size cap of the digests of input files kept on disk
+DIGESTS_MAX_BYTES = 1 << 20
+
+_file_digests = {}
+
+
+def _memo_key(path):
+    stat = os.stat(path)
+    return (os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+
+
+def _load_digest(memo_key):
+    try:
+        digest = get_digests().read(make_key(*memo_key))
+    except OSError:
+        return None
+    return digest and digest.decode()
+
+
+def _store_digest(memo_key, digest):
+    try:
+        get_digests().write(make_key(*memo_key), digest.encode())
+    except OSError as e:
+        util.logger.warning(f"Could not record the digest of {memo_key[0]}: {e}")
+
+
+def file_digest(path):
+    """sha256 of the contents of ``path``, memoized on its path, size and
+    mtime in this process and on disk for the other processes of the
+    service"""
+    memo_key = _memo_key(path)
+    if memo_key not in _file_digests:
+        digest = _load_digest(memo_key)
+        if digest is None:
+            sha256 = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    sha256.update(chunk)
+            digest = sha256.hexdigest()
+            _store_digest(memo_key, digest)
+        _file_digests[memo_key] = digest
+    return _file_digests[memo_key]
+
+
+def remember_digest(path, digest):
+    """Record the known ``digest`` of ``path``, so that it is not hashed again
+    while the file is unchanged"""
+    memo_key = _memo_key(path)
+    if _file_digests.get(memo_key) != digest:
+        _store_digest(memo_key, digest)
+        _file_digests[memo_key] = digest
+
+
+def input_digest(path_or_url):
+    """Digest of a local input file, or the address of a remote one"""
+    if os.path.isfile(path_or_url):
+        return file_digest(path_or_url)
+    return path_or_url
+
+
+def array_digest(array):
+    """Digest of the values of an array"""
+    values = np.ascontiguousarray(np.ma.getdata(array), dtype=np.float64)
+    return hashlib.sha256(values.tobytes()).hexdigest()
+
+
+def make_key(*parts):
+    """Digest of JSON serializable ``parts``"""
+    encoded = json.dumps(parts, sort_keys=True, default=str).encode()
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def _link_or_copy(src, dest):
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+
+class DiskCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    def path(self, key):
+        if not all(c in "0123456789abcdef" for c in key) or not key:
+            raise ValueError(f"Invalid cache key '{key}'")
+        return os.path.join(self.directory, key)
+
+    @contextmanager
+    def _lock(self, name=".lock"):
+        with open(os.path.join(self.directory, name), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def fill_lock(self, key):
+        """Lock held while the entry for ``key`` is computed, so that
+        concurrent jobs wait for one another instead of computing it twice.
+        Keys share one of 256 lock files."""
+        self.path(key)
+        return self._lock(f".fill-{key[:2]}")
+
+    def get(self, key, dest):
+        """Place the entry for ``key`` at ``dest`` and return ``dest``, or
+        ``None`` on a miss"""
+        path = self.path(key)
+        with self._lock():
+            if not os.path.exists(path):
+                return None
+            os.utime(path)
+            if os.path.exists(dest):
+                os.remove(dest)
+            _link_or_copy(path, dest)
+        return dest
+
+    def put(self, key, src, link=False):
+        """Store a copy of the file ``src`` under ``key``, or a hard link to
+        it with ``link`` when ``src`` will not be modified.
+
+        A cache that cannot be written only logs a warning.
+        """
+        if link:
+            return self._store(key, lambda tmp: _link_or_copy(src, tmp), src)
+        return self._store(key, lambda tmp: shutil.copyfile(src, tmp), src)
+
+    def read(self, key):
+        """Contents of the entry for ``key``, or ``None`` on a miss"""
+        path = self.path(key)
+        with self._lock():
+            if not os.path.exists(path):
+                return None
+            os.utime(path)
+            with open(path, "rb") as f:
+                return f.read()
+
+    def write(self, key, data):
+        """Store the bytes ``data`` under ``key``, like ``put``"""
+
+        def write_tmp(tmp):
+            with open(tmp, "wb") as f:
+                f.write(data)
+
+        return self._store(key, write_tmp, key)
+
+    def _store(self, key, fill, name):
+        path = self.path(key)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        try:
+            fill(tmp)
+            with self._lock():
+                os.replace(tmp, path)
+                self._evict(keep=path)
+        except OSError as e:
+            util.logger.warning(f"Could not cache {name}: {e}")
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return False
+        return True
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.startswith(".") or name.endswith(".tmp"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def _evict(self, keep=None):
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            os.remove(path)
+            total -= size
+
+
+def get_cache_dir():
+    return configuration.get_config_value(
+        "chickadee", "cache_dir"
+    ) or util.get_runtime_dir("cache")
+
+
+def get_cache(name, size_option, default_gb):
+    """The cache ``name`` in ``cache_dir``, capped at the number of GB given
+    by the ``size_option`` setting"""
+    max_gb = float(
+        configuration.get_config_value("chickadee", size_option) or default_gb
+    )
+    return DiskCache(os.path.join(get_cache_dir(), name), int(max_gb * 2**30))
+
+
+def get_digests():
+    """Digests of input files, shared by the processes of the service"""
+    return DiskCache(os.path.join(get_cache_dir(), "digests"), DIGESTS_MAX_BYTES)
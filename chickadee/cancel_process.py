@@ -4,6 +4,7 @@ import signal
 from pywps.dblog import store_status, get_session, ProcessInstance
 from pywps.response.status import WPS_STATUS
 from chickadee.response_tracker import get_response
+from chickadee import cancellation
 
 
 def handle_cancel(environ, start_response):
@@ -33,6 +34,7 @@ def handle_cancel(environ, start_response):
         pid = process.pid
         try:
             response = get_response(process_uuid)
+            cancellation.request_cancel(process_uuid)
 
             if process.status in {WPS_STATUS.STARTED, WPS_STATUS.PAUSED}:
                 os.kill(pid, signal.SIGINT)  # Graceful termination
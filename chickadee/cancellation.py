@@ -0,0 +1,94 @@
+"""Cancellation state of running processes.
+
+Checking whether a process was cancelled happens on every line of R console
+output, so it must not cost a database query. A cancellation is recorded in
+memory and as a flag file in the runtime directory, which is visible to the
+forked processes pywps runs requests in. The pywps database is only polled as
+a fallback, at most once every ``DB_POLL_INTERVAL`` seconds per process.
+"""
+
+import os
+import time
+from contextlib import contextmanager
+from pywps.dblog import ProcessInstance
+from pywps.response.status import WPS_STATUS
+
+import chickadee.utils as util
+from chickadee.db import get_session
+
+
+DB_POLL_INTERVAL = 5
+FLAG_MAX_AGE = 24 * 60 * 60
+
+_cancelled = set()
+_last_db_poll = {}
+
+
+def _flag_path(uuid):
+    return os.path.join(util.get_runtime_dir("cancelled"), str(uuid))
+
+
+def _prune_flags():
+    flag_dir = util.get_runtime_dir("cancelled")
+    now = time.time()
+    for name in os.listdir(flag_dir):
+        path = os.path.join(flag_dir, name)
+        try:
+            if now - os.path.getmtime(path) > FLAG_MAX_AGE:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def request_cancel(uuid):
+    """Mark the process with the given uuid as cancelled"""
+    _cancelled.add(str(uuid))
+    _prune_flags()
+    with open(_flag_path(uuid), "w"):
+        pass
+
+
+def is_cancelled(uuid):
+    uuid = str(uuid)
+    if uuid in _cancelled:
+        return True
+
+    if os.path.exists(_flag_path(uuid)):
+        _cancelled.add(uuid)
+        return True
+
+    now = time.monotonic()
+    if now - _last_db_poll.get(uuid, float("-inf")) < DB_POLL_INTERVAL:
+        return False
+    _last_db_poll[uuid] = now
+
+    session = get_session()
+    try:
+        process = session.query(ProcessInstance).filter_by(uuid=uuid).first()
+        if process and process.status == WPS_STATUS.FAILED:
+            _cancelled.add(uuid)
+            return True
+    finally:
+        session.close()
+    return False
+
+
+def clear(uuid):
+    """Forget the cancellation state of a finished process"""
+    uuid = str(uuid)
+    _cancelled.discard(uuid)
+    _last_db_poll.pop(uuid, None)
+    try:
+        os.remove(_flag_path(uuid))
+    except FileNotFoundError:
+        pass
+
+
+@contextmanager
+def tracking(uuid):
+    """Scope of the handler of a process, which forgets its cancellation
+    state when it returns or fails"""
+    try:
+        yield
+    finally:
+        clear(uuid)
@@ -6,12 +6,14 @@
 ###########################################################
 
 import os
+import signal
 import psutil
 import click
 from jinja2 import Environment, PackageLoader
 from pywps import configuration
 
-from . import wsgi
+from . import wsgi, cost_model, obs_registry, r_pool, task_queue
+from .engines.subset import Subset
 from urllib.parse import urlparse
 
 PID_FILE = os.path.abspath(os.path.join(os.path.curdir, "pywps.pid"))
@@ -32,6 +34,17 @@ def write_user_config(**kwargs):
     return config_file
 
 
+def load_config(config=None):
+    """Load the pywps configuration for commands that do not start the
+    service"""
+    config_files = [os.path.join(os.path.dirname(__file__), "default.cfg")]
+    if config:
+        config_files.append(config)
+    if "PYWPS_CFG" in os.environ:
+        config_files.append(os.environ["PYWPS_CFG"])
+    configuration.load_configuration(config_files)
+
+
 def get_host():
     url = configuration.get_config_value("server", "url")
     url = url or "http://localhost:5000/wps"
@@ -74,11 +87,19 @@ def run_process_action(action=None):
     click.echo(msg)
 
 
+def _exit(signum, frame):
+    raise SystemExit(0)
+
+
 def _run(application, bind_host=None, daemon=False):
     from werkzeug.serving import run_simple
 
     # call this *after* app is initialized ... needs pywps config.
     host, port = get_host()
+    # Pre-warm the R workers so requests don't pay for loading ClimDown
+    r_pool.start_pool()
+    # Exit cleanly on "chickadee stop" so the R workers are stopped too
+    signal.signal(signal.SIGTERM, _exit)
     bind_host = bind_host or host
     # need to serve the wps outputs
     static_files = {"/outputs": configuration.get_config_value("server", "outputpath")}
@@ -233,3 +254,159 @@ def start(
     else:
         # no daemon
         _run(app, bind_host=bind_host)
+
+
+@cli.group()
+@click.option(
+    "--config", "-c", metavar="PATH", help="path to pywps configuration file."
+)
+def obs(config):
+    """Manage the registry of observation datasets"""
+    load_config(config)
+
+
+@obs.command()
+@click.argument("source", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--id",
+    "obs_id",
+    metavar="ID",
+    help="ID of the dataset (defaults to the file name and the start of its digest).",
+)
+@click.option(
+    "--max-gb",
+    default=1.0,
+    show_default=True,
+    help="memory used while rewriting the dataset.",
+)
+def ingest(source, obs_id, max_gb):
+    """Ingest an observations file and print its ID"""
+    try:
+        entry = obs_registry.ingest(source, obs_id, max_gb)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(entry["id"])
+
+
+@obs.command("list")
+def list_obs():
+    """List the registered observation datasets"""
+    for entry in obs_registry.list_entries():
+        variables = ",".join(entry["variables"])
+        click.echo(f"{entry['id']}\t{variables}\t{entry['source']}")
+
+
+@obs.command()
+@click.argument("obs_id")
+def remove(obs_id):
+    """Remove a registered observation dataset"""
+    try:
+        obs_registry.remove(obs_id)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Removed {obs_id}")
+
+
+@cli.command()
+@click.option(
+    "--config", "-c", metavar="PATH", help="path to pywps configuration file."
+)
+@click.option(
+    "--name", metavar="NAME", help="name of the worker (defaults to HOST:PID)."
+)
+@click.option(
+    "--poll",
+    default=5.0,
+    show_default=True,
+    help="seconds to wait when the queue is empty.",
+)
+@click.option(
+    "--max-tasks", type=int, metavar="INT", help="exit after running INT tiles."
+)
+def worker(config, name, poll, max_tasks):
+    """Run tiles from the task queue"""
+    load_config(config)
+    if not task_queue.enabled():
+        raise click.ClickException("No task_queue in the configuration")
+
+    def terminate(signum, frame):
+        # Puts back the tile that is running
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, terminate)
+    count = task_queue.work(name, poll, max_tasks)
+    click.echo(f"Ran {count} tiles")
+
+
+@cli.command()
+@click.option(
+    "--config", "-c", metavar="PATH", help="path to pywps configuration file."
+)
+@click.argument("process", type=click.Choice(["ca", "ci", "qdm", "rerank", "bccaq"]))
+@click.argument("gcm_file")
+@click.argument("obs_file")
+@click.option("--varname", required=True, help="variable to downscale.")
+@click.option(
+    "--engine",
+    type=click.Choice(["climdown", "numpy"]),
+    default="climdown",
+    show_default=True,
+    help="engine of the steps.",
+)
+@click.option("--num-cores", default="auto", show_default=True, help="cores to use.")
+@click.option(
+    "--max-gb", default=1.0, show_default=True, help="memory of the chunk I/O loop."
+)
+@click.option("--bbox", help="subset as west,south,east,north.")
+@click.option("--time-range", help="subset as start/end dates of the output.")
+@click.option(
+    "--start-date",
+    type=click.DateTime(["%Y-%m-%d"]),
+    default="1971-01-01",
+    show_default=True,
+    help="start of the calibration period.",
+)
+@click.option(
+    "--end-date",
+    type=click.DateTime(["%Y-%m-%d"]),
+    default="2005-12-31",
+    show_default=True,
+    help="end of the calibration period.",
+)
+def estimate(
+    config,
+    process,
+    gcm_file,
+    obs_file,
+    varname,
+    engine,
+    num_cores,
+    max_gb,
+    bbox,
+    time_range,
+    start_date,
+    end_date,
+):
+    """Estimate the cost of a request from the headers of its inputs. For
+    rerank, give the QDM output as GCM_FILE."""
+    load_config(config)
+    try:
+        job = cost_model.describe(
+            process,
+            engine,
+            gcm_file,
+            obs_file,
+            max_gb,
+            num_cores,
+            varname,
+            varname,
+            Subset.from_inputs(bbox, time_range),
+            (start_date.date(), end_date.date()),
+        )
+        estimate = cost_model.estimate(job)
+    except (ValueError, OSError) as e:
+        raise click.ClickException(str(e))
+    fitted = f"fitted to {estimate['runs']} runs" if estimate["runs"] else "default"
+    click.echo(f"wall time:   {estimate['wall_time']:.0f} s ({fitted})")
+    click.echo(f"peak memory: {estimate['peak_memory_gb']:.2f} GB")
+    click.echo(f"output size: {estimate['output_gb']:.2f} GB")
@@ -0,0 +1,104 @@
+"""CPU cores of the host and the cores committed to running jobs.
+
+The cores jobs may use are detected from the CPU affinity of the
+service and the CPU quota of its cgroup, unless ``max_cores`` is set. Every
+job reserves its ``num_cores`` in a ledger shared by the processes of the
+service, and gets at most the cores no other job holds: ``num_cores=auto``
+takes all of them, a number is clamped to them. A job always gets at least
+one core, so a busy host slows jobs down instead of failing them.
+"""
+
+import os
+import uuid
+from contextlib import contextmanager
+from pywps import configuration
+
+import chickadee.utils as util
+from chickadee.ledger import open_ledger
+
+
+LEDGER = "cores"
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+
+def cgroup_quota(root=CGROUP_ROOT):
+    """CPU quota of the cgroup of the service in CPUs, or None if it has
+    none"""
+    try:
+        # cgroup v2
+        with open(os.path.join(root, "cpu.max")) as f:
+            quota, period = f.read().split()
+        return None if quota == "max" else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        # cgroup v1
+        with open(os.path.join(root, "cpu", "cpu.cfs_quota_us")) as f:
+            quota = int(f.read())
+        with open(os.path.join(root, "cpu", "cpu.cfs_period_us")) as f:
+            period = int(f.read())
+        return None if quota <= 0 else quota / period
+    except (OSError, ValueError):
+        return None
+
+
+def detect_cores(root=CGROUP_ROOT):
+    """Cores the service may use: its CPU affinity, capped by the cgroup
+    quota"""
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    quota = cgroup_quota(root)
+    if quota is not None:
+        cores = min(cores, max(1, int(quota)))
+    return cores
+
+
+def get_max_cores():
+    # Resolved on every call, the configuration may be loaded after import
+    max_cores = configuration.get_config_value("chickadee", "max_cores")
+    return int(max_cores) if max_cores else detect_cores()
+
+
+def parse(num_cores):
+    """``num_cores`` as a number, or "auto" """
+    if str(num_cores).strip().lower() == "auto":
+        return "auto"
+    try:
+        num_cores = int(num_cores)
+    except ValueError:
+        raise ValueError(f"num_cores must be a positive integer or auto: {num_cores}")
+    if num_cores < 1:
+        raise ValueError(f"num_cores must be a positive integer or auto: {num_cores}")
+    return num_cores
+
+
+def clamp(num_cores, available):
+    """Cores a job asking for ``num_cores`` gets with ``available`` free"""
+    available = max(1, available)
+    num_cores = parse(num_cores)
+    return available if num_cores == "auto" else min(num_cores, available)
+
+
+def committed():
+    """Cores reserved by running jobs"""
+    with open_ledger(LEDGER) as ledger:
+        return sum(entry["cores"] for entry in ledger.values())
+
+
+@contextmanager
+def reserve(num_cores):
+    """Reserve cores for a job asking for ``num_cores`` and yield how many
+    it gets"""
+    token = uuid.uuid4().hex
+    with open_ledger(LEDGER) as ledger:
+        used = sum(entry["cores"] for entry in ledger.values())
+        cores = clamp(num_cores, get_max_cores() - used)
+        ledger[token] = {"pid": os.getpid(), "cores": cores}
+    util.logger.info(f"Running with {cores} cores ({used} in use by other jobs)")
+    try:
+        yield cores
+    finally:
+        with open_ledger(LEDGER) as ledger:
+            ledger.pop(token, None)
@@ -0,0 +1,192 @@
+"""Estimates of the cost of a job before it runs.
+
+A job is described by its process, its engine, the (time, lat, lon) shapes
+of its GCM and observations, which are read from the NetCDF headers within
+its subset, its ``max_gb`` and its ``num_cores``. The peak memory of a job
+is the estimate used by admission control (see ``chickadee.admission``) and
+the size of its output follows from the shapes. Its wall time is modelled as
+
+    seconds = overhead + rate * work / num_cores
+
+where the work is the number of GCM timesteps times the cells of the
+observations grid, or for CA the GCM timesteps and cells times the observed
+days the analogues are searched in. Every finished job records how long it
+took in ``timings.jsonl`` in the cache directory, and the overhead and rate
+of each process and engine are fitted to the last ``MAX_RUNS`` runs of this
+deployment. Until ``MIN_RUNS`` runs were recorded, default rates are used.
+"""
+
+import os
+import json
+import time
+import fcntl
+import numpy as np
+from collections import namedtuple
+from contextlib import contextmanager
+
+import chickadee.utils as util
+from chickadee import admission, cache, cores
+from chickadee.engines import netcdf
+
+
+MIN_RUNS = 3
+MAX_RUNS = 200
+
+# Default overhead in seconds and seconds per unit of work and core
+DEFAULT_OVERHEAD = {"climdown": 30.0, "numpy": 5.0}
+DEFAULT_RATES = {
+    ("ci", "climdown"): 2e-6,
+    ("ci", "numpy"): 5e-7,
+    ("ca", "climdown"): 2e-9,
+    ("ca", "numpy"): 5e-10,
+    ("qdm", "climdown"): 1e-5,
+    ("qdm", "numpy"): 2.5e-6,
+    ("rerank", "climdown"): 2e-6,
+    ("bccaq", "climdown"): 1.5e-5,
+    ("bccaq", "numpy"): 5e-6,
+}
+# Analogues found for every GCM timestep, with their indices and weights
+ANALOGUES = 30
+
+Job = namedtuple(
+    "Job", ["process", "engine", "gcm_shape", "obs_shape", "max_gb", "num_cores"]
+)
+
+
+def read_shape(path, varname=None, window=None):
+    """Shape of ``varname`` in ``path``, or of its largest variable, within
+    ``window``"""
+    with netcdf.open_dataset(path, window) as nc:
+        if varname in nc.variables:
+            return tuple(nc.variables[varname].shape)
+        return max((var.shape for var in nc.variables.values()), key=np.prod)
+
+
+def describe(
+    process,
+    engine,
+    gcm_file,
+    obs_file,
+    max_gb,
+    num_cores,
+    gcm_varname=None,
+    obs_varname=None,
+    subset=None,
+    calibration=None,
+):
+    """The Job of a ``process`` request. Rerank has no GCM, its QDM output
+    is given as ``gcm_file`` instead. A ``num_cores`` of "auto" is taken as
+    all the cores."""
+    obs_shape = read_shape(obs_file, obs_varname, subset and subset.window(obs_file))
+    gcm_shape = read_shape(
+        gcm_file, gcm_varname, subset and subset.window(gcm_file, calibration)
+    )
+    num_cores = cores.clamp(num_cores, cores.get_max_cores())
+    if process == "rerank":
+        # Rerank only runs in ClimDown
+        engine = "climdown"
+    return Job(process, engine, gcm_shape, obs_shape, max_gb, num_cores)
+
+
+def work(job):
+    if job.process == "ca":
+        return float(np.prod(job.gcm_shape)) * job.obs_shape[0]
+    return float(job.gcm_shape[0]) * np.prod(job.obs_shape[1:])
+
+
+def peak_gb(job):
+    return admission.estimate_gb(
+        job.process,
+        job.engine,
+        job.gcm_shape,
+        job.obs_shape,
+        job.max_gb,
+        job.num_cores,
+    )
+
+
+def output_gb(job):
+    if job.process == "ca":
+        # int64 indices and double weights
+        return job.gcm_shape[0] * ANALOGUES * 16 / 2**30
+    # float32 on the observations grid
+    return 4 * float(job.gcm_shape[0]) * np.prod(job.obs_shape[1:]) / 2**30
+
+
+def get_history_file():
+    return os.path.join(cache.get_cache_dir(), "timings.jsonl")
+
+
+def record(job, seconds):
+    """Add the wall time of a finished job to the history"""
+    entry = dict(job._asdict(), seconds=seconds, time=time.time())
+    history_file = get_history_file()
+    try:
+        os.makedirs(os.path.dirname(history_file), exist_ok=True)
+        with open(history_file, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(json.dumps(entry) + "\n")
+    except OSError as e:
+        util.logger.warning(f"Failed to record the wall time of the job: {e}")
+
+
+@contextmanager
+def timed(job):
+    """Record the wall time of ``job`` if it finishes"""
+    start = time.monotonic()
+    yield
+    record(job, time.monotonic() - start)
+
+
+def load_history(process, engine):
+    """The last ``MAX_RUNS`` recorded runs of ``process`` with ``engine``"""
+    try:
+        with open(get_history_file()) as f:
+            lines = f.readlines()
+    except FileNotFoundError:
+        return []
+    runs = []
+    for line in lines:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            # Partly written by a job that was killed
+            continue
+        if entry["process"] == process and entry["engine"] == engine:
+            runs.append(entry)
+    return runs[-MAX_RUNS:]
+
+
+def fit(runs):
+    """Overhead and rate fitted to ``runs`` by least squares"""
+    per_core = np.array(
+        [
+            work(Job(**{k: run[k] for k in Job._fields})) / run["num_cores"]
+            for run in runs
+        ]
+    )
+    seconds = np.array([run["seconds"] for run in runs])
+    design = np.column_stack([np.ones_like(per_core), per_core])
+    (overhead, rate), *_ = np.linalg.lstsq(design, seconds, rcond=None)
+    if overhead < 0 or rate <= 0:
+        # Fit through the origin instead
+        overhead = 0.0
+        rate = per_core @ seconds / max(per_core @ per_core, 1e-300)
+    return float(overhead), float(rate)
+
+
+def estimate(job):
+    """Predicted wall time in seconds, peak memory and output size in GB of
+    ``job``, and the number of recorded runs the wall time is fitted to"""
+    runs = load_history(job.process, job.engine)
+    if len(runs) >= MIN_RUNS:
+        overhead, rate = fit(runs)
+    else:
+        overhead = DEFAULT_OVERHEAD[job.engine]
+        rate = DEFAULT_RATES[job.process, job.engine]
+    return {
+        "wall_time": overhead + rate * work(job) / job.num_cores,
+        "peak_memory_gb": peak_gb(job),
+        "output_gb": output_gb(job),
+        "runs": len(runs) if len(runs) >= MIN_RUNS else 0,
+    }
@@ -0,0 +1,37 @@
+"""Pooled connections to the pywps database for chickadee's own queries.
+
+``pywps.dblog.get_session`` opens a new connection for every session. The
+status and cancellation checks chickadee runs while a process is executing
+use the engine below instead, which keeps its connections in a pool. The
+engine is rebuilt after a fork so that processes never share connections.
+"""
+
+import os
+import sqlalchemy
+from sqlalchemy.orm import sessionmaker
+from pywps import configuration, dblog
+
+
+_session_maker = None
+_session_key = None
+
+
+def get_session():
+    global _session_maker, _session_key
+
+    database = configuration.get_config_value("logging", "database")
+    if ":memory:" in database:
+        # A second engine would open a different in-memory database
+        return dblog.get_session()
+
+    key = (database, os.getpid())
+    if _session_key != key:
+        connect_args = (
+            {"check_same_thread": False} if database.startswith("sqlite") else {}
+        )
+        engine = sqlalchemy.create_engine(
+            database, pool_pre_ping=True, connect_args=connect_args
+        )
+        _session_maker = sessionmaker(bind=engine)
+        _session_key = key
+    return _session_maker()
@@ -0,0 +1,8 @@
+"""Native Python implementations of ClimDown's downscaling steps.
+
+The processes run ClimDown through R by default. Passing ``engine=numpy``
+selects the implementations in this package instead, which read the NetCDF
+files directly and work on many grid cells at once.
+"""
+
+ENGINES = ["climdown", "numpy"]
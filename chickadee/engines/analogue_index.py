@@ -0,0 +1,187 @@
+"""Approximate nearest-neighbour index for the analogue search.
+
+The exact search compares every GCM timestep with all observed days in its
+``delta_days`` window. The index instead reduces the aggregated observations
+to their leading principal components and keeps a KD-tree of the candidate
+days of every day of year. A query takes the ``oversample * num_analogues``
+closest candidates from the tree and ranks them by their exact distance.
+
+The trees are built lazily, once per day of year, and kept for the lifetime
+of the index. Given a ``cache_key``, the principal components and the trees
+are also kept in the ``obs`` cache (see ``chickadee.engines.obs_cache``), so
+jobs on the same observations do not build them again. Before an index is
+used its recall is measured against the exact search on a sample of
+timesteps.
+"""
+
+import logging
+import numpy as np
+from pywps import configuration
+from scipy.spatial import cKDTree
+
+from chickadee.engines import ca, obs_cache
+
+
+logger = logging.getLogger("PYWPS")
+
+DEFAULT_SETTINGS = {
+    "ann_variance": 0.99,
+    "ann_oversample": 4,
+    "ann_sample_size": 200,
+    "ann_min_recall": 0.9,
+    "ann_fallback": True,
+}
+
+
+def get_settings():
+    settings = dict(DEFAULT_SETTINGS)
+    for name, default in DEFAULT_SETTINGS.items():
+        value = configuration.get_config_value("chickadee", name)
+        if value == "" or value is None:
+            continue
+        if isinstance(default, bool):
+            settings[name] = str(value).lower() in ("true", "1", "yes")
+        else:
+            settings[name] = type(default)(value)
+    return settings
+
+
+class AnalogueIndex:
+    """Index of the observed days of every day of year.
+
+    ``obs`` is the (time, cells) array of aggregated observations and
+    ``obs_doy`` the day of year of each of its timesteps. ``cache_key`` is
+    ``obs_cache.make_key`` with every argument but the name of the statistic
+    given, or ``None`` to not cache the index.
+    """
+
+    def __init__(
+        self, obs, obs_doy, delta_days, variance=0.99, oversample=4, cache_key=None
+    ):
+        self.obs = obs
+        self.obs_doy = obs_doy
+        self.delta_days = delta_days
+        self.variance = variance
+        self.oversample = oversample
+        self.cache_key = cache_key
+
+        def principal_components():
+            mean = obs.mean(axis=0)
+            _, singular, vt = np.linalg.svd(obs - mean, full_matrices=False)
+            explained = np.cumsum(singular**2) / max(
+                (singular**2).sum(), np.finfo(float).tiny
+            )
+            n_components = int(np.searchsorted(explained, variance) + 1)
+            components = vt[: min(n_components, len(vt))].T
+            return {
+                "mean": mean,
+                "components": components,
+                "projected": (obs - mean) @ components,
+            }
+
+        if cache_key:
+            pca = obs_cache.load_arrays(
+                cache_key("analogue_pca", variance=variance), principal_components
+            )
+        else:
+            pca = principal_components()
+        self.mean = pca["mean"]
+        self.components = pca["components"]
+        self.projected = pca["projected"]
+        self._trees = {}
+
+    def _tree(self, doy):
+        if doy not in self._trees:
+            candidates = ca.candidate_days(self.obs_doy, doy, self.delta_days)
+
+            def tree():
+                return cKDTree(self.projected[candidates])
+
+            if self.cache_key:
+                key = self.cache_key(
+                    "analogue_tree",
+                    variance=self.variance,
+                    delta_days=self.delta_days,
+                    doy=int(doy),
+                )
+                self._trees[doy] = (candidates, obs_cache.load_object(key, tree))
+            else:
+                self._trees[doy] = (candidates, tree())
+        return self._trees[doy]
+
+    def candidates(self, doy):
+        return self._tree(doy)[0]
+
+    def query(self, targets, doy, k):
+        """(n, k) positions in ``candidates(doy)`` of the analogues of
+        ``targets``, ordered by exact distance"""
+        candidates, tree = self._tree(doy)
+        m = min(k * self.oversample, len(candidates))
+        _, shortlist = tree.query((targets - self.mean) @ self.components, m)
+        shortlist = shortlist.reshape(len(targets), m)
+
+        # Rank the shortlist by distance in the full space
+        values = self.obs[candidates[shortlist]]
+        distances = ((values - targets[:, None, :]) ** 2).sum(axis=2)
+        order = np.argsort(distances, axis=1)[:, :k]
+        return np.take_along_axis(shortlist, order, axis=1)
+
+    def recall(self, targets, target_doy, k):
+        """Mean fraction of the exact ``k`` nearest analogues the index finds"""
+        found = []
+        for doy in np.unique(target_doy):
+            sample = targets[target_doy == doy]
+            candidates = self.candidates(doy)
+            exact = ca.nearest_candidates(sample, self.obs[candidates], k)
+            approximate = self.query(sample, doy, k)
+            found.extend(
+                len(np.intersect1d(e, a)) / k for e, a in zip(exact, approximate)
+            )
+        return float(np.mean(found))
+
+
+def build_index(
+    gcm,
+    gcm_doy,
+    obs,
+    obs_doy,
+    num_analogues,
+    delta_days,
+    settings=None,
+    cache_key=None,
+):
+    """Build an index for ``obs`` and check it on a sample of ``gcm``.
+
+    Returns ``None`` when the recall is below ``ann_min_recall`` and
+    ``ann_fallback`` is set, in which case the exact search should be used.
+    """
+    settings = settings or get_settings()
+    index = AnalogueIndex(
+        obs,
+        obs_doy,
+        delta_days,
+        settings["ann_variance"],
+        settings["ann_oversample"],
+        cache_key,
+    )
+
+    rng = np.random.default_rng(0)
+    size = min(settings["ann_sample_size"], len(gcm))
+    sample = rng.choice(len(gcm), size, replace=False)
+    recall = index.recall(gcm[sample], gcm_doy[sample], num_analogues)
+    logger.info(
+        f"Analogue index with {index.components.shape[1]} components "
+        f"has a recall of {recall:.3f}"
+    )
+    if recall < settings["ann_min_recall"]:
+        if settings["ann_fallback"]:
+            logger.warning(
+                f"Analogue index recall {recall:.3f} is below "
+                f"{settings['ann_min_recall']}, using the exact search"
+            )
+            return None
+        logger.warning(
+            f"Analogue index recall {recall:.3f} is below "
+            f"{settings['ann_min_recall']}"
+        )
+    return index
@@ -0,0 +1,344 @@
+"""Constructed analogues (CA) with NumPy.
+
+A vectorized port of ClimDown's ``ca.netcdf.wrapper``. The observations are
+aggregated to the GCM grid from their valid cells (see ``cells``), or taken
+from the obs cache, and the GCM is bias corrected against them. For every
+GCM timestep, the ``num_analogues`` closest observed days within
+``delta_days`` of its day of year are selected and weighted with a ridge
+regression.
+
+GCM timesteps are grouped by day of year, since all timesteps of a day share
+the same candidate days. The distances for a group are one matrix product
+and its ridge systems are solved in a single batched call.
+"""
+
+import numpy as np
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+from chickadee import cache
+from chickadee.engines import netcdf, analogue_index, obs_cache, cells
+
+
+# Day of year of the first of every month, in a leap year
+_MONTH_START = np.cumsum([0, 31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+DAYS_IN_YEAR = 366
+
+
+def day_of_year(dates):
+    """Day of year (0-365) of (n, 3) dates, with February 29th always at 59"""
+    return _MONTH_START[dates[:, 1] - 1] + dates[:, 2] - 1
+
+
+def _cell_edges(centres):
+    centres = np.asarray(centres, dtype=np.float64)
+    if len(centres) == 1:
+        return np.array([centres[0] - 0.5, centres[0] + 0.5])
+    mid = (centres[1:] + centres[:-1]) / 2
+    return np.concatenate([[2 * centres[0] - mid[0]], mid, [2 * centres[-1] - mid[-1]]])
+
+
+def _cell_index(fine, coarse):
+    """Index of the coarse cell every fine coordinate falls in, or -1"""
+    edges = _cell_edges(coarse)
+    descending = edges[0] > edges[-1]
+    if descending:
+        edges = edges[::-1]
+    index = np.searchsorted(edges, fine, side="right") - 1
+    index[(index < 0) | (index >= len(coarse))] = -1
+    if descending:
+        index[index >= 0] = len(coarse) - 1 - index[index >= 0]
+    return index
+
+
+def _normalize_lon(lon):
+    return (np.asarray(lon, dtype=np.float64) + 180) % 360 - 180
+
+
+def aggregation_matrix(obs_lat, obs_lon, gcm_lat, gcm_lon):
+    """(obs cells, gcm cells) matrix which sums the obs cells inside each GCM
+    cell"""
+    lat_index = _cell_index(obs_lat, gcm_lat)
+    lon_index = _cell_index(_normalize_lon(obs_lon), np.sort(_normalize_lon(gcm_lon)))
+    # Map back from sorted to file order of the GCM longitudes
+    lon_order = np.argsort(_normalize_lon(gcm_lon))
+    lon_index = np.where(lon_index >= 0, lon_order[lon_index], -1)
+
+    obs_cells = np.arange(len(obs_lat) * len(obs_lon)).reshape(
+        len(obs_lat), len(obs_lon)
+    )
+    gcm_cells = lat_index[:, None] * len(gcm_lon) + lon_index[None, :]
+    inside = (lat_index[:, None] >= 0) & (lon_index[None, :] >= 0)
+
+    matrix = np.zeros((obs_cells.size, len(gcm_lat) * len(gcm_lon)))
+    matrix[obs_cells[inside], gcm_cells[inside]] = 1
+    return matrix
+
+
+def aggregate_obs(obs_var, matrix, valid_cells, blocks, from_units=None, to_units=None):
+    """(time, gcm cells) mean of the valid obs cells in every GCM cell.
+
+    ``matrix`` aggregates the packed ``valid_cells`` of the observations,
+    which are read in ``blocks`` of grid rows.
+    """
+    offsets = cells.row_offsets(valid_cells)
+    total = count = 0
+
+    def read(rows):
+        values = netcdf.read_block(obs_var, rows, from_units, to_units)
+        return values[:, valid_cells[rows].ravel()]
+
+    for rows, values in netcdf.prefetch(read, blocks):
+        valid = np.isfinite(values)
+        part = matrix[offsets[rows.start] : offsets[rows.stop]]
+        total = total + np.where(valid, values, 0) @ part
+        count = count + valid @ part
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(count > 0, total / count, np.nan)
+
+
+def trimmed_mean(values, trim, axis=0):
+    """Mean along ``axis`` after dropping ``trim`` of the values at each end,
+    like R's ``mean(x, trim=trim)``"""
+    if trim <= 0:
+        return values.mean(axis=axis)
+    n = values.shape[axis]
+    cut = int(np.floor(n * trim))
+    if cut * 2 >= n:
+        return np.median(values, axis=axis)
+    ordered = np.sort(values, axis=axis)
+    return np.take(ordered, np.arange(cut, n - cut), axis=axis).mean(axis=axis)
+
+
+def bias_correct(gcm, gcm_months, gcm_calib, obs, obs_months, trim):
+    """Remove the difference between the monthly calibration means of the
+    GCM and the aggregated observations"""
+    corrected = gcm.copy()
+    for month in range(1, 13):
+        gcm_month = gcm_months == month
+        obs_month = obs_months == month
+        if not (gcm_month & gcm_calib).any() or not obs_month.any():
+            continue
+        bias = trimmed_mean(gcm[gcm_month & gcm_calib], trim) - trimmed_mean(
+            obs[obs_month], trim
+        )
+        corrected[gcm_month] -= bias
+    return corrected
+
+
+def candidate_days(obs_doy, doy, delta_days):
+    """Indices of the observed days within ``delta_days`` of ``doy``"""
+    distance = np.abs(obs_doy - doy)
+    distance = np.minimum(distance, DAYS_IN_YEAR - distance)
+    return np.flatnonzero(distance <= delta_days)
+
+
+def nearest_candidates(targets, candidates, k):
+    """(n, k) indices into the (m, cells) ``candidates`` of the closest
+    candidates of every (n, cells) target, ordered by distance"""
+    k = min(k, len(candidates))
+    # Squared euclidean distances as a single matrix product
+    distances = (candidates**2).sum(axis=1)[None, :] - 2 * targets @ candidates.T
+    nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    order = np.argsort(np.take_along_axis(distances, nearest, axis=1), axis=1)
+    return np.take_along_axis(nearest, order, axis=1)
+
+
+def find_analogues(targets, candidates, num_analogues, tol):
+    """Select and weight the closest candidates of every target.
+
+    Returns the (n, k) indices into ``candidates``, ordered by distance, and
+    their (n, k) ridge regression weights.
+    """
+    nearest = nearest_candidates(targets, candidates, num_analogues)
+    return nearest, ridge_weights(targets, candidates[nearest], tol)
+
+
+def ridge_weights(targets, analogues, tol):
+    """Solve (Q Q' + tol I) w = Q y for every (cells,) target y and its
+    (k, cells) analogues Q at once"""
+    gram = analogues @ analogues.transpose(0, 2, 1)
+    gram += tol * np.eye(analogues.shape[1])
+    rhs = analogues @ targets[:, :, None]
+    return np.linalg.solve(gram, rhs)[:, :, 0]
+
+
+def analogue_search(
+    gcm,
+    gcm_doy,
+    obs,
+    obs_doy,
+    num_analogues,
+    delta_days,
+    tol,
+    num_cores=1,
+    index=None,
+):
+    """Indices (into ``obs``) and weights of the analogues of every GCM
+    timestep, as (time, k) arrays.
+
+    With an ``index`` (see ``analogue_index``) the closest candidates are
+    looked up in the index instead of being compared exhaustively.
+    """
+    k = num_analogues
+    indices = np.zeros((len(gcm), k), dtype=np.int64)
+    weights = np.zeros((len(gcm), k))
+
+    def search(doy):
+        targets = np.flatnonzero(gcm_doy == doy)
+        candidates = candidate_days(obs_doy, doy, delta_days)
+        if len(candidates) < k:
+            raise ValueError(
+                f"Only {len(candidates)} observed days within {delta_days} days "
+                f"of day {doy + 1}, {k} analogues requested"
+            )
+        if index is None:
+            nearest, w = find_analogues(gcm[targets], obs[candidates], k, tol)
+        else:
+            nearest = index.query(gcm[targets], doy, k)
+            w = ridge_weights(gcm[targets], obs[candidates][nearest], tol)
+        indices[targets] = candidates[nearest]
+        weights[targets] = w
+
+    days = np.unique(gcm_doy)
+    if num_cores > 1:
+        # NumPy releases the GIL in the matrix products and solves
+        with ThreadPoolExecutor(num_cores) as executor:
+            list(executor.map(search, days))
+    else:
+        for doy in days:
+            search(doy)
+    return indices, weights
+
+
+def ca_netcdf(
+    gcm_file, obs_file, varname, options, num_cores=1, search="exact", subset=None
+):
+    """Find the constructed analogues of every timestep of ``gcm_file``.
+
+    ``options`` holds the values of the general and CA options inputs by
+    identifier. ``search="index"`` uses an approximate nearest-neighbour
+    index, falling back to the exact search if it is not accurate enough.
+    Returns ``{"indices": [...], "weights": [...]}`` with one array per GCM
+    timestep and 1-based indices into the observed timesteps, the structure
+    ClimDown's CA step returns. Only the ``subset`` of the inputs is read if
+    given, in which case there is one array per timestep of the subset.
+    """
+    calibration = (options["start_date"], options["end_date"])
+    with (
+        netcdf.open_dataset(
+            gcm_file, subset and subset.window(gcm_file, calibration)
+        ) as gcm_nc,
+        netcdf.open_dataset(obs_file, subset and subset.window(obs_file)) as obs_nc,
+    ):
+        for nc, name in ((obs_nc, "observations"), (gcm_nc, "GCM")):
+            if varname not in nc.variables:
+                raise ValueError(f"Variable '{varname}' not found in {name} file")
+        gcm_var, obs_var = gcm_nc.variables[varname], obs_nc.variables[varname]
+        gcm_units = getattr(gcm_var, "units", None)
+        obs_units = getattr(obs_var, "units", None)
+        target_units = None
+        if options["units_bool"]:
+            target_units = options.get(f"{varname}_units") or gcm_units
+
+        gcm_dates = netcdf.read_dates(gcm_nc, varname)
+        obs_dates = netcdf.read_dates(obs_nc, varname)
+        obs_calib = netcdf.in_period(
+            obs_dates, options["start_date"], options["end_date"]
+        )
+        gcm_calib = netcdf.in_period(
+            gcm_dates, options["start_date"], options["end_date"]
+        )
+        if not obs_calib.any():
+            raise ValueError("No observations in the calibration period")
+
+        gcm_lat, gcm_lon = gcm_nc.variables["lat"][:], gcm_nc.variables["lon"][:]
+
+        def aggregate():
+            valid = cells.load_valid(
+                obs_file, obs_var, varname, options["max_gb"], subset and subset.bbox
+            )
+            matrix = aggregation_matrix(
+                obs_nc.variables["lat"][:],
+                obs_nc.variables["lon"][:],
+                gcm_lat,
+                gcm_lon,
+            )[valid.ravel()]
+            # The values, their mask and a working copy of the valid cells,
+            # the block read ahead and the whole rows they are read from
+            blocks = cells.row_blocks(
+                valid,
+                netcdf.block_budget(options["max_gb"]),
+                8 * 4 * len(obs_dates),
+                8 * len(obs_dates),
+                netcdf.chunk_layout(obs_var, 1),
+            )
+            netcdf.log_plan(netcdf.chunking(obs_var), 1, blocks)
+            obs = aggregate_obs(obs_var, matrix, valid, blocks, obs_units, target_units)
+            return obs[obs_calib]
+
+        statistic_params = dict(
+            obs_file=obs_file,
+            start_date=options["start_date"],
+            end_date=options["end_date"],
+            varname=varname,
+            units=target_units,
+            grid=[cache.array_digest(axis) for axis in (gcm_lat, gcm_lon)],
+            bbox=subset and subset.bbox,
+        )
+        obs = obs_cache.load(
+            obs_cache.make_key("aggregate", **statistic_params), aggregate
+        )
+        gcm = netcdf.read_block(gcm_var, slice(None), gcm_units, target_units)
+
+    # Only cells with data everywhere take part in the search
+    usable = np.isfinite(obs).all(axis=0) & np.isfinite(gcm).all(axis=0)
+    if not usable.any():
+        raise ValueError("No grid cells with data in both GCM and observations")
+    obs_index = np.flatnonzero(obs_calib)
+    obs = obs[:, usable]
+    gcm = gcm[:, usable]
+    if varname == "pr" and options["n_pr_bool"]:
+        np.maximum(gcm, 0, out=gcm)
+
+    gcm = bias_correct(
+        gcm,
+        gcm_dates[:, 1],
+        gcm_calib,
+        obs,
+        obs_dates[obs_calib, 1],
+        options["trimmed_mean"],
+    )
+    gcm_doy = day_of_year(gcm_dates)
+    obs_doy = day_of_year(obs_dates[obs_calib])
+    index = None
+    if search == "index":
+        index = analogue_index.build_index(
+            gcm,
+            gcm_doy,
+            obs,
+            obs_doy,
+            options["num_analogues"],
+            options["delta_days"],
+            # The index covers the cells with data in the GCM too
+            cache_key=partial(
+                obs_cache.make_key,
+                usable=cache.array_digest(usable),
+                **statistic_params,
+            ),
+        )
+    indices, weights = analogue_search(
+        gcm,
+        gcm_doy,
+        obs,
+        obs_doy,
+        options["num_analogues"],
+        options["delta_days"],
+        options["tol"],
+        num_cores,
+        index,
+    )
+    return {
+        "indices": list(obs_index[indices] + 1),
+        "weights": list(weights),
+    }
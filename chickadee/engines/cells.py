@@ -0,0 +1,91 @@
+"""Valid cells of the observations.
+
+Observation grids are mostly missing over the ocean and outside the domain,
+and those cells come out missing from every step. The cells with data at
+any timestep are found once per observations dataset and kept in the obs
+cache. The engines then read, compute and hold in memory only the valid
+cells, packed in row-major order, and scatter the results back into the
+full grid when they are written.
+"""
+
+import numpy as np
+
+from chickadee.engines import netcdf, obs_cache
+
+
+def find_valid(var, time_size):
+    """(lat, lon) mask of the cells of ``var`` with data at any timestep,
+    read ``time_size`` timesteps at a time"""
+    valid = np.zeros(int(np.prod(var.shape[1:])), bool)
+
+    def read(steps):
+        return netcdf.read_block(var, slice(None), steps=steps)
+
+    blocks = netcdf.time_blocks(var, time_size)
+    for _, values in netcdf.prefetch(read, blocks):
+        valid |= np.isfinite(values).any(axis=0)
+    return valid.reshape(var.shape[1:])
+
+
+def load_valid(obs_file, var, varname, max_gb, bbox=None):
+    """Mask of the valid cells of ``varname`` in ``obs_file``, from the obs
+    cache. ``var`` is the (view of the) variable to read on a miss."""
+    # A timestep and the one read ahead
+    bytes_per_step = 8 * 2 * int(np.prod(var.shape[1:]))
+    time_size = netcdf.rows_per_block(max_gb, bytes_per_step, 1)
+    valid = obs_cache.load(
+        obs_cache.make_key(
+            "valid_cells", obs_file, None, None, varname=varname, bbox=bbox
+        ),
+        lambda: find_valid(var, time_size),
+    )
+    if not valid.any():
+        raise ValueError("No grid cells with data in the observations")
+    return valid
+
+
+def row_offsets(valid):
+    """Packed index of the first valid cell of every row, followed by the
+    number of valid cells"""
+    return np.concatenate([[0], np.cumsum(valid.sum(axis=1))])
+
+
+def row_blocks(valid, budget, bytes_per_cell, bytes_per_read=0, chunks=None):
+    """Blocks of consecutive grid rows to process packed, skipping rows
+    without valid cells.
+
+    A block needs ``bytes_per_cell`` for each of its valid cells and
+    ``bytes_per_read`` for each of the cells of its rows, which are read
+    before they are packed. Blocks stay within ``budget`` bytes unless a
+    single row does not fit. Blocks cut short by the budget end on the edge
+    of the row ``chunks`` given by ``netcdf.chunk_layout`` where they can.
+    """
+    ncols = valid.shape[1]
+    counts = valid.sum(axis=1)
+    costs = counts * bytes_per_cell + ncols * bytes_per_read
+    blocks, row = [], 0
+    while row < len(valid):
+        if counts[row] == 0:
+            row += 1
+            continue
+        start, used = row, 0
+        while row < len(valid) and counts[row] > 0:
+            if row > start and used + costs[row] > budget:
+                if chunks and row - start >= chunks[0]:
+                    extent, offset = chunks
+                    aligned = (offset + row) // extent * extent - offset
+                    row = aligned if aligned > start else row
+                break
+            used += costs[row]
+            row += 1
+        blocks.append(slice(start, row))
+    return blocks
+
+
+def scatter(values, cells, fill=np.nan):
+    """(time, cells) values on the grid from the packed (time, valid cells)
+    ``values``, given the mask of the valid ``cells``"""
+    cells = np.ravel(cells)
+    out = np.full((values.shape[0], cells.size), fill)
+    out[:, cells] = values
+    return out
@@ -0,0 +1,202 @@
+"""Climate Imprint (CI) with NumPy.
+
+A port of ClimDown's ``ci.netcdf.wrapper``. The daily GCM anomalies from
+its monthly calibration climatology are interpolated bilinearly to the
+observation grid, and the monthly climatologies of the observations are
+added back (or multiplied, for precipitation). The interpolation weights come
+from the regrid cache and the climatologies of the observations from the
+obs cache, so only the first job on a pair of grids or a calibration period
+builds them. The GCM is only interpolated to the cells with observations
+(see ``cells``).
+
+Progress is reported with the same messages ClimDown prints, so the R
+progress monitor of the CI process can follow either engine. Interpolation
+and applying the climatologies happen in the same pass over the GCM, which
+reports its progress as the latter.
+"""
+
+import numpy as np
+
+from chickadee.engines import netcdf, regrid, obs_cache, cells
+
+
+RATIO_VARIABLES = ("pr",)
+
+
+def monthly_climatology(
+    var, dates, calib, time_size, from_units=None, to_units=None, valid=None
+):
+    """(12, cells) mean of ``var`` for every month of the calibration period,
+    read ``time_size`` timesteps at a time. Only the ``valid`` cells are
+    kept, packed, if given."""
+    cells_read = valid.ravel() if valid is not None else slice(None)
+    ncells = int(np.prod(var.shape[1:]) if valid is None else valid.sum())
+    total = np.zeros((12, ncells))
+    count = np.zeros((12, ncells))
+
+    def read(steps):
+        values = netcdf.read_block(var, slice(None), from_units, to_units, steps)
+        return values[:, cells_read]
+
+    blocks = [
+        steps for steps in netcdf.time_blocks(var, time_size) if calib[steps].any()
+    ]
+    for steps, values in netcdf.prefetch(read, blocks):
+        months = dates[steps, 1] - 1
+        keep = calib[steps]
+        valid = np.isfinite(values[keep])
+        np.add.at(total, months[keep], np.where(valid, values[keep], 0))
+        np.add.at(count, months[keep], valid)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(count > 0, total / count, np.nan)
+
+
+def anomalies(values, months, climatology, ratio=False):
+    """Daily anomalies of (time, cells) ``values`` from their monthly
+    ``climatology``"""
+    clim = climatology[months - 1]
+    if ratio:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(clim > 0, values / clim, 1.0)
+    return values - clim
+
+
+def apply_climatology(values, months, climatology, ratio=False):
+    clim = climatology[months - 1]
+    return values * clim if ratio else values + clim
+
+
+def ci_netcdf(
+    gcm_file,
+    obs_file,
+    output_file,
+    gcm_varname,
+    obs_varname,
+    options,
+    progress=None,
+    subset=None,
+):
+    """Downscale ``gcm_varname`` in ``gcm_file`` to the grid of
+    ``obs_varname`` in ``obs_file``.
+
+    ``options`` holds the values of the general options inputs by identifier.
+    ``progress`` is called with ClimDown style progress messages. Only the
+    ``subset`` of the inputs (a ``subset.Subset``) is read if given.
+    """
+    progress = progress or (lambda message: None)
+    calibration = (options["start_date"], options["end_date"])
+    gcm_window = subset and subset.window(gcm_file, calibration)
+    obs_window = subset and subset.window(obs_file)
+    with (
+        netcdf.open_dataset(gcm_file, gcm_window) as gcm_nc,
+        netcdf.open_dataset(obs_file, obs_window) as obs_nc,
+    ):
+        for nc, name, varname in (
+            (gcm_nc, "GCM", gcm_varname),
+            (obs_nc, "observations", obs_varname),
+        ):
+            if varname not in nc.variables:
+                raise ValueError(f"Variable '{varname}' not found in {name} file")
+        gcm_var = gcm_nc.variables[gcm_varname]
+        obs_var = obs_nc.variables[obs_varname]
+        gcm_units = getattr(gcm_var, "units", None)
+        obs_units = getattr(obs_var, "units", None)
+        target_units = None
+        if options["units_bool"]:
+            target_units = options.get(f"{gcm_varname}_units") or obs_units
+        ratio = gcm_varname in RATIO_VARIABLES
+
+        gcm_dates = netcdf.read_dates(gcm_nc, gcm_varname)
+        obs_dates = netcdf.read_dates(obs_nc, obs_varname)
+        start, end = options["start_date"], options["end_date"]
+        gcm_calib = netcdf.in_period(gcm_dates, start, end)
+        obs_calib = netcdf.in_period(obs_dates, start, end)
+        if not gcm_calib.any() or not obs_calib.any():
+            raise ValueError("GCM or observations do not cover the calibration period")
+
+        n_obs_cells = int(np.prod(obs_var.shape[1:]))
+        n_gcm_cells = int(np.prod(gcm_var.shape[1:]))
+        valid = cells.load_valid(
+            obs_file, obs_var, obs_varname, options["max_gb"], subset and subset.bbox
+        )
+        # A GCM timestep, about four working copies of the valid cells and the
+        # full obs grid they are scattered to, and the timesteps read ahead
+        # and written behind
+        bytes_per_step = 8 * (4 * int(valid.sum()) + 2 * n_gcm_cells + 2 * n_obs_cells)
+        time_size = netcdf.rows_per_block(options["max_gb"], bytes_per_step, 1)
+
+        progress("Calculating daily anomalies on the GCM")
+        gcm_clim = monthly_climatology(
+            gcm_var, gcm_dates, gcm_calib, time_size, gcm_units, target_units
+        )
+
+        progress("Creating cache file for the interpolated GCM")
+        weights = regrid.get_weights(
+            gcm_nc.variables["lat"][:],
+            gcm_nc.variables["lon"][:],
+            obs_nc.variables["lat"][:],
+            obs_nc.variables["lon"][:],
+        ).tocsr()[valid.ravel()]
+
+        progress("Reading the monthly climatologies from the observations")
+        obs_clim = obs_cache.load(
+            obs_cache.make_key(
+                "monthly_climatology",
+                obs_file,
+                start,
+                end,
+                varname=obs_varname,
+                units=target_units,
+                bbox=subset and subset.bbox,
+            ),
+            lambda: monthly_climatology(
+                obs_var,
+                obs_dates,
+                obs_calib,
+                time_size,
+                obs_units,
+                target_units,
+                valid,
+            ),
+        )
+
+        progress("Adding the monthly climatologies to the interpolated GCM")
+        out = netcdf.create_regridded_output(
+            gcm_file,
+            obs_file,
+            output_file,
+            gcm_varname,
+            obs_varname,
+            target_units,
+            gcm_window,
+            obs_window,
+        )
+        try:
+            ntime = len(gcm_dates)
+            grid_shape = obs_var.shape[1:]
+
+            def read(steps):
+                return netcdf.read_block(
+                    gcm_var, slice(None), gcm_units, target_units, steps
+                )
+
+            def write(steps, downscaled):
+                out.variables[gcm_varname][steps] = np.ma.masked_invalid(
+                    downscaled.reshape(len(downscaled), *grid_shape)
+                )
+
+            with netcdf.write_behind(write) as submit:
+                blocks = netcdf.time_blocks(gcm_var, time_size)
+                for steps, values in netcdf.prefetch(read, blocks):
+                    months = gcm_dates[steps, 1]
+                    downscaled = regrid.regrid(
+                        anomalies(values, months, gcm_clim, ratio), weights
+                    )
+                    downscaled = apply_climatology(downscaled, months, obs_clim, ratio)
+                    submit(steps, cells.scatter(downscaled, valid))
+                    progress(
+                        f"Applying climatologies to file {output_file} steps "
+                        f"{steps.start + 1} : {steps.stop} / {ntime}"
+                    )
+        finally:
+            out.close()
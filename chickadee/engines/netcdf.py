@@ -0,0 +1,499 @@
+import os
+import math
+import queue
+import logging
+import threading
+import numpy as np
+from contextlib import contextmanager
+from netCDF4 import Dataset, num2date
+
+from chickadee.engines import units
+
+
+logger = logging.getLogger("PYWPS")
+
+# Chunking of copies made for the steps that sweep over time or over cells
+LAYOUTS = ("time_major", "cell_major")
+CHUNK_BYTES = 4 * 2**20
+# Blocks read ahead of, and written behind, the block being computed
+PIPELINE_DEPTH = 1
+# The NetCDF and HDF5 libraries are not thread-safe, so the reads and writes
+# of the pipeline threads take turns. They overlap the computation instead.
+LOCK = threading.Lock()
+
+
+def _window_index(index, key, size):
+    """Index into a whole dimension of ``key`` applied to its ``index``
+    window, as a slice where the result is contiguous"""
+    selected = np.arange(size)[index][key]
+    if np.ndim(selected) == 0:
+        return int(selected)
+    if len(selected) == 0:
+        return slice(0, 0)
+    if np.all(np.diff(selected) == 1):
+        return slice(int(selected[0]), int(selected[-1]) + 1)
+    return selected
+
+
+class _DimensionView:
+    def __init__(self, dim, size):
+        self.name = dim.name
+        self._dim = dim
+        self._size = size
+
+    def __len__(self):
+        return self._size
+
+    def isunlimited(self):
+        return self._dim.isunlimited()
+
+
+class VariableView:
+    """Read-only view of a window of a netCDF4 Variable. Reads are turned
+    into hyperslab reads of the underlying variable."""
+
+    def __init__(self, var, window):
+        self._var = var
+        self._window = {dim: window[dim] for dim in var.dimensions if dim in window}
+        self.shape = tuple(
+            len(np.arange(size)[self._window[dim]]) if dim in self._window else size
+            for dim, size in zip(var.dimensions, var.shape)
+        )
+
+    def __getattr__(self, name):
+        return getattr(self._var, name)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def offset(self, axis):
+        """Index in the file of the first index of the view along ``axis``,
+        or ``None`` if the window is not contiguous"""
+        dim = self._var.dimensions[axis]
+        if dim not in self._window:
+            return 0
+        selected = np.arange(self._var.shape[axis])[self._window[dim]]
+        if len(selected) and np.all(np.diff(selected) == 1):
+            return int(selected[0])
+        return None
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        ellipsis = [i for i, k in enumerate(key) if k is Ellipsis]
+        if ellipsis:
+            i = ellipsis[0]
+            key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1) + key[i + 1 :]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        return self._var[
+            tuple(
+                (
+                    _window_index(self._window[dim], k, size)
+                    if dim in self._window
+                    else k
+                )
+                for dim, size, k in zip(self._var.dimensions, self._var.shape, key)
+            )
+        ]
+
+
+class DatasetView:
+    """Read-only view of a window of a netCDF4 Dataset, given as a slice or
+    index array for some of its dimensions"""
+
+    def __init__(self, dataset, window):
+        self._dataset = dataset
+        self.dimensions = {
+            name: _DimensionView(
+                dim,
+                len(np.arange(len(dim))[window[name]]) if name in window else len(dim),
+            )
+            for name, dim in dataset.dimensions.items()
+        }
+        self.variables = {
+            name: VariableView(var, window) for name, var in dataset.variables.items()
+        }
+
+    def __getattr__(self, name):
+        return getattr(self._dataset, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._dataset.close()
+
+
+def open_dataset(path, window=None):
+    """Open ``path`` read-only, or a view of its ``window`` if given"""
+    dataset = Dataset(path)
+    return DatasetView(dataset, window) if window else dataset
+
+
+def find_time_variable(dataset, varname):
+    for dim in dataset.variables[varname].dimensions:
+        if dim in dataset.variables:
+            var = dataset.variables[dim]
+            if getattr(var, "axis", "") == "T" or dim == "time":
+                return var
+    raise ValueError(f"No time axis found for variable '{varname}'")
+
+
+def read_dates(dataset, varname):
+    """Return an (n, 3) array of the year, month and day of every timestep"""
+    time = find_time_variable(dataset, varname)
+    dates = num2date(
+        np.ma.getdata(time[:]),
+        time.units,
+        getattr(time, "calendar", "standard"),
+        only_use_cftime_datetimes=True,
+    )
+    dates = np.ma.getdata(dates).ravel()
+    return np.array([(d.year, d.month, d.day) for d in dates], dtype=int).reshape(-1, 3)
+
+
+def in_period(dates, start, end):
+    """Mask of the dates between ``start`` and ``end`` (inclusive)"""
+    keys = dates[:, 0] * 10000 + dates[:, 1] * 100 + dates[:, 2]
+    start_key = start.year * 10000 + start.month * 100 + start.day
+    end_key = end.year * 10000 + end.month * 100 + end.day
+    return (keys >= start_key) & (keys <= end_key)
+
+
+def read_block(var, rows, from_units=None, to_units=None, steps=slice(None)):
+    """Read rows of a (time, lat, lon) variable as a (time, cells) float array.
+
+    Missing values are returned as NaN.
+    """
+    block = var[steps, rows, :]
+    values = np.ma.filled(np.ma.asarray(block).astype(np.float64), np.nan)
+    if from_units and to_units:
+        values = units.convert(values, from_units, to_units)
+    return values.reshape(values.shape[0], -1)
+
+
+def row_blocks(nrows, row_size):
+    return [slice(r, min(r + row_size, nrows)) for r in range(0, nrows, row_size)]
+
+
+def chunk_layout(var, axis):
+    """Extent along ``axis`` of the chunks of ``var`` on disk and the index
+    in the file of its first index, or ``None`` if it is not chunked or is a
+    view of a window that is not contiguous"""
+    chunks = var.chunking()
+    if chunks in (None, "contiguous"):
+        # netCDF-3 files are not chunked
+        return None
+    offset = var.offset(axis) if isinstance(var, VariableView) else 0
+    if offset is None:
+        return None
+    return chunks[axis], offset
+
+
+def aligned_blocks(nrows, row_size, chunks=None):
+    """``row_blocks`` that end on the edges of the chunks given by
+    ``chunk_layout`` wherever a block spans at least one chunk"""
+    if not chunks or row_size < chunks[0]:
+        return row_blocks(nrows, row_size)
+    extent, offset = chunks
+    blocks, start = [], 0
+    while start < nrows:
+        stop = (offset + start + row_size) // extent * extent - offset
+        stop = min(nrows, stop if stop > start else start + row_size)
+        blocks.append(slice(start, stop))
+        start = stop
+    return blocks
+
+
+def chunking(var):
+    """Name of ``var`` for the logs and the shape of its chunks on disk, or
+    ``None`` if it is not chunked"""
+    try:
+        name = f"{var.name} of {os.path.basename(var.group().filepath())}"
+    except ValueError:
+        name = var.name
+    chunks = var.chunking()
+    return name, None if chunks in (None, "contiguous") else tuple(chunks)
+
+
+def log_plan(var_chunking, axis, blocks):
+    """Log how a variable with the given ``chunking`` is read in ``blocks``
+    along ``axis``, and warn if its chunks are decompressed again for every
+    block"""
+    if not blocks:
+        return
+    name, chunks = var_chunking
+    kind = "timesteps" if axis == 0 else "grid rows"
+    largest = max(block.stop - block.start for block in blocks)
+    if chunks is None:
+        logger.info(f"Reading {name} in blocks of up to {largest} {kind}")
+        return
+    logger.info(
+        f"Reading {name}, chunked {chunks}, in blocks of up to {largest} {kind}"
+    )
+    if chunks[axis] > largest:
+        logger.warning(
+            f"Chunks of {name} span {chunks[axis]} {kind}, so every chunk is "
+            f"decompressed about {math.ceil(chunks[axis] / largest)} times. A copy "
+            "chunked for this access reads faster."
+        )
+
+
+def time_blocks(var, time_size):
+    """Blocks of at most ``time_size`` timesteps of ``var``, aligned with its
+    chunks"""
+    blocks = aligned_blocks(var.shape[0], time_size, chunk_layout(var, 0))
+    log_plan(chunking(var), 0, blocks)
+    return blocks
+
+
+def prefetch(read, blocks, depth=PIPELINE_DEPTH):
+    """Yield ``(block, read(block))`` for every block, with up to ``depth``
+    blocks read ahead in a thread while the caller computes. The caller must
+    not use the NetCDF library without holding ``LOCK`` meanwhile."""
+    items = queue.Queue()
+    slots = threading.Semaphore(depth)
+    stop = threading.Event()
+
+    def reader():
+        try:
+            for block in blocks:
+                slots.acquire()
+                if stop.is_set():
+                    return
+                with LOCK:
+                    data = read(block)
+                items.put((block, data, None))
+        except Exception as e:
+            items.put((None, None, e))
+        else:
+            items.put(None)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is None:
+                return
+            block, data, error = item
+            if error:
+                raise error
+            slots.release()
+            yield block, data
+    finally:
+        stop.set()
+        slots.release()
+        thread.join()
+
+
+@contextmanager
+def write_behind(write, depth=PIPELINE_DEPTH):
+    """Yield a function that hands ``write(*args)`` to a thread, so up to
+    ``depth`` blocks are written while the next one is computed. Raises the
+    first error of the writes."""
+    items = queue.Queue()
+    slots = threading.Semaphore(depth)
+    errors = []
+
+    def writer():
+        while True:
+            args = items.get()
+            if args is None:
+                return
+            try:
+                if not errors:
+                    with LOCK:
+                        write(*args)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                slots.release()
+
+    def submit(*args):
+        slots.acquire()
+        if errors:
+            raise errors[0]
+        items.put(args)
+
+    thread = threading.Thread(target=writer, daemon=True)
+    thread.start()
+    try:
+        yield submit
+    finally:
+        items.put(None)
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def block_budget(max_gb, workers=1):
+    """Bytes of ``max_gb`` available to each of ``workers``"""
+    return max_gb * 2**30 / max(workers, 1)
+
+
+def rows_per_block(max_gb, bytes_per_cell, ncols, workers=1):
+    """Number of grid rows that fit in a worker's share of ``max_gb``"""
+    budget = block_budget(max_gb, workers)
+    return max(1, int(budget // (bytes_per_cell * ncols)))
+
+
+def create_output(template_file, output_file, varname, var_units=None, window=None):
+    """Create ``output_file`` with the dimensions, coordinates and attributes of
+    (the ``window`` of) ``template_file`` and an empty float32 ``varname``"""
+    with open_dataset(template_file, window) as template:
+        out = Dataset(output_file, "w", format="NETCDF4_CLASSIC")
+        out.setncatts({k: template.getncattr(k) for k in template.ncattrs()})
+        for name, dim in template.dimensions.items():
+            out.createDimension(name, None if dim.isunlimited() else len(dim))
+
+        for name, var in template.variables.items():
+            attrs = {k: var.getncattr(k) for k in var.ncattrs()}
+            fill_value = attrs.pop("_FillValue", None)
+            if name == varname:
+                fill_value = np.float32(1e20)
+                attrs.pop("missing_value", None)
+                if var_units:
+                    attrs["units"] = var_units
+                new = out.createVariable(
+                    name, np.float32, var.dimensions, fill_value=fill_value
+                )
+                new.setncatts(attrs)
+            else:
+                new = out.createVariable(
+                    name, var.dtype, var.dimensions, fill_value=fill_value
+                )
+                new.setncatts(attrs)
+                new[:] = var[:]
+    return out
+
+
+def _copy_variable(source, out, name):
+    var = source.variables[name]
+    attrs = {k: var.getncattr(k) for k in var.ncattrs()}
+    fill_value = attrs.pop("_FillValue", None)
+    new = out.createVariable(name, var.dtype, var.dimensions, fill_value=fill_value)
+    new.setncatts(attrs)
+    new[:] = var[:]
+
+
+def create_regridded_output(
+    time_file,
+    grid_file,
+    output_file,
+    varname,
+    grid_varname,
+    var_units=None,
+    time_window=None,
+    grid_window=None,
+):
+    """Create ``output_file`` with the time axis and attributes of
+    ``varname`` in ``time_file`` on the spatial grid of ``grid_varname`` in
+    ``grid_file``, with an empty float32 ``varname``. The windows select part
+    of either file."""
+    with (
+        open_dataset(time_file, time_window) as source,
+        open_dataset(grid_file, grid_window) as grid,
+    ):
+        time = find_time_variable(source, varname)
+        grid_dims = [
+            dim
+            for dim in grid.variables[grid_varname].dimensions
+            if dim != find_time_variable(grid, grid_varname).name
+        ]
+
+        out = Dataset(output_file, "w", format="NETCDF4_CLASSIC")
+        out.setncatts({k: source.getncattr(k) for k in source.ncattrs()})
+        out.createDimension(time.name, None)
+        time_vars = [time.name] + [
+            name
+            for name, var in source.variables.items()
+            if name != time.name
+            and var.dimensions
+            and var.dimensions[0] == time.name
+            and name != varname
+        ]
+        for name in time_vars:
+            for dim in source.variables[name].dimensions[1:]:
+                if dim not in out.dimensions:
+                    out.createDimension(dim, len(source.dimensions[dim]))
+            _copy_variable(source, out, name)
+
+        for dim in grid_dims:
+            out.createDimension(dim, len(grid.dimensions[dim]))
+            if dim in grid.variables:
+                _copy_variable(grid, out, dim)
+
+        attrs = {
+            k: source.variables[varname].getncattr(k)
+            for k in source.variables[varname].ncattrs()
+        }
+        for attr in ("_FillValue", "missing_value"):
+            attrs.pop(attr, None)
+        if var_units:
+            attrs["units"] = var_units
+        new = out.createVariable(
+            varname,
+            np.float32,
+            (time.name, *grid_dims),
+            fill_value=np.float32(1e20),
+        )
+        new.setncatts(attrs)
+    return out
+
+
+def chunk_shape(shape, itemsize, layout):
+    """Chunks of at most ``CHUNK_BYTES`` (or one grid or one cell series) for
+    a (time, lat, lon) variable"""
+    ntime, nlat, nlon = shape
+    if layout == "time_major":
+        steps = CHUNK_BYTES // (itemsize * nlat * nlon)
+        return (max(1, min(ntime, steps)), nlat, nlon)
+    cols = CHUNK_BYTES // (itemsize * max(ntime, 1))
+    return (max(ntime, 1), 1, max(1, min(nlon, cols)))
+
+
+def copy_dataset(source, output_file, layout="time_major", max_gb=1.0, window=None):
+    """Copy (the ``window`` of) the file or OPeNDAP URL ``source`` to
+    ``output_file``, chunking its (time, lat, lon) variables for ``layout``.
+    Values are copied as stored, without unpacking."""
+    with (
+        open_dataset(source, window) as src,
+        Dataset(output_file, "w", format="NETCDF4_CLASSIC") as out,
+    ):
+        src.set_auto_maskandscale(False)
+        out.setncatts({k: src.getncattr(k) for k in src.ncattrs()})
+        for name, dim in src.dimensions.items():
+            out.createDimension(name, None if dim.isunlimited() else len(dim))
+
+        for name, var in src.variables.items():
+            attrs = {k: var.getncattr(k) for k in var.ncattrs()}
+            fill_value = attrs.pop("_FillValue", None)
+            gridded = var.ndim == 3
+            chunks = None
+            if gridded:
+                chunks = chunk_shape(var.shape, var.dtype.itemsize, layout)
+            new = out.createVariable(
+                name,
+                var.dtype,
+                var.dimensions,
+                fill_value=fill_value,
+                chunksizes=chunks,
+            )
+            new.set_auto_maskandscale(False)
+            new.setncatts(attrs)
+            if not gridded:
+                new[:] = var[:]
+                continue
+
+            ntime, nlat, nlon = var.shape
+            if layout == "time_major":
+                size = rows_per_block(max_gb, var.dtype.itemsize, nlat * nlon)
+                for steps in time_blocks(var, size):
+                    new[steps] = var[steps]
+            else:
+                size = rows_per_block(max_gb, var.dtype.itemsize * ntime, nlon)
+                blocks = aligned_blocks(nlat, size, chunk_layout(var, 1))
+                log_plan(chunking(var), 1, blocks)
+                for rows in blocks:
+                    new[:, rows, :] = var[:, rows, :]
@@ -0,0 +1,94 @@
+"""Cache of the statistics the NumPy engines take from the observations.
+
+CI, CA and QDM only use the calibration period of the observations through
+a few derived arrays: the monthly climatologies (CI), the aggregate on the
+GCM grid (CA), the principal components and KD-trees of the analogue index
+(CA) and the empirical quantiles (QDM). These are kept in the
+``obs`` disk cache so that a job only reads the raw observations on a miss.
+
+Entries are keyed by the name of the statistic, ``VERSION``, the digest of
+the observations file, the calibration period and the parameters of the
+statistic. ``VERSION`` is part of every key so that changing how a
+statistic is computed retires the old entries.
+"""
+
+import os
+import pickle
+import numpy as np
+from tempfile import TemporaryDirectory
+
+from chickadee import cache
+
+
+VERSION = 2
+
+
+def get_cache():
+    return cache.get_cache("obs", "obs_cache_gb", 10)
+
+
+def make_key(name, obs_file, start_date, end_date, **params):
+    return cache.make_key(
+        "obs",
+        VERSION,
+        name,
+        cache.input_digest(obs_file),
+        start_date,
+        end_date,
+        params,
+    )
+
+
+def _load(key, build, save, read):
+    obs_cache = get_cache()
+    with TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "statistic")
+        if obs_cache.get(key, path):
+            return read(path)
+
+        value = build()
+        save(path, value)
+        obs_cache.put(key, path)
+    return value
+
+
+def _save_array(path, array):
+    with open(path, "wb") as f:
+        np.save(f, array)
+
+
+def _save_arrays(path, arrays):
+    with open(path, "wb") as f:
+        np.savez(f, **arrays)
+
+
+def _read_arrays(path):
+    with np.load(path) as arrays:
+        return dict(arrays)
+
+
+def _save_object(path, value):
+    with open(path, "wb") as f:
+        pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+
+
+def _read_object(path):
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def load(key, build):
+    """The array cached under ``key``, computed with ``build`` and cached on
+    a miss"""
+    return _load(key, build, _save_array, np.load)
+
+
+def load_arrays(key, build):
+    """``load`` for a dict of arrays"""
+    return _load(key, build, _save_arrays, _read_arrays)
+
+
+def load_object(key, build):
+    """``load`` for other objects, which are pickled. Only for objects the
+    service builds itself, the cache is private to the service user."""
+    return _load(key, build, _save_object, _read_object)
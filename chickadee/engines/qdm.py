@@ -0,0 +1,530 @@
+"""Quantile Delta Mapping (QDM) with NumPy.
+
+A vectorized port of ClimDown's ``qdm.netcdf.wrapper``: the bias correction
+is applied to a block of grid cells at once, with one column per cell. Only
+the cells with observations are corrected (see ``cells``). The grid is split
+into row blocks sized from ``max_gb`` by their valid cells, skipping rows
+without any, and the blocks are corrected in a pool of ``num_cores``
+processes.
+"""
+
+import os
+import numpy as np
+from functools import partial
+from tempfile import TemporaryDirectory
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+from chickadee.engines import netcdf, obs_cache, cells
+
+
+EPSILON = np.finfo(np.float64).eps
+RATIO_MAX = 2.0
+# ClimDown's qdm.tau for variables other than pr
+DEFAULT_TAU = 101
+
+
+def _interp(x, xp, fp):
+    """Linear interpolation along axis 0 for every column, like R's
+    ``approx(xp, fp, x, rule=2)``.
+
+    ``x`` is (n, cells), ``xp`` is (m, cells) and ascending in every column,
+    ``fp`` is (m,) or (m, cells). Values outside ``xp`` are clamped.
+    """
+    m = xp.shape[0]
+    lo = np.zeros(x.shape, dtype=np.intp)
+    hi = np.full(x.shape, m - 1, dtype=np.intp)
+    # Binary search on all columns at once
+    for _ in range(int(np.ceil(np.log2(max(m - 1, 1))))):
+        mid = (lo + hi) // 2
+        below = np.take_along_axis(xp, mid, axis=0) <= x
+        lo = np.where(below, mid, lo)
+        hi = np.where(below, hi, mid)
+
+    x0 = np.take_along_axis(xp, lo, axis=0)
+    x1 = np.take_along_axis(xp, hi, axis=0)
+    span = x1 - x0
+    weight = np.divide(x - x0, span, out=np.zeros_like(x), where=span > 0)
+    weight = np.clip(weight, 0, 1)
+
+    if fp.ndim == 1:
+        f0, f1 = fp[lo], fp[hi]
+    else:
+        f0 = np.take_along_axis(fp, lo, axis=0)
+        f1 = np.take_along_axis(fp, hi, axis=0)
+    return f0 + weight * (f1 - f0)
+
+
+def _interp_tau(t, fp):
+    """Interpolate ``fp`` (m, cells), given on ``m`` evenly spaced
+    probabilities from 0 to 1, at the probabilities ``t`` (n, cells)"""
+    m = fp.shape[0]
+    position = np.clip(t, 0, 1) * (m - 1)
+    lo = np.clip(np.floor(position).astype(np.intp), 0, max(m - 2, 0))
+    hi = np.minimum(lo + 1, m - 1)
+    weight = position - lo
+    f0 = np.take_along_axis(fp, lo, axis=0)
+    f1 = np.take_along_axis(fp, hi, axis=0)
+    return f0 + weight * (f1 - f0)
+
+
+def jitter(x, factor, rng):
+    """Add uniform noise to every column, following R's ``jitter(x, factor)``"""
+    r_min, r_max = x.min(axis=0), x.max(axis=0)
+    z = r_max - r_min
+    z = np.where(z == 0, np.abs(r_min), z)
+    z = np.where(z == 0, 1.0, z)
+
+    digits = 3 - np.floor(np.log10(z))
+    scale = 10.0**digits
+    rounded = np.sort(np.round(x * scale) / scale, axis=0)
+    diffs = np.diff(rounded, axis=0)
+    d = np.where(diffs > 0, diffs, np.inf).min(axis=0, initial=np.inf)
+    single = rounded[0]
+    d = np.where(np.isinf(d), np.where(single != 0, single / 10, z / 10), d)
+
+    amount = factor / 5 * np.abs(d)
+    return x + rng.uniform(-amount, amount, size=x.shape)
+
+
+def _prepare(a, ratio, trace, jitter_factor, rng):
+    """Jitter ``a`` and, for ratio variables, treat the values below trace as
+    left censored"""
+    if np.any(jitter_factor > 0):
+        a = jitter(a, jitter_factor, rng)
+    if ratio:
+        trace_calc = 0.5 * trace
+        a = a.copy()
+        censored = a < trace_calc
+        a[censored] = rng.uniform(EPSILON, trace_calc, size=censored.sum())
+    return a
+
+
+def _jitter_factors(jitter_factor, *arrays):
+    """Jitter factor of every column: ``jitter_factor``, or if it is 0 a tiny
+    one for the columns that are constant in any of ``arrays``, like ClimDown
+    decides for every cell on its own"""
+    if np.any(jitter_factor != 0):
+        return jitter_factor
+    constant = np.zeros(arrays[0].shape[1], bool)
+    for a in arrays:
+        constant |= a.min(axis=0) == a.max(axis=0)
+    return np.where(constant, np.sqrt(EPSILON), 0.0)
+
+
+def obs_quantiles(o_c, n_tau, ratio=False, trace=0.05, jitter_factor=0.0, rng=None):
+    """(n_tau, cells) empirical quantiles of the observed calibration values
+    ``o_c``, prepared the way ``quantile_delta_mapping`` prepares them"""
+    rng = rng or np.random.default_rng()
+    jitter_factor = _jitter_factors(jitter_factor, o_c)
+    o_c = _prepare(o_c, ratio, trace, jitter_factor, rng)
+    return np.quantile(o_c, np.linspace(0, 1, n_tau), axis=0)
+
+
+def quantile_delta_mapping(
+    o_c,
+    m_c,
+    m_p,
+    ratio=False,
+    trace=0.05,
+    jitter_factor=0.0,
+    n_tau=None,
+    rng=None,
+    quant_o_c=None,
+):
+    """Bias correct the projections ``m_p`` using the observed ``o_c`` and
+    modelled ``m_c`` calibration values.
+
+    All arrays have one column per grid cell. Columns must not contain NaN.
+    ``quant_o_c`` are the quantiles of ``o_c`` from ``obs_quantiles``, in
+    which case ``o_c`` is not used.
+    """
+    rng = rng or np.random.default_rng()
+    ratio_max_trace = 10 * trace
+
+    if quant_o_c is None:
+        jitter_factor = _jitter_factors(jitter_factor, o_c, m_c, m_p)
+        n_tau = n_tau or m_p.shape[0]
+        quant_o_c = obs_quantiles(o_c, n_tau, ratio, trace, jitter_factor, rng)
+    else:
+        jitter_factor = _jitter_factors(jitter_factor, m_c, m_p)
+        n_tau = quant_o_c.shape[0]
+    m_c, m_p = (_prepare(a, ratio, trace, jitter_factor, rng) for a in (m_c, m_p))
+
+    tau = np.linspace(0, 1, n_tau)
+    quant_m_c = np.quantile(m_c, tau, axis=0)
+    quant_m_p = np.quantile(m_p, tau, axis=0)
+
+    tau_m_p = _interp(m_p, quant_m_p, tau)
+    m_c_at = _interp_tau(tau_m_p, quant_m_c)
+    o_c_at = _interp_tau(tau_m_p, quant_o_c)
+
+    if ratio:
+        delta = m_p / m_c_at
+        delta[(delta > RATIO_MAX) & (m_c_at < ratio_max_trace)] = RATIO_MAX
+        mhat_p = o_c_at * delta
+        mhat_p[mhat_p < trace] = 0
+    else:
+        mhat_p = o_c_at + m_p - m_c_at
+    return mhat_p
+
+
+def qdm_groups(
+    obs_dates,
+    gcm_dates,
+    start_date,
+    end_date,
+    multiyear=True,
+    expand_multiyear=True,
+    multiyear_window_length=30,
+    seasonal=False,
+):
+    """Split the series into the groups QDM is applied to separately.
+
+    Returns the obs index of every season window and a list of ``(window,
+    calibration gcm index, target gcm index)``. Projections are split into
+    multi-year windows and, for seasonal variables, into months that are
+    calibrated on a sliding 3-month window.
+    """
+    obs_calib = netcdf.in_period(obs_dates, start_date, end_date)
+    gcm_calib = netcdf.in_period(gcm_dates, start_date, end_date)
+
+    years = gcm_dates[:, 0]
+    if multiyear:
+        bins = (years - years.min()) // multiyear_window_length
+        last = bins.max()
+        n_last_years = len(np.unique(years[bins == last]))
+        if expand_multiyear and last > 0 and n_last_years < multiyear_window_length:
+            bins[bins == last] = last - 1
+    else:
+        bins = np.zeros(len(years), dtype=int)
+
+    if seasonal:
+        seasons = [
+            (
+                np.isin(obs_dates[:, 1], window),
+                np.isin(gcm_dates[:, 1], window),
+                gcm_dates[:, 1] == month,
+            )
+            for month in range(1, 13)
+            for window in [[(month - 2) % 12 + 1, month, month % 12 + 1]]
+        ]
+    else:
+        everything = np.ones(len(obs_dates), bool), np.ones(len(gcm_dates), bool)
+        seasons = [everything + (np.ones(len(gcm_dates), bool),)]
+
+    windows, groups = [], []
+    for window, (obs_window, gcm_window, target_season) in enumerate(seasons):
+        o = np.flatnonzero(obs_calib & obs_window)
+        c = np.flatnonzero(gcm_calib & gcm_window)
+        windows.append(o)
+        for b in np.unique(bins):
+            p = np.flatnonzero((bins == b) & target_season)
+            if len(p) and len(o) and len(c):
+                groups.append((window, c, p))
+    return windows, groups
+
+
+def window_quantiles(obs, windows, params, rng=None):
+    """(windows, tau, cells) quantiles of the (time, cells) observations in
+    every season window, NaN for cells with missing observations"""
+    n_tau = params["n_tau"]
+    out = np.full((len(windows), n_tau, obs.shape[1]), np.nan)
+    valid = np.isfinite(obs).all(axis=0)
+    if not valid.any():
+        return out
+    for i, o in enumerate(windows):
+        if len(o):
+            out[i][:, valid] = obs_quantiles(
+                obs[o][:, valid],
+                n_tau,
+                params["ratio"],
+                params["trace"],
+                params["jitter_factor"],
+                rng,
+            )
+    return out
+
+
+def correct_cells(quantiles, gcm, groups, params, rng=None):
+    """Apply QDM to a (time, cells) block of GCM values, given the quantiles
+    of the observations in every season window"""
+    out = np.full(gcm.shape, np.nan)
+    used = sorted({window for window, _, _ in groups})
+    valid = np.isfinite(quantiles[used]).all(axis=(0, 1))
+    valid &= np.isfinite(gcm).all(axis=0)
+    if not valid.any():
+        return out
+
+    quantiles, gcm = quantiles[:, :, valid], gcm[:, valid]
+    # Timesteps no group corrects stay missing
+    corrected = np.full(gcm.shape, np.nan)
+    for window, c, p in groups:
+        corrected[p] = quantile_delta_mapping(
+            None, gcm[c], gcm[p], rng=rng, quant_o_c=quantiles[window], **params
+        )
+    out[:, valid] = corrected
+    return out
+
+
+def _variable_params(varname, options):
+    return {
+        "ratio": bool(options.get(f"{varname}_ratio", False)),
+        "trace": options["trace"],
+        "jitter_factor": options["jitter_factor"],
+        "n_tau": options.get(f"{varname}_tau") or DEFAULT_TAU,
+    }
+
+
+def _read(nc_file, window, varname, rows, block_cells, target_units, clip_negative):
+    """The valid ``block_cells`` of the grid ``rows``, packed"""
+    with netcdf.open_dataset(nc_file, window) as nc:
+        var = nc.variables[varname]
+        values = netcdf.read_block(var, rows, getattr(var, "units", None), target_units)
+    values = values[:, block_cells]
+    if clip_negative:
+        np.maximum(values, 0, out=values, where=np.isfinite(values))
+    return values
+
+
+def _read_inputs(
+    obs_file,
+    gcm_file,
+    obs_window,
+    gcm_window,
+    varname,
+    rows,
+    block_cells,
+    packed,
+    target_units,
+    clip_negative,
+    quantiles_file=None,
+):
+    """The GCM values of the valid ``block_cells`` of the grid ``rows``, which
+    are the ``packed`` range of all valid cells, and either their observed
+    quantiles from ``quantiles_file`` or the observed values"""
+    read_args = (varname, rows, block_cells, target_units, clip_negative)
+    gcm = _read(gcm_file, gcm_window, *read_args)
+    if quantiles_file:
+        quantiles = np.load(quantiles_file, mmap_mode="r")[:, :, packed]
+        return gcm, None, np.array(quantiles)
+    return gcm, _read(obs_file, obs_window, *read_args), None
+
+
+def _correct_inputs(rows, gcm, obs, quantiles, windows, groups, params):
+    """Correct the values read by ``_read_inputs``. The observed quantiles
+    are returned along with the packed corrected values if they were
+    computed."""
+    if quantiles is not None:
+        return rows, None, correct_cells(quantiles, gcm, groups, params)
+    quantiles = window_quantiles(obs, windows, params)
+    return rows, quantiles, correct_cells(quantiles, gcm, groups, params)
+
+
+def _correct_block(
+    obs_file,
+    gcm_file,
+    obs_window,
+    gcm_window,
+    varname,
+    rows,
+    block_cells,
+    packed,
+    windows,
+    groups,
+    params,
+    target_units,
+    clip_negative,
+    quantiles_file=None,
+):
+    """Read and correct one block in a worker process"""
+    gcm, obs, quantiles = _read_inputs(
+        obs_file,
+        gcm_file,
+        obs_window,
+        gcm_window,
+        varname,
+        rows,
+        block_cells,
+        packed,
+        target_units,
+        clip_negative,
+        quantiles_file,
+    )
+    return _correct_inputs(rows, gcm, obs, quantiles, windows, groups, params)
+
+
+def qdm_netcdf(
+    obs_file, gcm_file, output_file, varname, options, num_cores=1, subset=None
+):
+    """Bias correct ``varname`` in ``gcm_file`` against ``obs_file``.
+
+    ``options`` holds the values of the general and QDM options inputs by
+    identifier. Both files must be on the same grid, as for ClimDown. The
+    quantiles of the observations are taken from the obs cache when
+    possible, in which case the observations are not read. Only the
+    ``subset`` of the inputs is read and corrected if given, and only its
+    cells with observations.
+    """
+    calibration = (options["start_date"], options["end_date"])
+    obs_window = subset and subset.window(obs_file)
+    gcm_window = subset and subset.window(gcm_file, calibration)
+    with (
+        netcdf.open_dataset(obs_file, obs_window) as obs_nc,
+        netcdf.open_dataset(gcm_file, gcm_window) as gcm_nc,
+    ):
+        for nc, name in ((obs_nc, "observations"), (gcm_nc, "GCM")):
+            if varname not in nc.variables:
+                raise ValueError(f"Variable '{varname}' not found in {name} file")
+        obs_var, gcm_var = obs_nc.variables[varname], gcm_nc.variables[varname]
+        if obs_var.shape[1:] != gcm_var.shape[1:]:
+            raise ValueError("Observations and GCM must be on the same grid")
+        ncols = obs_var.shape[2]
+        obs_dates = netcdf.read_dates(obs_nc, varname)
+        gcm_dates = netcdf.read_dates(gcm_nc, varname)
+        gcm_units = getattr(gcm_var, "units", None)
+        # Blocks of rows are aligned with the chunks of the GCM, which is
+        # always read
+        gcm_chunks = netcdf.chunk_layout(gcm_var, 1)
+        chunkings = [netcdf.chunking(gcm_var), netcdf.chunking(obs_var)]
+        valid = cells.load_valid(
+            obs_file, obs_var, varname, options["max_gb"], subset and subset.bbox
+        )
+
+    target_units = None
+    if options["units_bool"]:
+        target_units = options.get(f"{varname}_units") or gcm_units
+
+    seasonal = bool(options.get(f"{varname}_seasonal", False))
+    windows, groups = qdm_groups(
+        obs_dates,
+        gcm_dates,
+        options["start_date"],
+        options["end_date"],
+        options["multiyear"],
+        options["expand_multiyear"],
+        options["multiyear_window_length"],
+        seasonal,
+    )
+    if not groups:
+        raise ValueError("No observations or GCM values in the calibration period")
+    params = _variable_params(varname, options)
+    clip_negative = varname == "pr" and options["n_pr_bool"]
+
+    # obs and gcm values, their quantiles and about six working copies of the
+    # projections for every valid cell, the values read ahead and the results
+    # written behind, and the whole rows they are read from
+    bytes_per_cell = 8 * (
+        2 * len(obs_dates) + 9 * len(gcm_dates) + 2 * len(windows) * params["n_tau"]
+    )
+    bytes_per_read = 8 * (len(obs_dates) + len(gcm_dates))
+    blocks = cells.row_blocks(
+        valid,
+        netcdf.block_budget(options["max_gb"], num_cores),
+        bytes_per_cell,
+        bytes_per_read,
+        gcm_chunks,
+    )
+    offsets = cells.row_offsets(valid)
+
+    key = obs_cache.make_key(
+        "quantiles",
+        obs_file,
+        options["start_date"],
+        options["end_date"],
+        varname=varname,
+        units=target_units,
+        seasonal=seasonal,
+        clip_negative=clip_negative,
+        bbox=subset and subset.bbox,
+        **params,
+    )
+    with TemporaryDirectory() as tmp:
+        quantiles_file = os.path.join(tmp, "quantiles.npy")
+        quantiles_cache = obs_cache.get_cache()
+        cached = quantiles_cache.get(key, quantiles_file)
+        # The observations are not read with cached quantiles
+        for var_chunking in chunkings[: 1 if cached else 2]:
+            netcdf.log_plan(var_chunking, 1, blocks)
+        if not cached:
+            quantiles = np.lib.format.open_memmap(
+                quantiles_file,
+                mode="w+",
+                shape=(len(windows), params["n_tau"], int(offsets[-1])),
+            )
+
+        out = netcdf.create_output(
+            gcm_file, output_file, varname, target_units, gcm_window
+        )
+
+        def write(rows, block_quantiles, values):
+            values = cells.scatter(values, valid[rows])
+            out.variables[varname][:, rows, :] = _to_grid(values, ncols)
+            if not cached:
+                quantiles[:, :, offsets[rows.start] : offsets[rows.stop]] = (
+                    block_quantiles
+                )
+
+        try:
+            block_args = [
+                (
+                    rows,
+                    valid[rows].ravel(),
+                    slice(offsets[rows.start], offsets[rows.stop]),
+                )
+                for rows in blocks
+            ]
+            tasks = [
+                (
+                    obs_file,
+                    gcm_file,
+                    obs_window,
+                    gcm_window,
+                    varname,
+                    *args,
+                    windows,
+                    groups,
+                    params,
+                    target_units,
+                    clip_negative,
+                    cached,
+                )
+                for args in block_args
+            ]
+            with netcdf.write_behind(write) as submit:
+                if num_cores > 1 and len(blocks) > 1:
+                    executor = ProcessPoolExecutor(
+                        num_cores, mp_context=get_context("spawn")
+                    )
+                    with executor:
+                        for result in executor.map(_correct_block, *zip(*tasks)):
+                            submit(*result)
+                else:
+                    # Read the next block and write the last one while this
+                    # one is corrected
+                    read = partial(
+                        _read_inputs,
+                        obs_file,
+                        gcm_file,
+                        obs_window,
+                        gcm_window,
+                        varname,
+                        target_units=target_units,
+                        clip_negative=clip_negative,
+                        quantiles_file=cached,
+                    )
+                    for (rows, *_), inputs in netcdf.prefetch(
+                        lambda args: read(*args), block_args
+                    ):
+                        submit(*_correct_inputs(rows, *inputs, windows, groups, params))
+        finally:
+            out.close()
+
+        if not cached:
+            quantiles.flush()
+            del quantiles
+            quantiles_cache.put(key, quantiles_file)
+
+
+def _to_grid(values, ncols):
+    return np.ma.masked_invalid(values.reshape(values.shape[0], -1, ncols))
@@ -0,0 +1,122 @@
+"""Bilinear regridding of GCM fields to the observation grid.
+
+The interpolation from a (GCM grid, obs grid) pair is a fixed linear
+operator, so it is built once as a sparse (obs cells, gcm cells) matrix and
+kept in a disk cache. Regridding a block of timesteps is then one sparse
+matrix product.
+"""
+
+import os
+import numpy as np
+from scipy import sparse
+from tempfile import TemporaryDirectory
+
+from chickadee import cache
+
+
+def _lon_frame(lon, base):
+    return (np.asarray(lon, dtype=np.float64) - base) % 360 + base
+
+
+def _align_lons(src_lon, dst_lon):
+    """Express both longitude axes in the frame (-180 to 180 or 0 to 360) in
+    which ``src_lon`` is contiguous"""
+
+    def largest_gap(base):
+        ordered = np.sort(_lon_frame(src_lon, base))
+        return np.diff(ordered).max() if len(ordered) > 1 else 0
+
+    base = min((-180, 0), key=largest_gap)
+    return _lon_frame(src_lon, base), _lon_frame(dst_lon, base)
+
+
+def _is_global(lon):
+    ordered = np.sort(lon)
+    if len(ordered) < 2:
+        return False
+    step = np.median(np.diff(ordered))
+    return ordered[-1] - ordered[0] + step >= 360 - step / 2
+
+
+def axis_weights(src, dst, periodic=False):
+    """Indices of the two ``src`` points around every ``dst`` point and the
+    weight of the second one.
+
+    Points outside ``src`` take the value of the nearest edge, or wrap around
+    for a ``periodic`` axis.
+    """
+    src = np.asarray(src, dtype=np.float64)
+    dst = np.asarray(dst, dtype=np.float64)
+    if len(src) == 1:
+        zeros = np.zeros(len(dst), dtype=int)
+        return zeros, zeros, np.zeros(len(dst))
+
+    order = np.argsort(src)
+    ordered = src[order]
+    if periodic:
+        ordered = np.append(ordered, ordered[0] + 360)
+        order = np.append(order, order[0])
+        dst = (dst - ordered[0]) % 360 + ordered[0]
+    else:
+        dst = np.clip(dst, ordered[0], ordered[-1])
+
+    upper = np.clip(np.searchsorted(ordered, dst, side="right"), 1, len(ordered) - 1)
+    lower = upper - 1
+    span = ordered[upper] - ordered[lower]
+    weight = np.divide(
+        dst - ordered[lower], span, out=np.zeros_like(dst), where=span > 0
+    )
+    return order[lower], order[upper], weight
+
+
+def bilinear_weights(src_lat, src_lon, dst_lat, dst_lon):
+    """Sparse (dst cells, src cells) bilinear interpolation matrix between two
+    rectilinear grids with cells ordered lat-major"""
+    src_lon, dst_lon = _align_lons(src_lon, dst_lon)
+    lat0, lat1, wlat = axis_weights(src_lat, dst_lat)
+    lon0, lon1, wlon = axis_weights(src_lon, dst_lon, periodic=_is_global(src_lon))
+
+    nlon = len(src_lon)
+    rows, cols, values = [], [], []
+    dst_cells = np.arange(len(dst_lat) * len(dst_lon)).reshape(
+        len(dst_lat), len(dst_lon)
+    )
+    for lat_index, lat_weight in ((lat0, 1 - wlat), (lat1, wlat)):
+        for lon_index, lon_weight in ((lon0, 1 - wlon), (lon1, wlon)):
+            rows.append(dst_cells.ravel())
+            cols.append((lat_index[:, None] * nlon + lon_index[None, :]).ravel())
+            values.append((lat_weight[:, None] * lon_weight[None, :]).ravel())
+
+    # Duplicate entries (on the source points themselves) are summed
+    return sparse.csr_matrix(
+        (np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(dst_cells.size, len(src_lat) * nlon),
+    )
+
+
+def get_weights(src_lat, src_lon, dst_lat, dst_lon):
+    """Bilinear weights between two grids from the regrid cache, building and
+    caching them on a miss"""
+    regrid_cache = cache.get_cache("regrid_weights", "regrid_cache_gb", 1)
+    key = cache.make_key(
+        "bilinear",
+        *(cache.array_digest(axis) for axis in (src_lat, src_lon, dst_lat, dst_lon)),
+    )
+    with TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "weights.npz")
+        if regrid_cache.get(key, path):
+            return sparse.load_npz(path)
+
+        weights = bilinear_weights(src_lat, src_lon, dst_lat, dst_lon)
+        sparse.save_npz(path, weights)
+        regrid_cache.put(key, path)
+    return weights
+
+
+def regrid(values, weights):
+    """Regrid a (time, src cells) block, ignoring missing source values"""
+    valid = np.isfinite(values)
+    total = weights @ np.where(valid, values, 0).T
+    coverage = weights @ valid.T.astype(np.float64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(coverage > 0, total / coverage, np.nan).T
@@ -0,0 +1,151 @@
+"""Spatial and temporal subsets of the inputs.
+
+A ``Subset`` holds the ``bbox`` and ``time_range`` inputs of a request. For
+every file it is turned into a window of index ranges along the latitude,
+longitude and time dimensions, and the engines open the file as a view of
+that window (``netcdf.open_dataset``), so only the hyperslabs inside it are
+ever read.
+
+Grids keep one cell beyond the box on every side, so that the CA aggregation
+and the CI interpolation have the neighbours of the edge cells. The time
+range only applies to the GCM: the calibration period is always kept, since
+every step calibrates the GCM against the observations over it.
+"""
+
+import numpy as np
+from datetime import date
+from netCDF4 import Dataset
+
+from chickadee.engines import netcdf
+
+
+def parse_bbox(text):
+    """``west,south,east,north`` in degrees"""
+    try:
+        west, south, east, north = (float(v) for v in text.split(","))
+    except ValueError:
+        raise ValueError(
+            f"Invalid bbox '{text}', expected west,south,east,north in degrees"
+        )
+    if south > north:
+        raise ValueError(f"Invalid bbox '{text}', south is above north")
+    return west, south, east, north
+
+
+def parse_time_range(text):
+    """``YYYY-MM-DD/YYYY-MM-DD``, both ends inclusive"""
+    try:
+        start, end = (date.fromisoformat(v.strip()) for v in text.split("/"))
+    except ValueError:
+        raise ValueError(f"Invalid time_range '{text}', expected YYYY-MM-DD/YYYY-MM-DD")
+    if start > end:
+        raise ValueError(f"Invalid time_range '{text}', start is after end")
+    return start, end
+
+
+def _axis(var):
+    axis = getattr(var, "axis", "").upper()
+    standard_name = getattr(var, "standard_name", "")
+    units = getattr(var, "units", "")
+    if axis == "Y" or standard_name == "latitude" or units == "degrees_north":
+        return "lat"
+    if axis == "X" or standard_name == "longitude" or units == "degrees_east":
+        return "lon"
+    if axis == "T" or standard_name == "time" or var.name == "time":
+        return "time"
+    return {"lat": "lat", "latitude": "lat", "lon": "lon", "longitude": "lon"}.get(
+        var.name
+    )
+
+
+def coordinate(nc, axis):
+    """Name of the ``"lat"``, ``"lon"`` or ``"time"`` coordinate variable of
+    ``nc``"""
+    for name, var in nc.variables.items():
+        if var.dimensions == (name,) and _axis(var) == axis:
+            return name
+    raise ValueError(f"No {axis} coordinate found")
+
+
+def _spacing(values):
+    return np.median(np.abs(np.diff(values))) if len(values) > 1 else 0.0
+
+
+def _as_index(mask, name):
+    selected = np.flatnonzero(mask)
+    if not len(selected):
+        raise ValueError(f"The subset does not intersect the {name} axis")
+    if np.all(np.diff(selected) == 1):
+        return slice(int(selected[0]), int(selected[-1]) + 1)
+    return selected
+
+
+def lat_index(lat, south, north):
+    lat = np.asarray(lat, dtype=np.float64)
+    margin = _spacing(lat)
+    return _as_index((lat >= south - margin) & (lat <= north + margin), "latitude")
+
+
+def lon_index(lon, west, east):
+    """Longitudes inside ``west`` to ``east`` in any frame, including boxes
+    across the antimeridian"""
+    lon = np.asarray(lon, dtype=np.float64)
+    margin = _spacing(np.sort(lon % 360))
+    width = 360 if east - west >= 360 else (east - west) % 360
+    offset = (lon - west) % 360
+    return _as_index((offset <= width + margin) | (offset >= 360 - margin), "longitude")
+
+
+class Subset:
+    def __init__(self, bbox=None, time_range=None):
+        self.bbox = bbox
+        self.time_range = time_range
+
+    @classmethod
+    def from_inputs(cls, bbox=None, time_range=None):
+        """The subset given by the ``bbox`` and ``time_range`` inputs, or
+        ``None`` if neither is given"""
+        if not bbox and not time_range:
+            return None
+        return cls(
+            parse_bbox(bbox) if bbox else None,
+            parse_time_range(time_range) if time_range else None,
+        )
+
+    def key(self):
+        return {"bbox": self.bbox, "time_range": self.time_range}
+
+    def window(self, path, calibration=None):
+        """Window of ``path`` in the subset. The time range is only applied
+        with the ``(start, end)`` of the ``calibration`` period to keep, i.e.
+        to GCM files."""
+        window = {}
+        with Dataset(path) as nc:
+            for name, var in nc.variables.items():
+                if var.dimensions != (name,):
+                    continue
+                axis = _axis(var)
+                if axis == "lat" and self.bbox:
+                    window[name] = lat_index(var[:], self.bbox[1], self.bbox[3])
+                elif axis == "lon" and self.bbox:
+                    window[name] = lon_index(var[:], self.bbox[0], self.bbox[2])
+                elif axis == "time" and self.time_range and calibration:
+                    dates = netcdf.read_dates(nc, name)
+                    keep = netcdf.in_period(dates, *self.time_range)
+                    keep |= netcdf.in_period(dates, *calibration)
+                    window[name] = _as_index(keep, "time")
+        return window
+
+
+def write_subset(subset, path, output_file, calibration=None):
+    """Write the subset of ``path`` to ``output_file`` for steps that can
+    only read whole files, returning the file to read.
+
+    Tiles of the ClimDown engine write their subsets from threads of the
+    service, so the NetCDF library is only used while holding ``netcdf.LOCK``.
+    """
+    if not subset:
+        return path
+    with netcdf.LOCK:
+        netcdf.copy_dataset(path, output_file, window=subset.window(path, calibration))
+    return output_file
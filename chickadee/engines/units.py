@@ -0,0 +1,68 @@
+import numpy as np
+
+
+# Units are converted through a base unit per quantity:
+# value_in_base = value * scale + offset
+_UNITS = {
+    "temperature": {
+        "k": (1.0, 0.0),
+        "kelvin": (1.0, 0.0),
+        "degk": (1.0, 0.0),
+        "deg_k": (1.0, 0.0),
+        "degc": (1.0, 273.15),
+        "deg_c": (1.0, 273.15),
+        "celsius": (1.0, 273.15),
+        "degrees_c": (1.0, 273.15),
+        "degf": (5 / 9, 273.15 - 32 * 5 / 9),
+        "fahrenheit": (5 / 9, 273.15 - 32 * 5 / 9),
+        "farenheit": (5 / 9, 273.15 - 32 * 5 / 9),
+    },
+    "precipitation": {
+        "kg m-2 s-1": (1.0, 0.0),
+        "kg/m2/s": (1.0, 0.0),
+        "mm s-1": (1.0, 0.0),
+        "mm/s": (1.0, 0.0),
+        "kg m-2 d-1": (1 / 86400, 0.0),
+        "kg m-2 day-1": (1 / 86400, 0.0),
+        "kg/m2/d": (1 / 86400, 0.0),
+        "mm d-1": (1 / 86400, 0.0),
+        "mm day-1": (1 / 86400, 0.0),
+        "mm/d": (1 / 86400, 0.0),
+        "mm/day": (1 / 86400, 0.0),
+        "mm": (1 / 86400, 0.0),
+    },
+}
+
+
+def _lookup(units):
+    key = " ".join(str(units).lower().split())
+    for quantity, table in _UNITS.items():
+        if key in table:
+            return quantity, table[key]
+    raise ValueError(f"Unknown units '{units}'")
+
+
+def quantity(units):
+    """The quantity ``units`` measure, or ``None`` if they are not known"""
+    try:
+        return _lookup(units)[0]
+    except ValueError:
+        return None
+
+
+def compatible(from_units, to_units):
+    try:
+        return _lookup(from_units)[0] == _lookup(to_units)[0]
+    except ValueError:
+        return False
+
+
+def convert(values, from_units, to_units):
+    """Convert an array of values between two known units"""
+    from_quantity, (from_scale, from_offset) = _lookup(from_units)
+    to_quantity, (to_scale, to_offset) = _lookup(to_units)
+    if from_quantity != to_quantity:
+        raise ValueError(f"Cannot convert units '{from_units}' to '{to_units}'")
+    if (from_scale, from_offset) == (to_scale, to_offset):
+        return values
+    return (np.asarray(values) * from_scale + from_offset - to_offset) / to_scale
@@ -0,0 +1,16 @@
+"""Gunicorn hooks of the service.
+
+Use with ``gunicorn --config python:chickadee.gunicorn_conf
+chickadee.wsgi:application``. Every gunicorn worker keeps its own pool of R
+workers, started once the worker has loaded the configuration.
+"""
+
+from chickadee import r_pool
+
+
+def post_worker_init(worker):
+    r_pool.start_pool()
+
+
+def worker_exit(server, worker):
+    r_pool.stop_pool()
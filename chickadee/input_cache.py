@@ -0,0 +1,152 @@
+"""Disk cache of remote inputs.
+
+GCM and observations files given as HTTP URLs or OPeNDAP endpoints are
+downloaded into the ``inputs`` disk cache and reused by later jobs. Entries
+are keyed by the URL and a validator of its current contents: the ETag or
+Last-Modified header of an HTTP file, or the digest of the DDS and DAS of an
+OPeNDAP dataset. Inputs without a validator are downloaded for the job only.
+Like pywps does for the inputs it downloads, inputs larger than
+``maxsingleinputsize`` are refused.
+
+Jobs that need the same missing entry wait for the first one to download it.
+"""
+
+import os
+import hashlib
+from netCDF4 import Dataset
+from urllib.parse import urlparse, urlsplit, urlunsplit
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+from pywps import configuration, FORMATS
+from pywps.exceptions import FileSizeExceeded
+
+import chickadee.utils as util
+from chickadee import cache
+from chickadee.engines import netcdf
+
+
+TIMEOUT = 60
+
+
+def get_input_cache():
+    return cache.get_cache("inputs", "input_cache_gb", 50)
+
+
+def is_enabled():
+    return (
+        float(configuration.get_config_value("chickadee", "input_cache_gb") or 50) > 0
+    )
+
+
+def is_remote(url):
+    return urlparse(url).scheme in ("http", "https")
+
+
+def is_opendap(input_):
+    data_format = getattr(input_, "data_format", None)
+    if data_format is not None and data_format.mime_type == FORMATS.DODS.mime_type:
+        return True
+    return "/dodsC/" in input_.url
+
+
+def http_validator(url):
+    """ETag or Last-Modified (with the length) of ``url``, or ``None``"""
+    try:
+        with urlopen(Request(url, method="HEAD"), timeout=TIMEOUT) as response:
+            headers = response.headers
+    except HTTPError as e:
+        # Some servers refuse HEAD requests but serve the file
+        util.logger.info(f"HEAD request for {url} failed ({e.code} {e.reason})")
+        return None
+    if headers.get("ETag"):
+        return f"etag:{headers['ETag']}"
+    if headers.get("Last-Modified"):
+        return f"modified:{headers['Last-Modified']}:{headers.get('Content-Length')}"
+    return None
+
+
+def dap_url(url, suffix):
+    """``url`` with ``suffix`` appended to its path, keeping its constraint
+    expression and fragment"""
+    parts = urlsplit(url)
+    return urlunsplit(parts._replace(path=parts.path + suffix))
+
+
+def dap_validator(url):
+    """Digest of the DDS and DAS of the OPeNDAP dataset at ``url``"""
+    digest = hashlib.sha256()
+    for suffix in (".dds", ".das"):
+        with urlopen(dap_url(url, suffix), timeout=TIMEOUT) as response:
+            digest.update(response.read())
+    return f"dap:{digest.hexdigest()}"
+
+
+def get_max_bytes():
+    """``maxsingleinputsize`` in bytes, or 0 for no limit"""
+    max_size = configuration.get_config_value("server", "maxsingleinputsize")
+    return int(configuration.get_size_mb(max_size) * 1024**2) if max_size else 0
+
+
+def check_size(url, size, max_bytes):
+    if max_bytes and size > max_bytes:
+        raise FileSizeExceeded(
+            f"Input {url} exceeds the maximum input size of {max_bytes} bytes"
+        )
+
+
+def download(url, dest):
+    tmp = f"{dest}.part"
+    max_bytes = get_max_bytes()
+    try:
+        with urlopen(url, timeout=TIMEOUT) as response, open(tmp, "wb") as f:
+            check_size(url, int(response.headers.get("Content-Length") or 0), max_bytes)
+            size = 0
+            # The length may be missing or wrong, so count the bytes as well
+            while chunk := response.read(cache.CHUNK_SIZE):
+                size += len(chunk)
+                check_size(url, size, max_bytes)
+                f.write(chunk)
+        os.replace(tmp, dest)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def download_dap(url, dest):
+    tmp = f"{dest}.part"
+    # The DDS declares the size of every variable
+    with Dataset(url) as nc:
+        size = sum(
+            var.size * getattr(var.dtype, "itemsize", 0)
+            for var in nc.variables.values()
+        )
+    check_size(url, size, get_max_bytes())
+    try:
+        netcdf.copy_dataset(url, tmp)
+        os.replace(tmp, dest)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def fetch(url, dest, opendap=False):
+    """Place the remote input ``url`` at ``dest``, from the input cache when
+    its validator still matches"""
+    validator = dap_validator(url) if opendap else http_validator(url)
+    fill = download_dap if opendap else download
+    if validator is None:
+        util.logger.info(f"No validator for {url}, downloading it for this job")
+        fill(url, dest)
+        return dest
+
+    input_cache = get_input_cache()
+    key = cache.make_key("input", url, validator)
+    if input_cache.get(key, dest):
+        return dest
+    with input_cache.fill_lock(key):
+        # Another job may have downloaded it while we waited
+        if input_cache.get(key, dest):
+            return dest
+        fill(url, dest)
+        input_cache.put(key, dest, link=True)
+    return dest
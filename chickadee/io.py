@@ -15,12 +15,21 @@ gcm_file = ComplexInput(
 obs_file = ComplexInput(
     "obs_file",
     "Observations NetCDF file",
-    abstract="Filename of high-res gridded historical observations",
-    min_occurs=1,
+    abstract="Filename of high-res gridded historical observations (or give obs_id)",
+    min_occurs=0,
     max_occurs=1,
     supported_formats=[FORMATS.NETCDF, FORMATS.DODS],
 )
 
+obs_id = LiteralInput(
+    "obs_id",
+    "Registered Observations",
+    abstract="ID of observations added with 'chickadee obs ingest', used instead of an obs_file",
+    min_occurs=0,
+    max_occurs=1,
+    data_type="string",
+)
+
 varname = LiteralInput(
     "varname",
     "Variable to Downscale",
@@ -42,12 +51,57 @@ out_file = LiteralInput(
 num_cores = LiteralInput(
     "num_cores",
     "Number of Cores",
-    abstract="The number of cores to use for parallel execution",
-    default=4,
-    allowed_values=[1, 2, 3, 4],
+    abstract="The number of cores to use for parallel execution, or auto for the cores no other job is using. Requests are limited to the free cores of the server.",
+    default="auto",
+    data_type="string",
+)
+
+engine = LiteralInput(
+    "engine",
+    "Engine",
+    abstract="Implementation to run the step with: ClimDown in R or the native NumPy engine",
+    default="climdown",
+    allowed_values=["climdown", "numpy"],
+    data_type="string",
+)
+
+num_tiles = LiteralInput(
+    "num_tiles",
+    "Number of Tiles",
+    abstract="Split the observations grid into this many bands of rows, which are downscaled in separate processes and stitched together (1 disables tiling)",
+    default=1,
     data_type="positiveInteger",
 )
 
+analogue_search = LiteralInput(
+    "analogue_search",
+    "Analogue Search",
+    abstract="Compare every GCM timestep with all candidate days (exact) or look them up in an approximate nearest-neighbour index (index, implies the numpy engine)",
+    default="exact",
+    allowed_values=["exact", "index"],
+    data_type="string",
+)
+
+
+subset_input = [
+    LiteralInput(
+        "bbox",
+        "Bounding Box",
+        abstract="Only downscale the region west,south,east,north in degrees (e.g. '-123.5,48.5,-122.5,49.5')",
+        min_occurs=0,
+        max_occurs=1,
+        data_type="string",
+    ),
+    LiteralInput(
+        "time_range",
+        "Time Range",
+        abstract="Only downscale the GCM timesteps from start to end as YYYY-MM-DD/YYYY-MM-DD, in addition to the calibration period",
+        min_occurs=0,
+        max_occurs=1,
+        data_type="string",
+    ),
+]
+
 
 general_options_input = [
     LiteralInput(
@@ -0,0 +1,41 @@
+"""Reservations shared by the processes of the service.
+
+pywps runs asynchronous requests in forked processes, so state about the
+running jobs is kept in a JSON file in the runtime directory, locked with
+``flock`` while it is read and updated. Every entry records the process that
+made it, and entries of processes that died are dropped.
+"""
+
+import os
+import json
+import fcntl
+import psutil
+from contextlib import contextmanager
+
+import chickadee.utils as util
+
+
+@contextmanager
+def open_ledger(name):
+    """Yield the entries of ledger ``name`` to read and update, and save
+    them"""
+    path = os.path.join(util.get_runtime_dir(), f"{name}.json")
+    with open(path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            try:
+                with open(path) as f:
+                    ledger = json.load(f)
+            except (OSError, ValueError):
+                ledger = {}
+            ledger = {
+                token: entry
+                for token, entry in ledger.items()
+                if psutil.pid_exists(entry["pid"])
+            }
+            yield ledger
+            with open(path + ".tmp", "w") as f:
+                json.dump(ledger, f)
+            os.replace(path + ".tmp", path)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
@@ -0,0 +1,140 @@
+"""Registry of observation datasets that processes reference by ID.
+
+An observations file is ingested once with ``chickadee obs ingest``. It is
+rewritten twice in ``obs_registry_dir/<id>``, with the gridded variables
+chunked for the two ways the steps read it:
+
+- ``time_major.nc``: chunks of whole grids for a few timesteps, for the
+  steps that sweep over time (CI)
+- ``cell_major.nc``: chunks of a few cells for the whole series, for the
+  steps that read blocks of grid rows (CA, QDM and Rerank)
+
+Processes then take the ``obs_id`` of an entry instead of an uploaded
+``obs_file`` and read it in place. The digest of the original file is
+recorded at ingest, so the disk caches keyed by the observations do not hash
+the files again.
+"""
+
+import os
+import re
+import json
+import shutil
+from datetime import datetime, timezone
+from netCDF4 import Dataset
+from pywps import configuration
+
+import chickadee.utils as util
+from chickadee import cache
+from chickadee.engines import netcdf
+
+
+LAYOUTS = netcdf.LAYOUTS
+ENTRY_FILE = "entry.json"
+
+_ID_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.-]*$")
+
+
+def get_registry_dir():
+    registry_dir = configuration.get_config_value(
+        "chickadee", "obs_registry_dir"
+    ) or util.get_runtime_dir("obs_registry")
+    os.makedirs(registry_dir, exist_ok=True)
+    return registry_dir
+
+
+def _entry_dir(obs_id):
+    if not obs_id or not _ID_PATTERN.match(obs_id):
+        raise ValueError(f"Invalid observations ID '{obs_id}'")
+    return os.path.join(get_registry_dir(), obs_id)
+
+
+def _is_gridded(var):
+    return var.ndim == 3
+
+
+def ingest(source, obs_id=None, max_gb=1.0):
+    """Add the observations file ``source`` to the registry and return its
+    entry. The ID defaults to the file name and the start of its digest."""
+    digest = cache.file_digest(source)
+    if not obs_id:
+        stem = os.path.splitext(os.path.basename(source))[0]
+        obs_id = f"{re.sub(r'[^A-Za-z0-9_.-]', '_', stem)}-{digest[:8]}"
+    entry_dir = _entry_dir(obs_id)
+    if os.path.exists(entry_dir):
+        raise ValueError(f"Observations '{obs_id}' are already registered")
+
+    tmp_dir = f"{entry_dir}.{os.getpid()}.tmp"
+    os.makedirs(tmp_dir)
+    try:
+        for layout in LAYOUTS:
+            netcdf.copy_dataset(
+                source, os.path.join(tmp_dir, f"{layout}.nc"), layout, max_gb
+            )
+        with Dataset(source) as nc:
+            variables = {
+                name: list(var.shape)
+                for name, var in nc.variables.items()
+                if _is_gridded(var)
+            }
+        entry = {
+            "id": obs_id,
+            "source": os.path.abspath(source),
+            "digest": digest,
+            "variables": variables,
+            "created": datetime.now(timezone.utc).isoformat(),
+        }
+        with open(os.path.join(tmp_dir, ENTRY_FILE), "w") as f:
+            json.dump(entry, f, indent=2)
+        os.rename(tmp_dir, entry_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return entry
+
+
+def get_entry(obs_id):
+    path = os.path.join(_entry_dir(obs_id), ENTRY_FILE)
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        raise ValueError(f"No registered observations with ID '{obs_id}'")
+
+
+def list_entries():
+    registry_dir = get_registry_dir()
+    entries = []
+    for name in sorted(os.listdir(registry_dir)):
+        if name.endswith(".tmp"):
+            continue
+        path = os.path.join(registry_dir, name, ENTRY_FILE)
+        if os.path.exists(path):
+            with open(path) as f:
+                entries.append(json.load(f))
+    return entries
+
+
+def remove(obs_id):
+    entry = get_entry(obs_id)
+    shutil.rmtree(_entry_dir(obs_id))
+    return entry
+
+
+def resolve(obs_id, layout):
+    """Path of the ``layout`` file of the registered observations ``obs_id``"""
+    if layout not in LAYOUTS:
+        raise ValueError(f"Unknown layout '{layout}'")
+    entry = get_entry(obs_id)
+    path = os.path.join(_entry_dir(obs_id), f"{layout}.nc")
+    cache.remember_digest(path, entry["digest"])
+    return path
+
+
+def get_obs_file(obs_file, obs_id, layout):
+    """The observations file of a request, which gives either an uploaded
+    ``obs_file`` or the ``obs_id`` of registered observations"""
+    if obs_id:
+        return resolve(obs_id, layout)
+    if not obs_file:
+        raise ValueError("Either obs_file or obs_id is required")
+    return obs_file
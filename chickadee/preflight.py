@@ -0,0 +1,113 @@
+"""Checks of the inputs of a request before any step runs.
+
+Mistakes in a request, such as a variable missing from one of the files,
+units ClimDown cannot convert or a calibration period the observations do
+not cover, otherwise only fail deep inside the steps, often after minutes of
+R and worker start-up. ``check`` finds them from the headers and coordinate
+variables of the inputs, which takes milliseconds, so the request is
+rejected before anything is started.
+
+Only definite problems are rejected. Units that are not in the table of
+``chickadee.engines.units`` are left to ClimDown to convert.
+"""
+
+from contextlib import ExitStack
+
+from chickadee.engines import netcdf, units
+
+
+# Variables ClimDown converts to target units with units_bool
+TARGET_UNITS = ("tasmax", "tasmin", "tg", "pr")
+
+
+def open_input(stack, path, name):
+    try:
+        return stack.enter_context(netcdf.open_dataset(path))
+    except OSError as e:
+        raise ValueError(f"Cannot read the {name} file: {e}")
+
+
+def check_variable(nc, varname, name):
+    """The ``varname`` variable of ``nc``, which must be a (time, lat, lon)
+    grid"""
+    if varname not in nc.variables:
+        found = ", ".join(
+            other for other, var in nc.variables.items() if len(var.dimensions) == 3
+        )
+        raise ValueError(
+            f"Variable '{varname}' not found in {name} file (it has: {found or 'none'})"
+        )
+    var = nc.variables[varname]
+    if len(var.dimensions) != 3:
+        raise ValueError(
+            f"Variable '{varname}' in {name} file must have time, lat and lon "
+            f"dimensions, not {', '.join(var.dimensions)}"
+        )
+    return var
+
+
+def check_dates(nc, varname, name, start, end):
+    """Check the time axis of ``varname`` can be read and covers part of the
+    calibration period from ``start`` to ``end``"""
+    try:
+        dates = netcdf.read_dates(nc, varname)
+    except (ValueError, TypeError, AttributeError) as e:
+        raise ValueError(f"Cannot read the time axis of the {name} file: {e}")
+    if not len(dates):
+        raise ValueError(f"The {name} file has no timesteps")
+    if not netcdf.in_period(dates, start, end).any():
+        first, last = ("-".join(f"{v:02d}" for v in d) for d in (dates[0], dates[-1]))
+        raise ValueError(
+            f"The {name} file ({first} to {last}) does not cover the calibration "
+            f"period {start} to {end}"
+        )
+
+
+def check_units(variables, target):
+    """Check the ``(name, var)`` pairs have units that convert to each other
+    and to ``target``"""
+    known = []
+    for name, var in variables:
+        var_units = getattr(var, "units", None)
+        if not var_units:
+            raise ValueError(
+                f"Variable '{var.name}' in {name} file has no units, which "
+                "units_bool needs"
+            )
+        if units.quantity(var_units):
+            known.append((f"'{var_units}' of the {name} file", var_units))
+    if target and units.quantity(target):
+        known.append((f"target units '{target}'", target))
+    for (first, first_units), (other, other_units) in zip(known, known[1:]):
+        if not units.compatible(first_units, other_units):
+            raise ValueError(f"Cannot convert the units {first} to the {other}")
+
+
+def check(process, gcm_file, obs_file, gcm_varname, obs_varname, options):
+    """Check the inputs of a ``process`` request and raise a ValueError for
+    the first problem. For Rerank, ``gcm_file`` is its QDM output."""
+    gcm_name = "QDM" if process == "rerank" else "GCM"
+    with ExitStack() as stack:
+        gcm_nc = open_input(stack, gcm_file, gcm_name)
+        obs_nc = open_input(stack, obs_file, "observations")
+        gcm_var = check_variable(gcm_nc, gcm_varname, gcm_name)
+        obs_var = check_variable(obs_nc, obs_varname, "observations")
+
+        start, end = options["start_date"], options["end_date"]
+        if start > end:
+            raise ValueError(f"The calibration period starts after it ends: {start}")
+        check_dates(gcm_nc, gcm_varname, gcm_name, start, end)
+        check_dates(obs_nc, obs_varname, "observations", start, end)
+
+        # QDM and Rerank work cell by cell on the observations grid
+        if process in ("qdm", "rerank") and gcm_var.shape[1:] != obs_var.shape[1:]:
+            raise ValueError(
+                f"The {gcm_name} file must be on the grid of the observations, "
+                f"{gcm_var.shape[1:]} is not {obs_var.shape[1:]}"
+            )
+
+        if options["units_bool"]:
+            target = None
+            if gcm_varname in TARGET_UNITS:
+                target = options.get(f"{gcm_varname}_units")
+            check_units([(gcm_name, gcm_var), ("observations", obs_var)], target)
@@ -3,6 +3,7 @@ from .wps_CI import CI
 from .wps_BCCAQ import BCCAQ
 from .wps_QDM import QDM
 from .wps_rerank import Rerank
+from .wps_estimate import Estimate
 
 processes = [
     CA(),
@@ -10,4 +11,5 @@ processes = [
     BCCAQ(),
     QDM(),
     Rerank(),
+    Estimate(),
 ]
@@ -1,12 +1,93 @@
+import os
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from pywps import Process
 from pywps.app.Common import Metadata
+from pywps.app.exceptions import ProcessError
 from rpy2.rinterface_lib.embedded import RRuntimeError
-from rpy2 import robjects
 
 # PCIC libraries
-from wps_tools import logging, R, io, error_handling
+from wps_tools import logging, io, error_handling
 import chickadee.utils as util
 import chickadee.io as chick_io
+from chickadee import (
+    r_pool,
+    admission,
+    cancellation,
+    cores,
+    cost_model,
+    obs_registry,
+    preflight,
+    staging,
+    tiling,
+)
+from chickadee.processes.wps_CI import run_ci, ci_tile
+from chickadee.processes.wps_QDM import run_qdm, qdm_tile
+from chickadee.processes.wps_CA import (
+    run_ca,
+    run_ca_numpy,
+    get_analogue_cache,
+    analogue_cache_key,
+)
+from chickadee.engines import ci, qdm
+from chickadee.engines.subset import Subset, write_subset
+from chickadee.processes.wps_rerank import run_rerank, rerank_tile
+
+
+ANALOGUES_NAME = "analogues"
+
+
+def run_branches(*branches):
+    """Run independent branches of the pipeline at the same time.
+
+    Each branch is a list of ``(fn, *args)`` steps that run in order, either
+    ``tiling.in_process`` calls of the NumPy engines or ``r_pool.run`` jobs.
+    The branches are threads, so no step may use the NetCDF library in this
+    process. Raises the first error once all branches have stopped.
+    """
+
+    def run_branch(steps):
+        for fn, *args in steps:
+            fn(*args)
+
+    with ThreadPoolExecutor(len(branches)) as executor:
+        futures = [executor.submit(run_branch, jobs) for jobs in branches]
+    for future in futures:
+        future.result()
+
+
+def peak_gb(job, cached):
+    """Peak memory of a BCCAQ ``job``, of CI -> QDM alone when the analogues
+    are ``cached``"""
+    if not cached:
+        return cost_model.peak_gb(job)
+    return max(cost_model.peak_gb(job._replace(process=p)) for p in ("ci", "qdm"))
+
+
+def bias_correct_tile(
+    tile, workdir, engine, gcm_file, ci_obs_file, obs_file, varname, options
+):
+    """Run CI and then QDM on one tile and return the QDM output file"""
+    ci_file = ci_tile(
+        tile, workdir, engine, gcm_file, ci_obs_file, options, (varname, varname)
+    )
+    return qdm_tile(tile, workdir, engine, obs_file, ci_file, varname, options)
+
+
+def rerank_bias_corrected_tile(
+    tile, workdir, obs_file, varname, analogues_file, options
+):
+    """Run Rerank on the output of ``bias_correct_tile`` for one tile"""
+    return rerank_tile(
+        tile,
+        workdir,
+        obs_file,
+        tiling.tile_file(workdir, tile, "qdm.nc"),
+        varname,
+        analogues_file,
+        ANALOGUES_NAME,
+        options,
+    )
 
 
 class BCCAQ(Process):
@@ -17,20 +98,24 @@ class BCCAQ(Process):
     def __init__(self):
         self.status_percentage_steps = dict(
             logging.common_status_percentages,
-            **{"get_ClimDown": 5, "set_R_options": 10, "parallelization": 15},
+            **{"gather_options": 10, "rerank": 80},
         )
 
         self.handler_inputs = [
             chick_io.gcm_file,
             chick_io.obs_file,
+            chick_io.obs_id,
             chick_io.varname,
             chick_io.out_file,
             chick_io.num_cores,
             io.log_level,
+            chick_io.engine,
+            chick_io.num_tiles,
         ]
 
         inputs = (
             self.handler_inputs
+            + chick_io.subset_input
             + chick_io.general_options_input
             + chick_io.ca_options_input
             + chick_io.qdm_options_input
@@ -59,100 +144,309 @@ class BCCAQ(Process):
         )
 
     def _handler(self, request, response):
-        args = io.collect_args(request.inputs, self.workdir)
-        (
-            gcm_file,
-            obs_file,
-            varname,
-            out_file,
-            num_cores,
-            loglevel,
-        ) = util.select_args_from_input_list(args, self.handler_inputs)
-
-        logging.log_handler(
-            self,
-            response,
-            "Starting Process",
-            util.logger,
-            log_level=loglevel,
-            process_step="start",
-        )
+        with cancellation.tracking(response.uuid):
+            args = staging.collect_args(request.inputs, self.workdir)
+            (
+                gcm_file,
+                obs_file,
+                obs_id,
+                varname,
+                out_file,
+                num_cores,
+                loglevel,
+                engine,
+                num_tiles,
+            ) = util.select_args_from_input_list(args, self.handler_inputs)
+            try:
+                ci_obs_file = obs_registry.get_obs_file(obs_file, obs_id, "time_major")
+                obs_file = obs_registry.get_obs_file(obs_file, obs_id, "cell_major")
+                subset = Subset.from_inputs(
+                    *util.select_args_from_input_list(args, chick_io.subset_input)
+                )
+                cores.parse(num_cores)
+                preflight.check("bccaq", gcm_file, obs_file, varname, varname, args)
+            except ValueError as e:
+                raise ProcessError(f"{type(e).__name__}: {e}")
 
-        logging.log_handler(
-            self,
-            response,
-            "Importing R package 'ClimDown'",
-            util.logger,
-            log_level=loglevel,
-            process_step="get_ClimDown",
-        )
-        climdown = R.get_package("ClimDown")
-
-        logging.log_handler(
-            self,
-            response,
-            "Setting R options",
-            util.logger,
-            log_level=loglevel,
-            process_step="set_R_options",
-        )
-        util.set_general_options(
-            *util.select_args_from_input_list(args, chick_io.general_options_input)
-        )
-        util.set_ca_options(
-            *util.select_args_from_input_list(args, chick_io.ca_options_input)
-        )
-        util.set_qdm_options(
-            *util.select_args_from_input_list(args, chick_io.qdm_options_input)
-        )
+            logging.log_handler(
+                self,
+                response,
+                "Starting Process",
+                util.logger,
+                log_level=loglevel,
+                process_step="start",
+            )
 
-        logging.log_handler(
-            self,
-            response,
-            "Setting parallelization",
-            util.logger,
-            log_level=loglevel,
-            process_step="parallelization",
-        )
-        doPar = R.get_package("doParallel")
-        doPar.registerDoParallel(cores=num_cores)
-
-        logging.log_handler(
-            self,
-            response,
-            "Downscaling GCM",
-            util.logger,
-            log_level=loglevel,
-            process_step="process",
-        )
+            logging.log_handler(
+                self,
+                response,
+                "Gathering options",
+                util.logger,
+                log_level=loglevel,
+                process_step="gather_options",
+            )
+            general_options = tuple(
+                util.select_args_from_input_list(args, chick_io.general_options_input)
+            )
+            ca_options = tuple(
+                util.select_args_from_input_list(args, chick_io.ca_options_input)
+            )
+            qdm_options = tuple(
+                util.select_args_from_input_list(args, chick_io.qdm_options_input)
+            )
 
-        try:
-            climdown.bccaq_netcdf_wrapper(gcm_file, obs_file, out_file, varname)
-        except RRuntimeError as e:
-            error_handling.custom_process_error(e)
+            logging.log_handler(
+                self,
+                response,
+                "Downscaling GCM",
+                util.logger,
+                log_level=loglevel,
+                process_step="process",
+            )
 
-        doPar.stopImplicitCluster()
+            ci_file = os.path.join(self.workdir, "ci.nc")
+            qdm_file = os.path.join(self.workdir, "qdm.nc")
+            analogues_file = os.path.join(self.workdir, "analogues.rda")
+            ci_options = (varname, varname)
+            options = util.select_options_from_input_list(
+                args,
+                chick_io.general_options_input
+                + chick_io.ca_options_input
+                + chick_io.qdm_options_input,
+            )
 
-        logging.log_handler(
-            self,
-            response,
-            "Building final output",
-            util.logger,
-            log_level=loglevel,
-            process_step="build_output",
-        )
+            # Reuse the analogues of an earlier CA or BCCAQ run of the same inputs
+            analogue_cache = get_analogue_cache()
+            cache_key = analogue_cache_key(
+                gcm_file, obs_file, varname, args, engine, "exact", subset
+            )
+            cache_file = os.path.join(self.workdir, "analogues.rds")
+            cached = analogue_cache.get(cache_key, cache_file)
 
-        response.outputs["output"].file = out_file
+            # Rerank, and ClimDown in every step, only read whole files, so they
+            # are given copies of the subset
+            calibration = (args["start_date"], args["end_date"])
+            try:
+                job = cost_model.describe(
+                    "bccaq",
+                    engine,
+                    gcm_file,
+                    obs_file,
+                    args["max_gb"],
+                    num_cores,
+                    varname,
+                    varname,
+                    subset,
+                    calibration,
+                )
+                rerank_obs_file = write_subset(
+                    subset, obs_file, os.path.join(self.workdir, "obs_subset.nc")
+                )
+                if engine != "numpy":
+                    gcm_file = write_subset(
+                        subset,
+                        gcm_file,
+                        os.path.join(self.workdir, "gcm_subset.nc"),
+                        calibration,
+                    )
+                    if ci_obs_file == obs_file:
+                        ci_obs_file = rerank_obs_file
+                    else:
+                        ci_obs_file = write_subset(
+                            subset,
+                            ci_obs_file,
+                            os.path.join(self.workdir, "ci_obs_subset.nc"),
+                        )
+                    obs_file = rerank_obs_file
+            except (ValueError, OSError) as e:
+                error_handling.custom_process_error(e)
 
-        # Clear R global env
-        robjects.r("rm(list=ls())")
+            with (
+                cores.reserve(num_cores) as num_cores,
+                admission.admit(
+                    peak_gb(job._replace(num_cores=num_cores), cached),
+                    response.uuid,
+                ),
+                cost_model.timed(job._replace(num_cores=num_cores)),
+            ):
+                # CI -> QDM and CA are independent until Rerank, so they run at the
+                # same time and split the cores
+                if cached:
+                    util.logger.info(f"Using cached analogues {cache_key}")
+                    analogues_file = cached
+                    qdm_cores, ca_cores = num_cores, 0
+                else:
+                    qdm_cores = max(1, num_cores // 2)
+                    ca_cores = max(1, num_cores - qdm_cores)
 
-        logging.log_handler(
-            self,
-            response,
-            "Process Complete",
-            util.logger,
-            log_level=loglevel,
-            process_step="complete",
-        )
-        return response
+                if engine == "numpy":
+                    bias_correction = [
+                        (
+                            tiling.in_process,
+                            ci.ci_netcdf,
+                            gcm_file,
+                            ci_obs_file,
+                            ci_file,
+                            *ci_options,
+                            options,
+                            None,
+                            subset,
+                        ),
+                        (
+                            tiling.in_process,
+                            qdm.qdm_netcdf,
+                            obs_file,
+                            ci_file,
+                            qdm_file,
+                            varname,
+                            options,
+                            qdm_cores,
+                            subset,
+                        ),
+                    ]
+                    analogues = [
+                        (
+                            run_ca_numpy,
+                            gcm_file,
+                            obs_file,
+                            varname,
+                            options,
+                            ca_cores,
+                            "exact",
+                            ANALOGUES_NAME,
+                            analogues_file,
+                            cache_file,
+                            subset,
+                        )
+                    ]
+                else:
+                    bias_correction = [
+                        (
+                            r_pool.run,
+                            run_ci,
+                            gcm_file,
+                            ci_obs_file,
+                            ci_file,
+                            qdm_cores,
+                            general_options,
+                            ci_options,
+                        ),
+                        (
+                            r_pool.run,
+                            run_qdm,
+                            ci_file,
+                            obs_file,
+                            varname,
+                            qdm_file,
+                            qdm_cores,
+                            general_options,
+                            qdm_options,
+                        ),
+                    ]
+                    analogues = [
+                        (
+                            r_pool.run,
+                            run_ca,
+                            gcm_file,
+                            obs_file,
+                            varname,
+                            ca_cores,
+                            general_options,
+                            ca_options,
+                            ANALOGUES_NAME,
+                            analogues_file,
+                            cache_file,
+                        )
+                    ]
+
+                with tiling.tile_workdir(self.workdir, response.uuid) as tile_dir:
+                    try:
+                        if num_tiles > 1:
+                            # CA finds the analogues on the whole domain, CI, QDM and
+                            # Rerank run tile by tile
+                            tiles = tiling.make_tiles(obs_file, num_tiles, subset)
+                            workers = min(tiling.get_workers(), num_cores)
+                            tile_options = tiling.tile_options(
+                                options, min(workers, len(tiles))
+                            )
+                            bias_correction = [
+                                (
+                                    partial(tiling.run_tiles, job_id=response.uuid),
+                                    partial(
+                                        bias_correct_tile,
+                                        workdir=tile_dir,
+                                        engine=engine,
+                                        gcm_file=gcm_file,
+                                        ci_obs_file=ci_obs_file,
+                                        obs_file=obs_file,
+                                        varname=varname,
+                                        options=tile_options,
+                                    ),
+                                    tiles,
+                                    workers,
+                                )
+                            ]
+                        run_branches(bias_correction, [] if cached else analogues)
+                        if not cached:
+                            analogue_cache.put(cache_key, cache_file)
+
+                        logging.log_handler(
+                            self,
+                            response,
+                            "Reranking",
+                            util.logger,
+                            log_level=loglevel,
+                            process_step="rerank",
+                        )
+                        if num_tiles > 1:
+                            tile_files = tiling.run_tiles(
+                                partial(
+                                    rerank_bias_corrected_tile,
+                                    workdir=tile_dir,
+                                    obs_file=rerank_obs_file,
+                                    varname=varname,
+                                    analogues_file=analogues_file,
+                                    options=tile_options,
+                                ),
+                                tiles,
+                                workers,
+                                job_id=response.uuid,
+                            )
+                            tiling.stitch(
+                                tile_files, tiles, out_file, options["max_gb"]
+                            )
+                        else:
+                            r_pool.run(
+                                run_rerank,
+                                rerank_obs_file,
+                                varname,
+                                out_file,
+                                num_cores,
+                                qdm_file,
+                                analogues_file,
+                                ANALOGUES_NAME,
+                                general_options,
+                            )
+                    except (RRuntimeError, ValueError, OSError) as e:
+                        error_handling.custom_process_error(e)
+
+            logging.log_handler(
+                self,
+                response,
+                "Building final output",
+                util.logger,
+                log_level=loglevel,
+                process_step="build_output",
+            )
+
+            response.outputs["output"].file = out_file
+
+            logging.log_handler(
+                self,
+                response,
+                "Process Complete",
+                util.logger,
+                log_level=loglevel,
+                process_step="complete",
+            )
+            return response
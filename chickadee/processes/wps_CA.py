@@ -1,13 +1,124 @@
-from pywps import Process, LiteralInput
+import os
+from pywps import Process, LiteralInput, LiteralOutput
 from pywps.app.Common import Metadata
 from pywps.app.exceptions import ProcessError
-from rpy2.rinterface_lib.embedded import RRuntimeError
 from rpy2 import robjects
+from rpy2.rinterface_lib.embedded import RRuntimeError
 
 # PCIC libraries
 from wps_tools import logging, R, io, error_handling
 import chickadee.utils as util
 import chickadee.io as chick_io
+from chickadee import (
+    r_pool,
+    admission,
+    cancellation,
+    cache,
+    cores,
+    cost_model,
+    obs_registry,
+    preflight,
+    staging,
+    tiling,
+)
+from chickadee.engines import ca
+from chickadee.engines.subset import Subset, write_subset
+
+
+def get_analogue_cache():
+    return cache.get_cache("analogues", "analogue_cache_gb", 10)
+
+
+def analogue_cache_key(gcm_file, obs_file, varname, args, engine, search, subset=None):
+    """Cache key of the analogues computed from the given inputs"""
+    options = util.select_options_from_input_list(
+        args, chick_io.general_options_input + chick_io.ca_options_input
+    )
+    # Only changes how the work is chunked
+    options.pop("max_gb")
+    return cache.make_key(
+        "analogues",
+        cache.input_digest(gcm_file),
+        cache.input_digest(obs_file),
+        varname,
+        options,
+        engine,
+        search,
+        subset.key() if subset else None,
+    )
+
+
+def run_ca(
+    gcm_file,
+    obs_file,
+    varname,
+    num_cores,
+    general_options,
+    ca_options,
+    vector_name,
+    output_file,
+    cache_file=None,
+):
+    """Run the CA step in an R worker and save the analogues to an Rdata file
+    and, for the analogue cache, to the RDS file ``cache_file``"""
+    climdown = r_pool.get_package("ClimDown")
+    util.set_general_options(*general_options)
+    util.set_ca_options(*ca_options)
+
+    r_pool.register_parallel(num_cores)
+    analogues = climdown.ca_netcdf_wrapper(gcm_file, obs_file, varname)
+
+    R.r_valid_name(vector_name)
+    R.save_python_to_rdata(vector_name, analogues, output_file)
+    if cache_file:
+        robjects.r["saveRDS"](analogues, file=cache_file)
+
+
+def save_analogues(analogues, vector_name, output_file, cache_file=None):
+    """Save analogues found by the NumPy engine to an Rdata file in an R
+    worker, as the same list of indices and weights ClimDown returns"""
+    r_list = robjects.r["list"]
+    analogues = robjects.ListVector(
+        {
+            "indices": r_list(
+                *[robjects.IntVector(i.tolist()) for i in analogues["indices"]]
+            ),
+            "weights": r_list(
+                *[robjects.FloatVector(w.tolist()) for w in analogues["weights"]]
+            ),
+        }
+    )
+    R.r_valid_name(vector_name)
+    R.save_python_to_rdata(vector_name, analogues, output_file)
+    if cache_file:
+        robjects.r["saveRDS"](analogues, file=cache_file)
+
+
+def run_ca_numpy(
+    gcm_file,
+    obs_file,
+    varname,
+    options,
+    num_cores,
+    search,
+    vector_name,
+    output_file,
+    cache_file=None,
+    subset=None,
+):
+    """Find the analogues with the NumPy engine in their own process and save
+    them like ``run_ca``"""
+    analogues = tiling.in_process(
+        ca.ca_netcdf, gcm_file, obs_file, varname, options, num_cores, search, subset
+    )
+    r_pool.run(save_analogues, analogues, vector_name, output_file, cache_file)
+
+
+def export_analogues(rds_file, vector_name, output_file):
+    """Save cached analogues to an Rdata file under the requested name"""
+    analogues = robjects.r["readRDS"](rds_file)
+    R.r_valid_name(vector_name)
+    R.save_python_to_rdata(vector_name, analogues, output_file)
 
 
 class CA(Process):
@@ -23,31 +134,38 @@ class CA(Process):
     def __init__(self):
         self.status_percentage_steps = dict(
             logging.common_status_percentages,
-            **{
-                "get_ClimDown": 5,
-                "set_R_options": 10,
-                "parallelization": 15,
-                "write_files": 80,
-            },
+            **{"gather_options": 10},
         )
 
         self.handler_inputs = [
             chick_io.gcm_file,
             chick_io.obs_file,
+            chick_io.obs_id,
             chick_io.varname,
             chick_io.num_cores,
             chick_io.out_file,
             io.vector_name,
             io.log_level,
+            chick_io.engine,
+            chick_io.analogue_search,
         ]
 
         inputs = (
             self.handler_inputs
+            + chick_io.subset_input
             + chick_io.general_options_input
             + chick_io.ca_options_input
         )
 
-        outputs = [io.rda_output]
+        outputs = [
+            io.rda_output,
+            LiteralOutput(
+                "analogues_ref",
+                "Analogues cache reference",
+                abstract="Reference to the cached analogues, which can be passed to Rerank instead of the Rdata file. Empty when the analogues could not be cached. The cache evicts its least recently used entries, so a reference can expire",
+                data_type="string",
+            ),
+        ]
 
         super(CA, self).__init__(
             self._handler,
@@ -70,120 +188,163 @@ class CA(Process):
         )
 
     def _handler(self, request, response):
-        args = io.collect_args(request.inputs, self.workdir)
-        (
-            gcm_file,
-            obs_file,
-            varname,
-            num_cores,
-            output_file,
-            vector_name,
-            loglevel,
-        ) = util.select_args_from_input_list(args, self.handler_inputs)
-
-        logging.log_handler(
-            self,
-            response,
-            "Starting Process",
-            util.logger,
-            log_level=loglevel,
-            process_step="start",
-        )
+        with cancellation.tracking(response.uuid):
+            args = staging.collect_args(request.inputs, self.workdir)
+            (
+                gcm_file,
+                obs_file,
+                obs_id,
+                varname,
+                num_cores,
+                output_file,
+                vector_name,
+                loglevel,
+                engine,
+                analogue_search,
+            ) = util.select_args_from_input_list(args, self.handler_inputs)
+            try:
+                obs_file = obs_registry.get_obs_file(obs_file, obs_id, "cell_major")
+                subset = Subset.from_inputs(
+                    *util.select_args_from_input_list(args, chick_io.subset_input)
+                )
+                preflight.check("ca", gcm_file, obs_file, varname, varname, args)
+            except ValueError as e:
+                raise ProcessError(f"{type(e).__name__}: {e}")
 
-        logging.log_handler(
-            self,
-            response,
-            "Importing R package 'ClimDown'",
-            util.logger,
-            log_level=loglevel,
-            process_step="get_ClimDown",
-        )
-        climdown = R.get_package("ClimDown")
-
-        logging.log_handler(
-            self,
-            response,
-            "Setting R options",
-            util.logger,
-            log_level=loglevel,
-            process_step="set_R_options",
-        )
-        util.set_general_options(
-            *util.select_args_from_input_list(args, chick_io.general_options_input)
-        )
-        util.set_ca_options(
-            *util.select_args_from_input_list(args, chick_io.ca_options_input)
-        )
+            logging.log_handler(
+                self,
+                response,
+                "Starting Process",
+                util.logger,
+                log_level=loglevel,
+                process_step="start",
+            )
 
-        logging.log_handler(
-            self,
-            response,
-            "Setting parallelization",
-            util.logger,
-            log_level=loglevel,
-            process_step="parallelization",
-        )
-        doPar = R.get_package("doParallel")
-        doPar.registerDoParallel(cores=num_cores)
-
-        logging.log_handler(
-            self,
-            response,
-            "Calculating weights",
-            util.logger,
-            log_level=loglevel,
-            process_step="process",
-        )
+            logging.log_handler(
+                self,
+                response,
+                "Gathering options",
+                util.logger,
+                log_level=loglevel,
+                process_step="gather_options",
+            )
+            general_options = tuple(
+                util.select_args_from_input_list(args, chick_io.general_options_input)
+            )
+            ca_options = tuple(
+                util.select_args_from_input_list(args, chick_io.ca_options_input)
+            )
 
-        # Run Constructed Analogue Step (CA)
-        logging.log_handler(
-            self,
-            response,
-            "Calculating weights",
-            util.logger,
-            log_level=loglevel,
-            process_step="process",
-        )
+            # Run Constructed Analogue Step (CA) and write indices and weights
+            logging.log_handler(
+                self,
+                response,
+                "Calculating weights",
+                util.logger,
+                log_level=loglevel,
+                process_step="process",
+            )
 
-        try:
-            analogues = climdown.ca_netcdf_wrapper(gcm_file, obs_file, varname)
-        except RRuntimeError as e:
-            error_handling.custom_process_error(e)
-
-        # Stop parallelization
-        doPar.stopImplicitCluster()
-
-        logging.log_handler(
-            self,
-            response,
-            "Writing indices and weights lists to files",
-            util.logger,
-            log_level=loglevel,
-            process_step="write_files",
-        )
-        R.r_valid_name(vector_name)
-        R.save_python_to_rdata(vector_name, analogues, output_file)
-
-        logging.log_handler(
-            self,
-            response,
-            "Building final output",
-            util.logger,
-            log_level=loglevel,
-            process_step="build_output",
-        )
+            if analogue_search == "index":
+                engine = "numpy"
+            analogue_cache = get_analogue_cache()
+            cache_key = analogue_cache_key(
+                gcm_file, obs_file, varname, args, engine, analogue_search, subset
+            )
+            cache_file = os.path.join(self.workdir, "analogues.rds")
 
-        response.outputs["rda_output"].file = output_file
+            try:
+                job = cost_model.describe(
+                    "ca",
+                    engine,
+                    gcm_file,
+                    obs_file,
+                    args["max_gb"],
+                    num_cores,
+                    varname,
+                    varname,
+                    subset,
+                    (args["start_date"], args["end_date"]),
+                )
+                with (
+                    cores.reserve(num_cores) as num_cores,
+                    admission.admit(
+                        cost_model.peak_gb(job._replace(num_cores=num_cores)),
+                        response.uuid,
+                    ),
+                    cost_model.timed(job._replace(num_cores=num_cores)),
+                ):
+                    cached = analogue_cache.get(cache_key, cache_file)
+                    if cached:
+                        util.logger.info(f"Using cached analogues {cache_key}")
+                        r_pool.run(
+                            export_analogues, cache_file, vector_name, output_file
+                        )
+                    elif engine == "numpy":
+                        options = util.select_options_from_input_list(
+                            args,
+                            chick_io.general_options_input + chick_io.ca_options_input,
+                        )
+                        run_ca_numpy(
+                            gcm_file,
+                            obs_file,
+                            varname,
+                            options,
+                            num_cores,
+                            analogue_search,
+                            vector_name,
+                            output_file,
+                            cache_file,
+                            subset,
+                        )
+                        cached = analogue_cache.put(cache_key, cache_file)
+                    else:
+                        # ClimDown reads whole files
+                        calibration = (args["start_date"], args["end_date"])
+                        r_pool.run(
+                            run_ca,
+                            write_subset(
+                                subset,
+                                gcm_file,
+                                os.path.join(self.workdir, "gcm_subset.nc"),
+                                calibration,
+                            ),
+                            write_subset(
+                                subset,
+                                obs_file,
+                                os.path.join(self.workdir, "obs_subset.nc"),
+                            ),
+                            varname,
+                            num_cores,
+                            general_options,
+                            ca_options,
+                            vector_name,
+                            output_file,
+                            cache_file,
+                        )
+                        cached = analogue_cache.put(cache_key, cache_file)
+            except (RRuntimeError, ValueError, OSError) as e:
+                error_handling.custom_process_error(e)
 
-        # Clear R global env
-        robjects.r("rm(list=ls())")
+            logging.log_handler(
+                self,
+                response,
+                "Building final output",
+                util.logger,
+                log_level=loglevel,
+                process_step="build_output",
+            )
 
-        logging.log_handler(
-            self,
-            response,
-            "Process Complete",
-            util.logger,
-            log_level=loglevel,
-            process_step="complete",
-        )
-        return response
+            response.outputs["rda_output"].file = output_file
+            # Only refer to analogues that made it into the cache
+            response.outputs["analogues_ref"].data = cache_key if cached else ""
+
+            logging.log_handler(
+                self,
+                response,
+                "Process Complete",
+                util.logger,
+                log_level=loglevel,
+                process_step="complete",
+            )
+            return response
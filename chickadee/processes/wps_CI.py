@@ -1,31 +1,93 @@
+import os
+from functools import partial
 from pywps import Process
 from pywps.app.Common import Metadata
-from rpy2 import robjects
+from pywps.app.exceptions import ProcessError
 from rpy2.rinterface_lib.embedded import RRuntimeError
 from tempfile import TemporaryDirectory
 
 # PCIC libraries
-from wps_tools import logging, R, io, error_handling
+from wps_tools import logging, io, error_handling
 import chickadee.utils as util
 import chickadee.io as chick_io
+from chickadee import (
+    r_pool,
+    admission,
+    cancellation,
+    cores,
+    cost_model,
+    obs_registry,
+    preflight,
+    staging,
+    tiling,
+)
+from chickadee.engines import ci
+from chickadee.engines.subset import Subset, write_subset
 from chickadee.response_tracker import track_response, untrack_response
+from chickadee.status_writer import StatusWriter
+
+
+def run_ci(gcm_file, obs_file, output_path, num_cores, general_options, ci_options):
+    """Run the CI step in an R worker"""
+    climdown = r_pool.get_package("ClimDown")
+    util.set_general_options(*general_options)
+    util.set_ci_options(*ci_options)
+
+    r_pool.register_parallel(num_cores)
+    climdown.ci_netcdf_wrapper(gcm_file, obs_file, output_path)
+
+
+def ci_tile(tile, workdir, engine, gcm_file, obs_file, options, ci_options):
+    """Run CI on one tile in its own process and return its output file"""
+    output_file = tiling.tile_file(workdir, tile, "ci.nc")
+    if engine == "numpy":
+        tiling.in_process(
+            ci.ci_netcdf,
+            gcm_file,
+            obs_file,
+            output_file,
+            *ci_options,
+            options,
+            subset=tile,
+        )
+        return output_file
+
+    calibration = (options["start_date"], options["end_date"])
+    r_pool.run(
+        run_ci,
+        write_subset(
+            tile, gcm_file, tiling.tile_file(workdir, tile, "gcm.nc"), calibration
+        ),
+        write_subset(tile, obs_file, tiling.tile_file(workdir, tile, "obs.nc")),
+        output_file,
+        1,
+        tuple(
+            util.select_args_from_input_list(options, chick_io.general_options_input)
+        ),
+        ci_options,
+    )
+    return output_file
 
 
 class CI(Process):
     def __init__(self):
         self.status_percentage_steps = dict(
             logging.common_status_percentages,
-            **{"get_ClimDown": 5, "set_R_options": 10, "parallelization": 15},
+            **{"gather_options": 10},
         )
         self.handler_inputs = [
             chick_io.gcm_file,
             chick_io.obs_file,
+            chick_io.obs_id,
             chick_io.out_file,
             chick_io.num_cores,
             io.log_level,
+            chick_io.engine,
+            chick_io.num_tiles,
         ]
         inputs = (
             self.handler_inputs
+            + chick_io.subset_input
             + chick_io.general_options_input
             + chick_io.ci_options_input
         )
@@ -51,116 +113,189 @@ class CI(Process):
         )
 
     def _handler(self, request, response):
-        track_response(response.uuid, response)
-        try:
-            args = io.collect_args(request.inputs, self.workdir)
-            (
-                gcm_file,
-                obs_file,
-                output_file,
-                num_cores,
-                loglevel,
-            ) = util.select_args_from_input_list(args, self.handler_inputs)
-            util.raise_if_failed(response)
-            logging.log_handler(
-                self,
-                response,
-                "Starting Process",
-                util.logger,
-                log_level=loglevel,
-                process_step="start",
-            )
-            util.raise_if_failed(response)
-            logging.log_handler(
-                self,
-                response,
-                "Importing R package 'ClimDown'",
-                util.logger,
-                log_level=loglevel,
-                process_step="get_ClimDown",
-            )
-            climdown = R.get_package("ClimDown")
-            util.raise_if_failed(response)
-            logging.log_handler(
-                self,
-                response,
-                "Setting R options",
-                util.logger,
-                log_level=loglevel,
-                process_step="set_R_options",
-            )
-            # Uses general_options_input
-            util.set_general_options(
-                *util.select_args_from_input_list(args, chick_io.general_options_input)
-            )
-
-            # Uses ci_options_input
-            util.set_ci_options(
-                *util.select_args_from_input_list(args, chick_io.ci_options_input)
-            )
-
-            # Set parallelization
-            logging.log_handler(
-                self,
-                response,
-                "Setting parallelization",
-                util.logger,
-                log_level=loglevel,
-                process_step="parallelization",
-            )
-            util.raise_if_failed(response)
-            doPar = R.get_package("doParallel")
-            doPar.registerDoParallel(cores=num_cores)
-
-            logging.log_handler(
-                self,
-                response,
-                "Processing CI downscaling",
-                util.logger,
-                log_level=loglevel,
-                process_step="process",
-            )
-            util.raise_if_failed(response)
-            set_r_monitor, remove_r_monitor = util.create_r_progress_monitor(
-                self, response, util.logger, loglevel
-            )
-
-            with TemporaryDirectory() as td:
+        with cancellation.tracking(response.uuid):
+            track_response(response.uuid, response)
+            try:
+                args = staging.collect_args(request.inputs, self.workdir)
+                (
+                    gcm_file,
+                    obs_file,
+                    obs_id,
+                    output_file,
+                    num_cores,
+                    loglevel,
+                    engine,
+                    num_tiles,
+                ) = util.select_args_from_input_list(args, self.handler_inputs)
                 try:
-                    output_path = td + "/" + output_file
-                    set_r_monitor()
-                    climdown.ci_netcdf_wrapper(gcm_file, obs_file, output_path)
-                    remove_r_monitor()
-                except RRuntimeError as e:
-                    remove_r_monitor()
-                    error_handling.custom_process_error(e)
-
-                # stop parallelization
-                doPar.stopImplicitCluster()
+                    obs_file = obs_registry.get_obs_file(obs_file, obs_id, "time_major")
+                    subset = Subset.from_inputs(
+                        *util.select_args_from_input_list(args, chick_io.subset_input)
+                    )
+                    preflight.check(
+                        "ci",
+                        gcm_file,
+                        obs_file,
+                        args["gcm_varname"],
+                        args["obs_varname"],
+                        args,
+                    )
+                except ValueError as e:
+                    raise ProcessError(f"{type(e).__name__}: {e}")
                 util.raise_if_failed(response)
                 logging.log_handler(
                     self,
                     response,
-                    "Building final output",
+                    "Starting Process",
                     util.logger,
                     log_level=loglevel,
-                    process_step="build_output",
+                    process_step="start",
+                )
+                util.raise_if_failed(response)
+                logging.log_handler(
+                    self,
+                    response,
+                    "Gathering options",
+                    util.logger,
+                    log_level=loglevel,
+                    process_step="gather_options",
+                )
+                # Uses general_options_input
+                general_options = tuple(
+                    util.select_args_from_input_list(
+                        args, chick_io.general_options_input
+                    )
                 )
 
-                response.outputs["output"].file = output_path
-
-                # Clear R global env
-                robjects.r("rm(list=ls())")
+                # Uses ci_options_input
+                ci_options = tuple(
+                    util.select_args_from_input_list(args, chick_io.ci_options_input)
+                )
 
                 logging.log_handler(
                     self,
                     response,
-                    "Process Complete",
+                    "Processing CI downscaling",
                     util.logger,
                     log_level=loglevel,
-                    process_step="complete",
+                    process_step="process",
                 )
+                util.raise_if_failed(response)
+
+                with TemporaryDirectory() as td:
+                    output_path = td + "/" + output_file
+                    try:
+                        job = cost_model.describe(
+                            "ci",
+                            engine,
+                            gcm_file,
+                            obs_file,
+                            args["max_gb"],
+                            num_cores,
+                            *ci_options,
+                            subset,
+                            (args["start_date"], args["end_date"]),
+                        )
+                        with (
+                            cores.reserve(num_cores) as num_cores,
+                            admission.admit(
+                                cost_model.peak_gb(job._replace(num_cores=num_cores)),
+                                response.uuid,
+                            ),
+                            StatusWriter(response) as status_writer,
+                            cost_model.timed(job._replace(num_cores=num_cores)),
+                        ):
+                            r_monitor = util.create_r_progress_monitor(
+                                self, response, util.logger, loglevel, status_writer
+                            )
+                            options = util.select_options_from_input_list(
+                                args, chick_io.general_options_input
+                            )
+                            if num_tiles > 1:
+                                tiles = tiling.make_tiles(obs_file, num_tiles, subset)
+                                workers = min(tiling.get_workers(), num_cores)
+                                tile_options = tiling.tile_options(
+                                    options, min(workers, len(tiles))
+                                )
+                                with tiling.tile_workdir(
+                                    self.workdir, response.uuid
+                                ) as workdir:
+                                    tile_files = tiling.run_tiles(
+                                        partial(
+                                            ci_tile,
+                                            workdir=workdir,
+                                            engine=engine,
+                                            gcm_file=gcm_file,
+                                            obs_file=obs_file,
+                                            options=tile_options,
+                                            ci_options=ci_options,
+                                        ),
+                                        tiles,
+                                        workers,
+                                        job_id=response.uuid,
+                                    )
+                                    tiling.stitch(
+                                        tile_files,
+                                        tiles,
+                                        output_path,
+                                        options["max_gb"],
+                                    )
+                            elif engine == "numpy":
+                                ci.ci_netcdf(
+                                    gcm_file,
+                                    obs_file,
+                                    output_path,
+                                    *ci_options,
+                                    options,
+                                    progress=r_monitor,
+                                    subset=subset,
+                                )
+                            else:
+                                # ClimDown reads whole files
+                                calibration = (args["start_date"], args["end_date"])
+                                r_pool.run(
+                                    run_ci,
+                                    write_subset(
+                                        subset,
+                                        gcm_file,
+                                        os.path.join(td, "gcm_subset.nc"),
+                                        calibration,
+                                    ),
+                                    write_subset(
+                                        subset,
+                                        obs_file,
+                                        os.path.join(td, "obs_subset.nc"),
+                                    ),
+                                    output_path,
+                                    num_cores,
+                                    general_options,
+                                    ci_options,
+                                    on_console=r_monitor,
+                                )
+                    except (RRuntimeError, ValueError, OSError) as e:
+                        error_handling.custom_process_error(e)
+
+                    util.raise_if_failed(response)
+                    logging.log_handler(
+                        self,
+                        response,
+                        "Building final output",
+                        util.logger,
+                        log_level=loglevel,
+                        process_step="build_output",
+                    )
+
+                    response.outputs["output"].file = output_path
+
+                    logging.log_handler(
+                        self,
+                        response,
+                        "Process Complete",
+                        util.logger,
+                        log_level=loglevel,
+                        process_step="complete",
+                    )
 
-                return response
-        finally:
-            untrack_response(response.uuid)
+                    return response
+            finally:
+                untrack_response(response.uuid)
@@ -1,31 +1,89 @@
+import os
+from functools import partial
 from pywps import Process
 from pywps.app.Common import Metadata
-from rpy2 import robjects
+from pywps.app.exceptions import ProcessError
 from rpy2.rinterface_lib.embedded import RRuntimeError
 
 # PCIC libraries
-from wps_tools import logging, R, io, error_handling
+from wps_tools import logging, io, error_handling
 import chickadee.utils as util
 import chickadee.io as chick_io
+from chickadee import (
+    r_pool,
+    admission,
+    cancellation,
+    cores,
+    cost_model,
+    obs_registry,
+    preflight,
+    staging,
+    tiling,
+)
+from chickadee.engines import qdm
+from chickadee.engines.subset import Subset, write_subset
+
+
+def run_qdm(
+    gcm_file, obs_file, varname, output_file, num_cores, general_options, qdm_options
+):
+    """Run the QDM step in an R worker"""
+    climdown = r_pool.get_package("ClimDown")
+    util.set_general_options(*general_options)
+    util.set_qdm_options(*qdm_options)
+
+    r_pool.register_parallel(num_cores)
+    climdown.qdm_netcdf_wrapper(obs_file, gcm_file, output_file, varname)
+
+
+def qdm_tile(tile, workdir, engine, obs_file, gcm_file, varname, options):
+    """Run QDM on one tile in its own process and return its output file"""
+    output_file = tiling.tile_file(workdir, tile, "qdm.nc")
+    if engine == "numpy":
+        tiling.in_process(
+            qdm.qdm_netcdf, obs_file, gcm_file, output_file, varname, options, 1, tile
+        )
+        return output_file
+
+    calibration = (options["start_date"], options["end_date"])
+    r_pool.run(
+        run_qdm,
+        write_subset(
+            tile, gcm_file, tiling.tile_file(workdir, tile, "gcm.nc"), calibration
+        ),
+        write_subset(tile, obs_file, tiling.tile_file(workdir, tile, "obs.nc")),
+        varname,
+        output_file,
+        1,
+        tuple(
+            util.select_args_from_input_list(options, chick_io.general_options_input)
+        ),
+        tuple(util.select_args_from_input_list(options, chick_io.qdm_options_input)),
+    )
+    return output_file
 
 
 class QDM(Process):
     def __init__(self):
         self.status_percentage_steps = dict(
             logging.common_status_percentages,
-            **{"get_ClimDown": 5, "set_R_options": 10, "parallelization": 15},
+            **{"gather_options": 10},
         )
         self.handler_inputs = [
             chick_io.gcm_file,
             chick_io.obs_file,
+            chick_io.obs_id,
             chick_io.varname,
             chick_io.out_file,
             chick_io.num_cores,
             io.log_level,
+            chick_io.engine,
+            chick_io.num_tiles,
         ]
 
         inputs = (
             self.handler_inputs
+            + chick_io.subset_input
             + chick_io.general_options_input
             + chick_io.qdm_options_input
         )
@@ -51,97 +109,161 @@ class QDM(Process):
         )
 
     def _handler(self, request, response):
-        args = io.collect_args(request.inputs, self.workdir)
-        (
-            gcm_file,
-            obs_file,
-            varname,
-            output_file,
-            num_cores,
-            loglevel,
-        ) = util.select_args_from_input_list(args, self.handler_inputs)
-
-        logging.log_handler(
-            self,
-            response,
-            "Starting Process",
-            util.logger,
-            log_level=loglevel,
-            process_step="start",
-        )
+        with cancellation.tracking(response.uuid):
+            args = staging.collect_args(request.inputs, self.workdir)
+            (
+                gcm_file,
+                obs_file,
+                obs_id,
+                varname,
+                output_file,
+                num_cores,
+                loglevel,
+                engine,
+                num_tiles,
+            ) = util.select_args_from_input_list(args, self.handler_inputs)
+            try:
+                obs_file = obs_registry.get_obs_file(obs_file, obs_id, "cell_major")
+                subset = Subset.from_inputs(
+                    *util.select_args_from_input_list(args, chick_io.subset_input)
+                )
+                preflight.check("qdm", gcm_file, obs_file, varname, varname, args)
+            except ValueError as e:
+                raise ProcessError(f"{type(e).__name__}: {e}")
 
-        logging.log_handler(
-            self,
-            response,
-            "Importing R package 'ClimDown'",
-            util.logger,
-            log_level=loglevel,
-            process_step="get_ClimDown",
-        )
-        climdown = R.get_package("ClimDown")
-
-        logging.log_handler(
-            self,
-            response,
-            "Setting R options",
-            util.logger,
-            log_level=loglevel,
-            process_step="set_R_options",
-        )
-        util.set_general_options(
-            *util.select_args_from_input_list(args, chick_io.general_options_input)
-        )
-        util.set_qdm_options(
-            *util.select_args_from_input_list(args, chick_io.qdm_options_input)
-        )
+            logging.log_handler(
+                self,
+                response,
+                "Starting Process",
+                util.logger,
+                log_level=loglevel,
+                process_step="start",
+            )
 
-        # Set parallelization
-        logging.log_handler(
-            self,
-            response,
-            "Setting parallelization",
-            util.logger,
-            log_level=loglevel,
-            process_step="parallelization",
-        )
-        doPar = R.get_package("doParallel")
-        doPar.registerDoParallel(cores=num_cores)
-
-        logging.log_handler(
-            self,
-            response,
-            "Processing QDM",
-            util.logger,
-            log_level=loglevel,
-            process_step="process",
-        )
-        try:
-            climdown.qdm_netcdf_wrapper(obs_file, gcm_file, output_file, varname)
-        except RRuntimeError as e:
-            error_handling.custom_process_error(e)
-
-        # stop parallelization
-        doPar.stopImplicitCluster()
-
-        logging.log_handler(
-            self,
-            response,
-            "Building final output",
-            util.logger,
-            log_level=loglevel,
-            process_step="build_output",
-        )
-        response.outputs["output"].file = output_file
-
-        # Clear R global env
-        robjects.r("rm(list=ls())")
-
-        logging.log_handler(
-            self,
-            response,
-            "Process Complete",
-            util.logger,
-            log_level=loglevel,
-            process_step="complete",
-        )
-        return response
+            logging.log_handler(
+                self,
+                response,
+                "Gathering options",
+                util.logger,
+                log_level=loglevel,
+                process_step="gather_options",
+            )
+            general_options = tuple(
+                util.select_args_from_input_list(args, chick_io.general_options_input)
+            )
+            qdm_options = tuple(
+                util.select_args_from_input_list(args, chick_io.qdm_options_input)
+            )
+
+            logging.log_handler(
+                self,
+                response,
+                "Processing QDM",
+                util.logger,
+                log_level=loglevel,
+                process_step="process",
+            )
+            options = util.select_options_from_input_list(
+                args, chick_io.general_options_input + chick_io.qdm_options_input
+            )
+            try:
+                job = cost_model.describe(
+                    "qdm",
+                    engine,
+                    gcm_file,
+                    obs_file,
+                    args["max_gb"],
+                    num_cores,
+                    varname,
+                    varname,
+                    subset,
+                    (args["start_date"], args["end_date"]),
+                )
+                with (
+                    cores.reserve(num_cores) as num_cores,
+                    admission.admit(
+                        cost_model.peak_gb(job._replace(num_cores=num_cores)),
+                        response.uuid,
+                    ),
+                    cost_model.timed(job._replace(num_cores=num_cores)),
+                ):
+                    if num_tiles > 1:
+                        tiles = tiling.make_tiles(obs_file, num_tiles, subset)
+                        workers = min(tiling.get_workers(), num_cores)
+                        tile_options = tiling.tile_options(
+                            options, min(workers, len(tiles))
+                        )
+                        with tiling.tile_workdir(
+                            self.workdir, response.uuid
+                        ) as workdir:
+                            tile_files = tiling.run_tiles(
+                                partial(
+                                    qdm_tile,
+                                    workdir=workdir,
+                                    engine=engine,
+                                    obs_file=obs_file,
+                                    gcm_file=gcm_file,
+                                    varname=varname,
+                                    options=tile_options,
+                                ),
+                                tiles,
+                                workers,
+                                job_id=response.uuid,
+                            )
+                            tiling.stitch(
+                                tile_files, tiles, output_file, options["max_gb"]
+                            )
+                    elif engine == "numpy":
+                        qdm.qdm_netcdf(
+                            obs_file,
+                            gcm_file,
+                            output_file,
+                            varname,
+                            options,
+                            num_cores,
+                            subset,
+                        )
+                    else:
+                        # ClimDown reads whole files
+                        calibration = (args["start_date"], args["end_date"])
+                        r_pool.run(
+                            run_qdm,
+                            write_subset(
+                                subset,
+                                gcm_file,
+                                os.path.join(self.workdir, "gcm_subset.nc"),
+                                calibration,
+                            ),
+                            write_subset(
+                                subset,
+                                obs_file,
+                                os.path.join(self.workdir, "obs_subset.nc"),
+                            ),
+                            varname,
+                            output_file,
+                            num_cores,
+                            general_options,
+                            qdm_options,
+                        )
+            except (RRuntimeError, ValueError, OSError) as e:
+                error_handling.custom_process_error(e)
+
+            logging.log_handler(
+                self,
+                response,
+                "Building final output",
+                util.logger,
+                log_level=loglevel,
+                process_step="build_output",
+            )
+            response.outputs["output"].file = output_file
+
+            logging.log_handler(
+                self,
+                response,
+                "Process Complete",
+                util.logger,
+                log_level=loglevel,
+                process_step="complete",
+            )
+            return response
@@ -0,0 +1,118 @@
+from pywps import Process, LiteralInput, LiteralOutput
+from pywps.app.Common import Metadata
+from pywps.app.exceptions import ProcessError
+
+# PCIC libraries
+import chickadee.utils as util
+import chickadee.io as chick_io
+from chickadee import cancellation, cost_model, obs_registry, staging
+from chickadee.engines.subset import Subset
+
+
+class Estimate(Process):
+    def __init__(self):
+        self.handler_inputs = [
+            LiteralInput(
+                "process",
+                "Process",
+                abstract="Process to estimate the cost of a request to",
+                min_occurs=1,
+                max_occurs=1,
+                allowed_values=["ca", "ci", "qdm", "rerank", "bccaq"],
+                data_type="string",
+            ),
+            chick_io.gcm_file,
+            chick_io.obs_file,
+            chick_io.obs_id,
+            chick_io.varname,
+            chick_io.num_cores,
+            chick_io.engine,
+        ]
+
+        inputs = (
+            self.handler_inputs + chick_io.subset_input + chick_io.general_options_input
+        )
+
+        outputs = [
+            LiteralOutput(
+                "wall_time",
+                "Wall time",
+                abstract="Predicted wall time of the request in seconds",
+                data_type="float",
+            ),
+            LiteralOutput(
+                "peak_memory_gb",
+                "Peak memory",
+                abstract="Predicted peak memory of the request in GB",
+                data_type="float",
+            ),
+            LiteralOutput(
+                "output_gb",
+                "Output size",
+                abstract="Predicted size of the output in GB",
+                data_type="float",
+            ),
+            LiteralOutput(
+                "runs",
+                "Recorded runs",
+                abstract="Number of recorded runs the wall time is fitted to, 0 if it uses the default rates",
+                data_type="integer",
+            ),
+        ]
+
+        super(Estimate, self).__init__(
+            self._handler,
+            identifier="estimate",
+            title="Estimate",
+            abstract="Predict the wall time, peak memory and output size of a request to another process from the headers of its inputs. For rerank, give the QDM output as gcm_file.",
+            keywords=["estimate", "cost"],
+            metadata=[
+                Metadata("NetCDF processing"),
+                Metadata("PyWPS", "https://pywps.org/"),
+                Metadata("Birdhouse", "http://bird-house.github.io/"),
+            ],
+            inputs=inputs,
+            outputs=outputs,
+            store_supported=True,
+            status_supported=True,
+        )
+
+    def _handler(self, request, response):
+        with cancellation.tracking(response.uuid):
+            # Remote inputs are not fetched, OPeNDAP only sends their headers
+            args = staging.collect_args(
+                request.inputs, self.workdir, remote_in_place=True
+            )
+            (
+                process,
+                gcm_file,
+                obs_file,
+                obs_id,
+                varname,
+                num_cores,
+                engine,
+            ) = util.select_args_from_input_list(args, self.handler_inputs)
+            try:
+                obs_file = obs_registry.get_obs_file(obs_file, obs_id, "cell_major")
+                subset = Subset.from_inputs(
+                    *util.select_args_from_input_list(args, chick_io.subset_input)
+                )
+                job = cost_model.describe(
+                    process,
+                    engine,
+                    gcm_file,
+                    obs_file,
+                    args["max_gb"],
+                    num_cores,
+                    varname,
+                    varname,
+                    subset,
+                    (args["start_date"], args["end_date"]),
+                )
+                estimate = cost_model.estimate(job)
+            except (ValueError, OSError) as e:
+                raise ProcessError(f"{type(e).__name__}: {e}")
+
+            for name, value in estimate.items():
+                response.outputs[name].data = value
+            return response
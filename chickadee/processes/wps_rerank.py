@@ -1,3 +1,5 @@
+import os
+from functools import partial
 from rpy2 import robjects
 from rpy2.rinterface_lib.embedded import RRuntimeError
 from pywps.app.exceptions import ProcessError
@@ -8,6 +10,87 @@ from pywps.app.Common import Metadata
 from wps_tools import logging, R, io, error_handling
 import chickadee.utils as util
 import chickadee.io as chick_io
+from chickadee import (
+    r_pool,
+    admission,
+    cancellation,
+    cores,
+    cost_model,
+    obs_registry,
+    preflight,
+    staging,
+    tiling,
+)
+from chickadee.processes.wps_CA import get_analogue_cache
+from chickadee.engines.subset import Subset, write_subset
+
+
+def read_analogues_file(analogues, analogues_name):
+    try:
+        return R.load_rdata_to_python(analogues, analogues_name)
+    except (RRuntimeError, ProcessError, IndexError):
+        pass
+
+    try:
+        return robjects.r(f"readRDS('{analogues}')")
+    except (RRuntimeError, ProcessError) as e:
+        raise ProcessError(
+            f"{type(e).__name__}: Analogues file must be a RDS file or "
+            "a Rdata file containing an object of the given name"
+        )
+
+
+def run_rerank(
+    obs_file,
+    varname,
+    out_file,
+    num_cores,
+    qdm_file,
+    analogues_object,
+    analogues_name,
+    general_options,
+):
+    """Run the Rerank step in an R worker"""
+    climdown = r_pool.get_package("ClimDown")
+    util.set_general_options(*general_options)
+
+    r_pool.register_parallel(num_cores)
+    analogues = read_analogues_file(analogues_object, analogues_name)
+    climdown.rerank_netcdf_wrapper(qdm_file, obs_file, analogues, out_file, varname)
+
+
+def rerank_tile(
+    tile,
+    workdir,
+    obs_file,
+    qdm_file,
+    varname,
+    analogues_object,
+    analogues_name,
+    options,
+):
+    """Run Rerank on one tile in an R worker and return its output file"""
+    output_file = tiling.tile_file(workdir, tile, "rerank.nc")
+    calibration = (options["start_date"], options["end_date"])
+    r_pool.run(
+        run_rerank,
+        write_subset(tile, obs_file, tiling.tile_file(workdir, tile, "obs.nc")),
+        varname,
+        output_file,
+        1,
+        write_subset(
+            tile,
+            qdm_file,
+            tiling.tile_file(workdir, tile, "qdm_subset.nc"),
+            calibration,
+        ),
+        analogues_object,
+        analogues_name,
+        tuple(
+            util.select_args_from_input_list(options, chick_io.general_options_input)
+        ),
+    )
+    return output_file
 
 
 class Rerank(Process):
@@ -18,11 +101,12 @@ class Rerank(Process):
     def __init__(self):
         self.status_percentage_steps = dict(
             logging.common_status_percentages,
-            **{"get_ClimDown": 5, "set_R_options": 10, "parallelization": 15},
+            **{"gather_options": 10},
         )
 
         self.handler_inputs = [
             chick_io.obs_file,
+            chick_io.obs_id,
             chick_io.varname,
             chick_io.out_file,
             chick_io.num_cores,
@@ -39,7 +123,7 @@ class Rerank(Process):
                 "analogues_object",
                 "Analogues R object",
                 abstract="Rdata or RDS file containing the analogues produced from the CA step",
-                min_occurs=1,
+                min_occurs=0,
                 max_occurs=1,
                 supported_formats=[Format("application/x-gzip", encoding="base64")],
             ),
@@ -53,8 +137,20 @@ class Rerank(Process):
                 max_occurs=1,
                 data_type="string",
             ),
+            LiteralInput(
+                "analogues_ref",
+                "Analogues cache reference",
+                abstract="Reference to cached analogues returned by CA (analogues_ref), "
+                "used instead of an analogues_object",
+                min_occurs=0,
+                max_occurs=1,
+                data_type="string",
+            ),
+            chick_io.num_tiles,
         ]
-        inputs = self.handler_inputs + chick_io.general_options_input
+        inputs = (
+            self.handler_inputs + chick_io.subset_input + chick_io.general_options_input
+        )
 
         outputs = [io.nc_output]
 
@@ -78,116 +174,173 @@ class Rerank(Process):
             status_supported=True,
         )
 
-    def read_analogues_file(self, analogues, analogues_name):
-        try:
-            return R.load_rdata_to_python(analogues, analogues_name)
-        except (RRuntimeError, ProcessError, IndexError):
-            pass
-
-        try:
-            return robjects.r(f"readRDS('{analogues}')")
-        except (RRuntimeError, ProcessError) as e:
-            raise ProcessError(
-                f"{type(e).__name__}: Analogues file must be a RDS file or "
-                "a Rdata file containing an object of the given name"
-            )
-
     def _handler(self, request, response):
-        args = io.collect_args(request.inputs, self.workdir)
-        (
-            obs_file,
-            varname,
-            out_file,
-            num_cores,
-            loglevel,
-            qdm_file,
-            analogues_object,
-            analogues_name,
-        ) = util.select_args_from_input_list(args, self.handler_inputs)
-
-        logging.log_handler(
-            self,
-            response,
-            "Starting Process",
-            util.logger,
-            log_level=loglevel,
-            process_step="start",
-        )
+        with cancellation.tracking(response.uuid):
+            args = staging.collect_args(request.inputs, self.workdir)
+            (
+                obs_file,
+                obs_id,
+                varname,
+                out_file,
+                num_cores,
+                loglevel,
+                qdm_file,
+                analogues_object,
+                analogues_name,
+                analogues_ref,
+                num_tiles,
+            ) = util.select_args_from_input_list(args, self.handler_inputs)
+            try:
+                obs_file = obs_registry.get_obs_file(obs_file, obs_id, "cell_major")
+                subset = Subset.from_inputs(
+                    *util.select_args_from_input_list(args, chick_io.subset_input)
+                )
+                preflight.check("rerank", qdm_file, obs_file, varname, varname, args)
+            except ValueError as e:
+                raise ProcessError(f"{type(e).__name__}: {e}")
 
-        logging.log_handler(
-            self,
-            response,
-            "Importing R package 'ClimDown'",
-            util.logger,
-            log_level=loglevel,
-            process_step="get_ClimDown",
-        )
-        climdown = R.get_package("ClimDown")
-
-        logging.log_handler(
-            self,
-            response,
-            "Setting R options",
-            util.logger,
-            log_level=loglevel,
-            process_step="set_R_options",
-        )
-        util.set_general_options(
-            *util.select_args_from_input_list(args, chick_io.general_options_input)
-        )
+            logging.log_handler(
+                self,
+                response,
+                "Starting Process",
+                util.logger,
+                log_level=loglevel,
+                process_step="start",
+            )
 
-        logging.log_handler(
-            self,
-            response,
-            "Setting parallelization",
-            util.logger,
-            log_level=loglevel,
-            process_step="parallelization",
-        )
-        doPar = R.get_package("doParallel")
-        doPar.registerDoParallel(cores=num_cores)
-
-        logging.log_handler(
-            self,
-            response,
-            "Applying quantile mapping bias correction",
-            util.logger,
-            log_level=loglevel,
-            process_step="process",
-        )
+            logging.log_handler(
+                self,
+                response,
+                "Gathering options",
+                util.logger,
+                log_level=loglevel,
+                process_step="gather_options",
+            )
+            general_options = tuple(
+                util.select_args_from_input_list(args, chick_io.general_options_input)
+            )
 
-        analogues = self.read_analogues_file(analogues_object, analogues_name)
+            if analogues_ref:
+                try:
+                    analogues_object = get_analogue_cache().get(
+                        analogues_ref, os.path.join(self.workdir, "analogues.rds")
+                    )
+                except ValueError as e:
+                    raise ProcessError(f"{type(e).__name__}: {e}")
+                if not analogues_object:
+                    raise ProcessError(
+                        f"No cached analogues found for reference '{analogues_ref}'"
+                    )
+            elif not analogues_object:
+                raise ProcessError(
+                    "Either analogues_object or analogues_ref is required"
+                )
 
-        try:
-            climdown.rerank_netcdf_wrapper(
-                qdm_file, obs_file, analogues, out_file, varname
+            logging.log_handler(
+                self,
+                response,
+                "Applying quantile mapping bias correction",
+                util.logger,
+                log_level=loglevel,
+                process_step="process",
             )
-        except RRuntimeError as e:
-            error_handling.custom_process_error(e)
-
-        # Stop parallelization
-        doPar.stopImplicitCluster()
-
-        logging.log_handler(
-            self,
-            response,
-            "Building final output",
-            util.logger,
-            log_level=loglevel,
-            process_step="build_output",
-        )
 
-        response.outputs["output"].file = out_file
+            try:
+                job = cost_model.describe(
+                    "rerank",
+                    "climdown",
+                    qdm_file,
+                    obs_file,
+                    args["max_gb"],
+                    num_cores,
+                    varname,
+                    varname,
+                    subset,
+                    (args["start_date"], args["end_date"]),
+                )
+                with (
+                    cores.reserve(num_cores) as num_cores,
+                    admission.admit(
+                        cost_model.peak_gb(job._replace(num_cores=num_cores)),
+                        response.uuid,
+                    ),
+                    cost_model.timed(job._replace(num_cores=num_cores)),
+                ):
+                    if num_tiles > 1:
+                        options = util.select_options_from_input_list(
+                            args, chick_io.general_options_input
+                        )
+                        tiles = tiling.make_tiles(obs_file, num_tiles, subset)
+                        workers = min(tiling.get_workers(), num_cores)
+                        tile_options = tiling.tile_options(
+                            options, min(workers, len(tiles))
+                        )
+                        with tiling.tile_workdir(
+                            self.workdir, response.uuid
+                        ) as workdir:
+                            tile_files = tiling.run_tiles(
+                                partial(
+                                    rerank_tile,
+                                    workdir=workdir,
+                                    obs_file=obs_file,
+                                    qdm_file=qdm_file,
+                                    varname=varname,
+                                    analogues_object=analogues_object,
+                                    analogues_name=analogues_name,
+                                    options=tile_options,
+                                ),
+                                tiles,
+                                workers,
+                                job_id=response.uuid,
+                            )
+                            tiling.stitch(
+                                tile_files, tiles, out_file, options["max_gb"]
+                            )
+                    else:
+                        # ClimDown reads whole files. The analogues index the
+                        # timesteps of the observations, which are never subset in
+                        # time.
+                        calibration = (args["start_date"], args["end_date"])
+                        r_pool.run(
+                            run_rerank,
+                            write_subset(
+                                subset,
+                                obs_file,
+                                os.path.join(self.workdir, "obs_subset.nc"),
+                            ),
+                            varname,
+                            out_file,
+                            num_cores,
+                            write_subset(
+                                subset,
+                                qdm_file,
+                                os.path.join(self.workdir, "qdm_subset.nc"),
+                                calibration,
+                            ),
+                            analogues_object,
+                            analogues_name,
+                            general_options,
+                        )
+            except (RRuntimeError, ValueError, OSError) as e:
+                error_handling.custom_process_error(e)
 
-        # Clear R global env
-        robjects.r("rm(list=ls())")
+            logging.log_handler(
+                self,
+                response,
+                "Building final output",
+                util.logger,
+                log_level=loglevel,
+                process_step="build_output",
+            )
 
-        logging.log_handler(
-            self,
-            response,
-            "Process Complete",
-            util.logger,
-            log_level=loglevel,
-            process_step="complete",
-        )
-        return response
+            response.outputs["output"].file = out_file
+
+            logging.log_handler(
+                self,
+                response,
+                "Process Complete",
+                util.logger,
+                log_level=loglevel,
+                process_step="complete",
+            )
+            return response
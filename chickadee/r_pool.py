@@ -0,0 +1,491 @@
+"""Pool of long-lived R worker processes.
+
+Every worker is a separate Python process with its own embedded R
+interpreter. It attaches ClimDown, ncdf4 and doParallel once at start-up and
+then serves jobs one at a time over a Unix socket, so requests no longer pay
+for package loading on every execution.
+
+Jobs are plain module-level functions which are pickled by reference and run
+inside the worker. Anything they print to the R console is streamed back to
+the caller, which lets the handlers keep monitoring ClimDown's progress.
+
+Every job gets a clean R session: the worker restores the R options it had
+after start-up and clears the global environment once a job finishes, so
+concurrent requests never see each other's ``options(...)``. With
+``r_isolation = process`` each job instead runs in a fresh worker process
+that exits afterwards.
+
+Each worker also keeps a persistent doParallel cluster between jobs instead
+of forking a new set of R processes for every request. The cluster has
+``max_cores`` processes and every job registers only the first ``num_cores``
+of them, so jobs asking for different numbers of cores share it. The cluster
+is health checked before it is reused and recycled after a configurable
+number of jobs.
+"""
+
+import os
+import sys
+import json
+import time
+import fcntl
+import atexit
+import pickle
+import shutil
+import socket
+import signal
+import subprocess
+import multiprocessing
+from contextlib import contextmanager
+from multiprocessing.connection import Client, Connection
+from pywps import configuration
+
+import chickadee.utils as util
+from chickadee import cores
+
+
+PACKAGES = ["ClimDown", "ncdf4", "doParallel"]
+
+# Set in the environment of worker processes so that importing chickadee
+# inside a worker does not start a pool of its own
+WORKER_ENV = "CHICKADEE_R_WORKER"
+
+ACCEPT_TIMEOUT = 5
+STARTUP_TIMEOUT = 300
+INTERRUPT_TIMEOUT = 30
+ACQUIRE_POLL = 0.2
+
+# Packages attached in this process when it is running as a worker
+_packages = {}
+
+# Persistent doParallel cluster of this worker
+_cluster = None
+_cluster_jobs = 0
+_settings = {"cluster_type": "PSOCK", "cluster_max_jobs": 50, "cluster_cores": 1}
+
+_MAKE_CLUSTER = """
+function(cores, type) {
+    cl <- parallel::makeCluster(cores, type = type)
+    parallel::clusterEvalQ(cl, { library(ClimDown); library(ncdf4) })
+    cl
+}
+"""
+
+# Options the cluster processes need to see the same way as the worker
+_CLUSTER_OPTIONS = [
+    "max.GB",
+    "check.units",
+    "check.neg.precip",
+    "target.units",
+    "calibration.start",
+    "calibration.end",
+    "trimmed.mean",
+    "delta.days",
+    "n.analogues",
+    "tol",
+    "gcm.varname",
+    "obs.varname",
+    "multiyear",
+    "expand.multiyear",
+    "multiyear.window.length",
+    "trace",
+    "jitter.factor",
+    "tau",
+    "seasonal",
+    "ratio",
+]
+
+_SYNC_OPTIONS = """
+function(cl, names) {
+    invisible(parallel::clusterCall(cl, function(o) { options(o); NULL }, options()[names]))
+}
+"""
+
+_CLUSTER_NODES = """
+function(cl, cores) cl[seq_len(min(cores, length(cl)))]
+"""
+
+_CLUSTER_HEALTHY = """
+function(cl) {
+    tryCatch(all(unlist(parallel::clusterCall(cl, function() TRUE))),
+             error = function(e) FALSE)
+}
+"""
+
+
+def get_package(name):
+    """Return an R package, reusing the handle attached at worker start-up"""
+    if name not in _packages:
+        from wps_tools import R
+
+        _packages[name] = R.get_package(name)
+    return _packages[name]
+
+
+def register_parallel(num_cores):
+    """Register ``num_cores`` processes of this worker's doParallel cluster
+    for a job.
+
+    Must be called after the job's R options are set, they are copied to the
+    cluster processes. The cluster is only started again when it has served
+    ``cluster_max_jobs`` jobs or when one of its processes died.
+    """
+    global _cluster, _cluster_jobs
+    from rpy2 import robjects
+
+    if _cluster is not None and (
+        _cluster_jobs >= _settings["cluster_max_jobs"]
+        or not robjects.r(_CLUSTER_HEALTHY)(_cluster)[0]
+    ):
+        stop_parallel()
+
+    if _cluster is None:
+        cluster_cores = _settings["cluster_cores"]
+        util.logger.info(f"Starting doParallel cluster with {cluster_cores} cores")
+        _cluster = robjects.r(_MAKE_CLUSTER)(cluster_cores, _settings["cluster_type"])
+        _cluster_jobs = 0
+
+    robjects.r(_SYNC_OPTIONS)(_cluster, robjects.StrVector(_CLUSTER_OPTIONS))
+    get_package("doParallel").registerDoParallel(
+        robjects.r(_CLUSTER_NODES)(_cluster, num_cores)
+    )
+    _cluster_jobs += 1
+
+
+def stop_parallel():
+    global _cluster
+    from rpy2 import robjects
+
+    if _cluster is not None:
+        try:
+            robjects.r("parallel::stopCluster")(_cluster)
+        except Exception as e:
+            util.logger.warning(f"Failed to stop doParallel cluster: {e}")
+        _cluster = None
+
+
+class RWorkerPool:
+    """Fixed number of R worker slots shared by every process of the service.
+
+    Slots are claimed with ``flock`` on a lock file, so the pool can be used
+    from the forked processes pywps runs asynchronous requests in. A slot whose
+    worker is not reachable is restarted by whoever claims it next.
+    """
+
+    def __init__(self, size, isolation="pool", settings=None):
+        self.size = size
+        self.isolation = isolation
+        self.settings = dict(_settings, **(settings or {}))
+        self.service_pid = os.getpid()
+        self.runtime_dir = util.get_runtime_dir(f"r-workers-{self.service_pid}")
+        self._procs = {}
+
+    def address(self, slot):
+        return os.path.join(self.runtime_dir, f"worker-{slot}.sock")
+
+    def start(self):
+        if self.isolation == "process":
+            return
+        for slot in range(self.size):
+            if not self._reachable(slot):
+                self._spawn(slot)
+
+    def stop(self):
+        """Stop the workers and remove the runtime directory of the pool"""
+        for slot in range(self.size):
+            pid = self._pid(slot)
+            if pid:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            self._reap(slot)
+        shutil.rmtree(self.runtime_dir, ignore_errors=True)
+
+    def run(self, fn, *args, on_console=None, **kwargs):
+        """Run ``fn(*args, **kwargs)`` in an R worker and return its result.
+
+        ``on_console`` is called with every chunk of text the job writes to
+        the R console. If it raises, the job is interrupted and the exception
+        is propagated.
+        """
+        with self._acquire() as slot:
+            conn = self._connect(slot)
+            try:
+                conn.send((fn, args, kwargs))
+                return self._receive(slot, conn, on_console)
+            finally:
+                conn.close()
+                if self.isolation == "process":
+                    self._reap(slot)
+
+    def _receive(self, slot, conn, on_console):
+        try:
+            while True:
+                kind, payload = conn.recv()
+                if kind == "done":
+                    return payload
+                if kind == "error":
+                    error = pickle.loads(payload)
+                    break
+                if on_console:
+                    on_console(payload)
+        except BaseException:
+            self._interrupt(slot, conn)
+            raise
+        raise error
+
+    def _interrupt(self, slot, conn):
+        # Stop the running job but keep the warm worker if it recovers in time
+        util.logger.info(f"Interrupting R worker {slot}")
+        pid = self._pid(slot)
+        if pid:
+            try:
+                os.kill(pid, signal.SIGINT)
+            except ProcessLookupError:
+                return
+        deadline = time.monotonic() + INTERRUPT_TIMEOUT
+        try:
+            while conn.poll(max(deadline - time.monotonic(), 0)):
+                kind, _ = conn.recv()
+                if kind in ("done", "error"):
+                    return
+        except (EOFError, OSError):
+            return
+        util.logger.warning(f"R worker {slot} did not stop, killing it")
+        if pid:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    @contextmanager
+    def _acquire(self):
+        while True:
+            for slot in range(self.size):
+                fd = os.open(self.address(slot) + ".lock", os.O_CREAT | os.O_RDWR)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    os.close(fd)
+                    continue
+                try:
+                    yield slot
+                    return
+                finally:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                    os.close(fd)
+            time.sleep(ACQUIRE_POLL)
+
+    def _connect(self, slot):
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while True:
+            if not self._reachable(slot):
+                self._spawn(slot)
+            try:
+                return Client(self.address(slot), family="AF_UNIX")
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"R worker {slot} failed to start")
+                time.sleep(ACQUIRE_POLL)
+
+    def _reap(self, slot):
+        spawner, proc = self._procs.pop(slot, (None, None))
+        if spawner == os.getpid():
+            try:
+                proc.wait(INTERRUPT_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+
+    def _pid(self, slot):
+        try:
+            with open(self.address(slot) + ".pid") as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def _reachable(self, slot):
+        # Only the process that spawned a worker can reap it
+        spawner, proc = self._procs.get(slot, (None, None))
+        if spawner == os.getpid() and proc.poll() is not None:
+            del self._procs[slot]
+            return False
+        pid = self._pid(slot)
+        if not pid:
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        return True
+
+    def _spawn(self, slot):
+        util.logger.info(f"Starting R worker {slot}")
+        try:
+            os.unlink(self.address(slot))
+        except FileNotFoundError:
+            pass
+        proc = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "chickadee.r_pool",
+                self.address(slot),
+                str(self.service_pid),
+                json.dumps(dict(self.settings, once=self.isolation == "process")),
+            ],
+            env=dict(os.environ, **{WORKER_ENV: "1"}),
+            start_new_session=True,
+        )
+        self._procs[slot] = (os.getpid(), proc)
+        with open(self.address(slot) + ".pid", "w") as f:
+            f.write(str(proc.pid))
+
+
+_pool = None
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        # One worker per job pywps may run at the same time unless configured
+        size = int(
+            configuration.get_config_value("chickadee", "r_workers")
+            or configuration.get_config_value("server", "parallelprocesses", 2)
+        )
+        isolation = configuration.get_config_value("chickadee", "r_isolation") or "pool"
+        settings = {
+            "cluster_type": configuration.get_config_value(
+                "chickadee", "r_cluster_type", "PSOCK"
+            ),
+            "cluster_max_jobs": int(
+                configuration.get_config_value("chickadee", "r_cluster_max_jobs", 50)
+            ),
+            # Workers do not load the configuration of the service
+            "cluster_cores": cores.get_max_cores(),
+        }
+        _pool = RWorkerPool(size, isolation, settings)
+        atexit.register(stop_pool)
+    return _pool
+
+
+def start_pool():
+    """Pre-warm the R workers once the configuration of the service is
+    loaded"""
+    # Workers and spawned engine processes import chickadee too
+    if os.environ.get(WORKER_ENV) or multiprocessing.parent_process():
+        return
+    get_pool().start()
+
+
+def stop_pool():
+    """Stop the R workers at service shutdown"""
+    global _pool
+    # Forked request processes inherit the pool but do not own it
+    if _pool is None or _pool.service_pid != os.getpid():
+        return
+    _pool.stop()
+    _pool = None
+
+
+def run(fn, *args, on_console=None, **kwargs):
+    return get_pool().run(fn, *args, on_console=on_console, **kwargs)
+
+
+def _restore_options(default_options):
+    from rpy2 import robjects
+
+    robjects.r(
+        """
+        function(saved) {
+            added <- setdiff(names(options()), names(saved))
+            options(saved)
+            if (length(added) > 0) options(sapply(added, function(x) NULL))
+        }
+        """
+    )(default_options)
+
+
+def _send_error(conn, e):
+    try:
+        payload = pickle.dumps(e)
+    except Exception:
+        payload = pickle.dumps(RuntimeError(f"{type(e).__name__}: {e}"))
+    conn.send(("error", payload))
+
+
+def _serve_job(conn, default_options):
+    from rpy2 import robjects
+    from rpy2.rinterface_lib import callbacks
+
+    original_console_write = callbacks.consolewrite_print
+    callbacks.consolewrite_print = lambda text: conn.send(("console", text))
+    try:
+        # A job that fails to unpickle, or a result that fails to pickle, is
+        # reported to the service like any other error of the job
+        fn, args, kwargs = conn.recv()
+        result = fn(*args, **kwargs)
+        conn.send(("done", result))
+    except BaseException as e:
+        # Raises in turn when the service is gone
+        _send_error(conn, e)
+    finally:
+        callbacks.consolewrite_print = original_console_write
+        # Leave a clean session for the next job
+        robjects.r("rm(list=ls())")
+        _restore_options(default_options)
+
+
+def serve(address, service_pid, settings):
+    from rpy2 import robjects
+
+    _settings.update(settings)
+
+    for name in PACKAGES:
+        get_package(name)
+    default_options = robjects.r("options()")
+
+    # Interrupts are delivered to R while a job runs; between jobs ignore them
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(address)
+    server.listen(1)
+    server.settimeout(ACCEPT_TIMEOUT)
+    util.logger.info(f"R worker {os.getpid()} ready on {address}")
+
+    while True:
+        try:
+            client, _ = server.accept()
+        except socket.timeout:
+            try:
+                os.kill(service_pid, 0)
+            except ProcessLookupError:
+                break
+            continue
+
+        client.setblocking(True)
+        conn = Connection(client.detach())
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        try:
+            _serve_job(conn, default_options)
+        except (EOFError, OSError):
+            pass
+        except KeyboardInterrupt:
+            util.logger.info("R worker job interrupted")
+        finally:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            conn.close()
+        if settings.get("once"):
+            break
+
+    stop_parallel()
+    server.close()
+    os.unlink(address)
+
+
+if __name__ == "__main__":
+    # Serve from the imported module so job functions share its packages
+    from chickadee import r_pool
+
+    r_pool.serve(sys.argv[1], int(sys.argv[2]), json.loads(sys.argv[3]))
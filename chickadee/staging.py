@@ -0,0 +1,137 @@
+"""Staging of the inputs of a request.
+
+``wps_tools.io.collect_args`` materializes every ComplexInput in the workdir
+of the request. For inputs that are already on the server, given as
+``file://`` references or plain absolute paths below ``allowedinputpaths``,
+that is a full copy of files that can be many GB. ``collect_args`` hands
+those to the steps in place instead, which only ever read their inputs.
+Remote inputs come from the input cache (see ``chickadee.input_cache``).
+
+The ``input_staging`` setting picks how local inputs are staged:
+
+- ``path``: pass the original path (the default)
+- ``symlink``: link the original file into the workdir
+- ``copy``: copy the file into the workdir, as ``wps_tools`` does
+"""
+
+import os
+import shutil
+from collections import OrderedDict
+from urllib.parse import urlparse
+from pywps import configuration
+from pywps.app.exceptions import ProcessError
+from wps_tools import io
+
+import chickadee.utils as util
+from chickadee import input_cache
+
+
+STAGING_MODES = ("path", "symlink", "copy")
+
+
+def get_staging_mode():
+    mode = configuration.get_config_value("chickadee", "input_staging") or "path"
+    if mode not in STAGING_MODES:
+        util.logger.warning(f"Unknown input_staging '{mode}', using 'path'")
+        return "path"
+    return mode
+
+
+def allowed_input_paths():
+    paths = configuration.get_config_value("server", "allowedinputpaths") or ""
+    return [
+        os.path.realpath(path.strip())
+        for path in paths.split(os.pathsep)
+        if path.strip()
+    ]
+
+
+def _inside(path, directory):
+    return os.path.commonpath([path, directory]) == directory
+
+
+def is_allowed(path):
+    """Whether ``path``, with its symlinks resolved, is inside one of the
+    ``allowedinputpaths``"""
+    path = os.path.realpath(path)
+    return any(_inside(path, allowed) for allowed in allowed_input_paths())
+
+
+def local_source(input_, workdir):
+    """Path of the file on the server a ComplexInput refers to, or ``None``
+    for data sent with the request, remote references and files pywps already
+    placed in ``workdir``"""
+    prop = getattr(input_, "prop", None)
+    if prop == "file":
+        # pywps links file:// references into the workdir, or copies them
+        # where it cannot link
+        path = os.path.realpath(input_.file)
+        return None if _inside(path, os.path.realpath(workdir)) else path
+    if prop == "url":
+        parsed = urlparse(input_.url)
+        if parsed.scheme in ("", "file") and os.path.isabs(parsed.path):
+            return parsed.path
+    return None
+
+
+def stage(source, identifier, workdir, mode):
+    if not is_allowed(source):
+        raise ProcessError(f"Input {source} is not in allowedinputpaths")
+    if not os.path.isfile(source):
+        raise ProcessError(f"Input {source} does not exist")
+    if mode == "path":
+        return source
+
+    # Inputs from different directories may share a file name
+    dest = os.path.join(workdir, f"{identifier}_{os.path.basename(source)}")
+    if os.path.lexists(dest):
+        os.remove(dest)
+    if mode == "symlink":
+        os.symlink(source, dest)
+    else:
+        shutil.copyfile(source, dest)
+    return dest
+
+
+def remote_url(input_):
+    if getattr(input_, "prop", None) == "url" and input_cache.is_remote(input_.url):
+        return input_.url
+    return None
+
+
+def fetch_remote(input_, identifier, workdir):
+    url = input_.url
+    name = f"{identifier}_{os.path.basename(urlparse(url).path) or 'input.nc'}"
+    try:
+        return input_cache.fetch(
+            url, os.path.join(workdir, name), input_cache.is_opendap(input_)
+        )
+    except OSError as e:
+        raise ProcessError(f"Could not fetch {url}: {e}")
+
+
+def collect_args(inputs, workdir, remote_in_place=False):
+    """``wps_tools.io.collect_args`` with the inputs that are local files
+    staged according to ``input_staging``. With ``remote_in_place``, remote
+    inputs are passed on as their URLs, e.g. to read only their headers."""
+    mode = get_staging_mode()
+    cache_remote = input_cache.is_enabled()
+    local = OrderedDict()
+    for identifier, values in inputs.items():
+        if len(values) != 1:
+            continue
+        source = local_source(values[0], workdir)
+        if source:
+            local[identifier] = stage(source, identifier, workdir, mode)
+        elif remote_in_place and remote_url(values[0]):
+            local[identifier] = remote_url(values[0])
+        elif cache_remote and remote_url(values[0]):
+            local[identifier] = fetch_remote(values[0], identifier, workdir)
+
+    remaining = {k: v for k, v in inputs.items() if k not in local}
+    args = io.collect_args(remaining, workdir) if remaining else OrderedDict()
+    return OrderedDict(
+        (identifier, local[identifier] if identifier in local else args[identifier])
+        for identifier in inputs
+        if identifier in local or identifier in args
+    )
@@ -0,0 +1,90 @@
+import time
+import threading
+from pywps import configuration
+
+import chickadee.utils as util
+
+
+class StatusWriter:
+    """Persist the progress of a running process from a background thread.
+
+    ``update`` only records the latest message and returns immediately. The
+    writer thread coalesces updates and flushes the most recent one at most
+    every ``interval`` seconds, or right away when the stage changes, so a
+    chatty job neither blocks on nor floods the pywps database.
+
+    While the writer is open, every ``update_status`` of the response, also
+    the ones the handler makes with ``log_handler``, holds one lock, since
+    pywps does not expect a response to be updated from two threads.
+    """
+
+    def __init__(self, response, interval=None):
+        self.response = response
+        self._lock = threading.RLock()
+        self._update_status = response.update_status
+        response.update_status = self._locked_update_status
+        self.interval = float(
+            interval
+            or configuration.get_config_value("chickadee", "status_interval", 2)
+        )
+        self._pending = None
+        self._stage = None
+        self._urgent = False
+        self._closed = False
+        self._last_flush = float("-inf")
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def update(self, message, percentage, stage=None):
+        with self._condition:
+            self._pending = (message, percentage)
+            if stage != self._stage:
+                self._stage = stage
+                self._urgent = True
+            self._condition.notify()
+
+    def close(self):
+        """Flush the last update and stop the writer thread"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+        # Back to the method of the class
+        if self.response.__dict__.get("update_status") == self._locked_update_status:
+            del self.response.update_status
+
+    def _locked_update_status(self, *args, **kwargs):
+        with self._lock:
+            return self._update_status(*args, **kwargs)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not (self._urgent or self._closed):
+                    if self._pending is None:
+                        self._condition.wait()
+                        continue
+                    remaining = self._last_flush + self.interval - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                pending, self._pending = self._pending, None
+                self._urgent = False
+                closed = self._closed
+
+            if pending is not None:
+                try:
+                    util.update_status_with_check(self.response, *pending)
+                except Exception as e:
+                    util.logger.warning(f"Failed to update status: {e}")
+                self._last_flush = time.monotonic()
+
+            if closed:
+                return
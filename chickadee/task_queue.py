@@ -0,0 +1,434 @@
+"""Queue of tile tasks run by workers on other hosts.
+
+With ``task_queue`` set to a database URL, the tiles of a job (see
+``chickadee.tiling``) are added to the queue instead of running on the host
+that received the request. ``chickadee worker`` daemons on any host that can
+reach the database claim them one at a time, write the tile outputs to
+``task_dir`` and record the results, while the handler waits for its tasks
+and stitches the outputs. Input files and ``task_dir`` must be mounted at the
+same paths on every host.
+
+Tasks are stored as JSON: the name of the job, its keyword arguments (paths
+and options) and the tile. Workers only run the job functions listed in
+``JOBS``, so a job must be one of them, or a ``functools.partial`` of one
+with keyword arguments. Workers register themselves and send a heartbeat while they run; the
+tasks of a worker whose heartbeat stopped are put back in the queue. When no
+worker is alive, tiles run on the local host as before.
+"""
+
+import os
+import json
+import time
+import socket
+import threading
+import importlib
+import numpy as np
+import sqlalchemy
+from datetime import date
+from functools import partial
+from sqlalchemy import Column, Float, Integer, String, Table, Text
+from pywps import configuration
+from pywps.app.exceptions import ProcessError
+
+import chickadee.utils as util
+from chickadee import cancellation
+
+
+# Errors that would happen again on a retry
+NO_RETRY = (ProcessError, ValueError)
+
+HEARTBEAT_INTERVAL = 10
+HEARTBEAT_TIMEOUT = 60
+WAIT_POLL = 2
+
+PENDING, RUNNING, DONE, FAILED = "pending", "running", "done", "failed"
+
+# Job functions workers run, by the name tasks give
+JOBS = {
+    "ci": "chickadee.processes.wps_CI:ci_tile",
+    "qdm": "chickadee.processes.wps_QDM:qdm_tile",
+    "rerank": "chickadee.processes.wps_rerank:rerank_tile",
+    "bias_correct": "chickadee.processes.wps_BCCAQ:bias_correct_tile",
+    "rerank_bias_corrected": (
+        "chickadee.processes.wps_BCCAQ:rerank_bias_corrected_tile"
+    ),
+}
+
+metadata = sqlalchemy.MetaData()
+
+tasks = Table(
+    "chickadee_tasks",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("job", String(64), index=True),
+    Column("tile", Integer),
+    Column("payload", Text),
+    Column("status", String(16), index=True),
+    Column("attempts", Integer, default=0),
+    Column("retries", Integer),
+    Column("worker", String(255)),
+    Column("result", Text),
+    Column("error", Text),
+    Column("updated", Float),
+)
+
+workers = Table(
+    "chickadee_workers",
+    metadata,
+    Column("name", String(255), primary_key=True),
+    Column("host", String(255)),
+    Column("pid", Integer),
+    Column("started", Float),
+    Column("heartbeat", Float),
+)
+
+_engine = None
+_engine_key = None
+
+
+def get_url():
+    return configuration.get_config_value("chickadee", "task_queue")
+
+
+def enabled():
+    return bool(get_url())
+
+
+def get_task_dir(job_id):
+    """Directory for the files of the tiles of a job, shared with the
+    workers"""
+    task_dir = configuration.get_config_value(
+        "chickadee", "task_dir"
+    ) or util.get_runtime_dir("tasks")
+    return os.path.join(task_dir, str(job_id))
+
+
+def get_engine():
+    global _engine, _engine_key
+
+    url = get_url()
+    key = (url, os.getpid())
+    if _engine_key != key:
+        connect_args = (
+            {"check_same_thread": False, "timeout": 30}
+            if url.startswith("sqlite")
+            else {}
+        )
+        _engine = sqlalchemy.create_engine(
+            url, pool_pre_ping=True, connect_args=connect_args
+        )
+        metadata.create_all(_engine)
+        _engine_key = key
+    return _engine
+
+
+def register(name):
+    now = time.time()
+    with get_engine().begin() as conn:
+        conn.execute(workers.delete().where(workers.c.name == name))
+        conn.execute(
+            workers.insert().values(
+                name=name,
+                host=socket.gethostname(),
+                pid=os.getpid(),
+                started=now,
+                heartbeat=now,
+            )
+        )
+
+
+def heartbeat(name):
+    with get_engine().begin() as conn:
+        conn.execute(
+            workers.update().where(workers.c.name == name).values(heartbeat=time.time())
+        )
+
+
+def unregister(name):
+    with get_engine().begin() as conn:
+        conn.execute(workers.delete().where(workers.c.name == name))
+
+
+def live_workers(timeout=HEARTBEAT_TIMEOUT):
+    """Names of the workers that sent a heartbeat in the last ``timeout``
+    seconds"""
+    with get_engine().begin() as conn:
+        rows = conn.execute(
+            sqlalchemy.select(workers.c.name).where(
+                workers.c.heartbeat > time.time() - timeout
+            )
+        )
+        return [row.name for row in rows]
+
+
+def _default(value):
+    if isinstance(value, date):
+        return {"__date__": value.isoformat()}
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} can not be sent to a worker")
+
+
+def _object_hook(value):
+    if list(value) == ["__date__"]:
+        return date.fromisoformat(value["__date__"])
+    return value
+
+
+def dumps(value):
+    return json.dumps(value, default=_default)
+
+
+def loads(text):
+    return json.loads(text, object_hook=_object_hook)
+
+
+def job_name(job):
+    """Name in ``JOBS`` of ``job``, or of the function of a partial"""
+    fn = job.func if isinstance(job, partial) else job
+    path = f"{fn.__module__}:{fn.__qualname__}"
+    for name, job_path in JOBS.items():
+        if job_path == path:
+            return name
+    raise ValueError(f"{path} is not a job workers can run")
+
+
+def get_job(name):
+    """The function of the job ``name``"""
+    if name not in JOBS:
+        raise ValueError(f"Unknown job '{name}'")
+    module, function = JOBS[name].split(":")
+    return getattr(importlib.import_module(module), function)
+
+
+def encode_task(job, tile):
+    """JSON task running ``job`` on ``tile``"""
+    if isinstance(job, partial) and job.args:
+        raise ValueError("Jobs only take keyword arguments besides the tile")
+    return dumps(
+        {
+            "job": job_name(job),
+            "kwargs": job.keywords if isinstance(job, partial) else {},
+            "tile": {
+                "index": tile.index,
+                "bbox": tile.bbox,
+                "time_range": tile.time_range,
+                "lat": tile.lat,
+            },
+        }
+    )
+
+
+def decode_task(payload):
+    """The job function, its keyword arguments and the tile of a task"""
+    from chickadee.tiling import Tile
+
+    task = loads(payload)
+    tile = task["tile"]
+    return (
+        get_job(task["job"]),
+        task["kwargs"],
+        Tile(
+            tile["index"],
+            tuple(tile["bbox"]) if tile["bbox"] else None,
+            tuple(tile["time_range"]) if tile["time_range"] else None,
+            np.array(tile["lat"], dtype=float),
+        ),
+    )
+
+
+def submit(job_id, job, tiles, retries):
+    """Add a task for every tile and return their IDs"""
+    now = time.time()
+    with get_engine().begin() as conn:
+        return [
+            conn.execute(
+                tasks.insert().values(
+                    job=str(job_id),
+                    tile=tile.index,
+                    payload=encode_task(job, tile),
+                    status=PENDING,
+                    attempts=0,
+                    retries=retries,
+                    updated=now,
+                )
+            ).inserted_primary_key[0]
+            for tile in tiles
+        ]
+
+
+def claim(name):
+    """Claim the oldest pending task for worker ``name``. Returns the task
+    as a dict, or None if the queue is empty."""
+    engine = get_engine()
+    while True:
+        with engine.begin() as conn:
+            task = conn.execute(
+                sqlalchemy.select(tasks)
+                .where(tasks.c.status == PENDING)
+                .order_by(tasks.c.id)
+                .limit(1)
+            ).first()
+            if task is None:
+                return None
+            # Another worker may have claimed it since
+            claimed = conn.execute(
+                tasks.update()
+                .where(tasks.c.id == task.id, tasks.c.status == PENDING)
+                .values(
+                    status=RUNNING,
+                    worker=name,
+                    attempts=task.attempts + 1,
+                    updated=time.time(),
+                )
+            ).rowcount
+        if claimed:
+            return dict(task._mapping, attempts=task.attempts + 1)
+
+
+def finish(task_id, result):
+    with get_engine().begin() as conn:
+        conn.execute(
+            tasks.update()
+            .where(tasks.c.id == task_id, tasks.c.status == RUNNING)
+            .values(status=DONE, result=dumps(result), updated=time.time())
+        )
+
+
+def fail(task_id, error, retry):
+    """Record the error of a task and put it back in the queue if
+    ``retry``"""
+    with get_engine().begin() as conn:
+        conn.execute(
+            tasks.update()
+            .where(tasks.c.id == task_id, tasks.c.status == RUNNING)
+            .values(
+                status=PENDING if retry else FAILED,
+                worker=None,
+                error=error,
+                updated=time.time(),
+            )
+        )
+
+
+def requeue_lost(timeout=HEARTBEAT_TIMEOUT):
+    """Put back the running tasks of workers that stopped sending
+    heartbeats, or fail them once they are out of retries"""
+    alive = live_workers(timeout)
+    with get_engine().begin() as conn:
+        lost = conn.execute(
+            sqlalchemy.select(tasks.c.id, tasks.c.attempts, tasks.c.retries).where(
+                tasks.c.status == RUNNING, tasks.c.worker.notin_(alive)
+            )
+        ).all()
+    for task in lost:
+        util.logger.warning(f"Worker of task {task.id} was lost")
+        fail(task.id, "Worker was lost", task.attempts <= task.retries)
+
+
+def cancel(job_id):
+    """Remove the tasks of a job from the queue"""
+    with get_engine().begin() as conn:
+        conn.execute(tasks.delete().where(tasks.c.job == str(job_id)))
+
+
+def wait(job_id, task_ids, poll=WAIT_POLL):
+    """Wait for the tasks of a job and return their results in the order of
+    ``task_ids``. Raises a ProcessError when a task failed or the process was
+    cancelled."""
+    try:
+        while True:
+            if cancellation.is_cancelled(job_id):
+                raise ProcessError("Process failed.")
+            requeue_lost()
+            with get_engine().begin() as conn:
+                rows = {
+                    row.id: row
+                    for row in conn.execute(
+                        sqlalchemy.select(
+                            tasks.c.id,
+                            tasks.c.tile,
+                            tasks.c.status,
+                            tasks.c.attempts,
+                            tasks.c.error,
+                            tasks.c.result,
+                        ).where(tasks.c.id.in_(task_ids))
+                    )
+                }
+            for row in rows.values():
+                if row.status == FAILED:
+                    raise ProcessError(
+                        f"Tile {row.tile} failed after {row.attempts} attempts: "
+                        f"{row.error}"
+                    )
+            if len(rows) < len(task_ids):
+                raise ProcessError("Tasks were removed from the queue")
+            if all(row.status == DONE for row in rows.values()):
+                return [loads(rows[task_id].result) for task_id in task_ids]
+            time.sleep(poll)
+    finally:
+        cancel(job_id)
+
+
+def run_tiles(job_id, job, tiles, retries):
+    """Run ``job(tile)`` for every tile on the workers"""
+    return wait(job_id, submit(job_id, job, tiles, retries))
+
+
+def run_task(task):
+    """Run a claimed task and record its result or error"""
+    try:
+        job, kwargs, tile = decode_task(task["payload"])
+    except (ValueError, KeyError, TypeError, ImportError) as e:
+        util.logger.warning(f"Invalid task {task['id']} ({type(e).__name__}: {e})")
+        fail(task["id"], f"Invalid task: {type(e).__name__}: {e}", False)
+        return
+    util.logger.info(f"Running tile {tile.index} of job {task['job']}")
+    try:
+        result = job(tile, **kwargs)
+    except Exception as e:
+        retry = not isinstance(e, NO_RETRY) and task["attempts"] <= task["retries"]
+        util.logger.warning(
+            f"Tile {tile.index} of job {task['job']} failed "
+            f"({type(e).__name__}: {e})"
+        )
+        fail(task["id"], f"{type(e).__name__}: {e}", retry)
+    else:
+        finish(task["id"], result)
+
+
+def work(name=None, poll=5.0, max_tasks=None):
+    """Run tasks from the queue until stopped, or ``max_tasks`` were run"""
+    name = name or f"{socket.gethostname()}:{os.getpid()}"
+    register(name)
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(HEARTBEAT_INTERVAL):
+            try:
+                heartbeat(name)
+            except sqlalchemy.exc.SQLAlchemyError as e:
+                util.logger.warning(f"Failed to send heartbeat: {e}")
+
+    threading.Thread(target=beat, daemon=True).start()
+    util.logger.info(f"Worker {name} waiting for tasks")
+    count = 0
+    task = None
+    try:
+        while max_tasks is None or count < max_tasks:
+            task = claim(name)
+            if task is None:
+                time.sleep(poll)
+                continue
+            run_task(task)
+            task = None
+            count += 1
+    finally:
+        stop.set()
+        if task is not None:
+            # Stopped while running, another worker picks the tile up
+            fail(task["id"], "Worker was stopped", True)
+        unregister(name)
+    return count
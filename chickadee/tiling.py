@@ -0,0 +1,206 @@
+"""Spatial tiling of downscaling jobs.
+
+With ``num_tiles`` above 1, the grid of the observations is split into bands
+of rows (tiles). Every tile is downscaled as a separate job on the subset of
+the inputs around it (see ``chickadee.engines.subset``), in a process of its
+own with its share of ``max_gb``, and the outputs of the tiles are stitched
+into one NetCDF file. Up to ``tile_workers`` tiles run at the same time and
+a tile that fails is retried ``tile_retries`` times. With a ``task_queue``
+the tiles are run by workers on other hosts instead (see
+``chickadee.task_queue``).
+
+Tile subsets overlap by the neighbouring rows every subset keeps, and only
+the rows a tile owns are stitched, so every cell comes out as it would
+without tiling. This holds for the steps that work cell by cell (CI, QDM
+and Rerank) but not for CA, whose analogues are found on the whole domain.
+"""
+
+import os
+import shutil
+import numpy as np
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import get_context
+from netCDF4 import Dataset
+from pywps import configuration
+from pywps.app.exceptions import ProcessError
+
+import chickadee.utils as util
+from chickadee import cores, task_queue
+from chickadee.engines import netcdf
+from chickadee.engines.subset import Subset, coordinate, lat_index
+from chickadee.task_queue import NO_RETRY
+
+
+def get_workers():
+    workers = configuration.get_config_value("chickadee", "tile_workers")
+    return int(workers) if workers else cores.get_max_cores()
+
+
+def get_retries():
+    retries = configuration.get_config_value("chickadee", "tile_retries")
+    return int(retries) if retries != "" else 2
+
+
+class Tile(Subset):
+    """Subset around the rows of a tile, which keeps the latitudes ``lat``
+    of the rows it owns"""
+
+    def __init__(self, index, bbox, time_range, lat):
+        super().__init__(bbox, time_range)
+        self.index = index
+        self.lat = lat
+
+
+def make_tiles(obs_file, num_tiles, subset=None):
+    """Split the rows of ``obs_file``, or of its ``subset``, into up to
+    ``num_tiles`` tiles"""
+    with Dataset(obs_file) as nc:
+        lat = np.ma.filled(nc.variables[coordinate(nc, "lat")][:], np.nan)
+        lon = np.ma.filled(nc.variables[coordinate(nc, "lon")][:], np.nan)
+    west, east = float(lon.min()), float(lon.max())
+    time_range = subset.time_range if subset else None
+    if subset and subset.bbox:
+        west, south, east, north = subset.bbox
+        lat = lat[lat_index(lat, south, north)]
+    return [
+        Tile(
+            index,
+            (west, float(rows.min()), east, float(rows.max())),
+            time_range,
+            rows,
+        )
+        for index, rows in enumerate(np.array_split(lat, min(num_tiles, len(lat))))
+    ]
+
+
+def tile_options(options, workers):
+    """``options`` with ``max_gb`` shared between ``workers`` tiles"""
+    return dict(options, max_gb=options["max_gb"] / max(workers, 1))
+
+
+def in_process(fn, *args, **kwargs):
+    """Call ``fn`` in a new process, so that a tile that runs out of memory
+    or crashes takes nothing else down with it"""
+    with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as executor:
+        return executor.submit(fn, *args, **kwargs).result()
+
+
+def run_tiles(job, tiles, workers=None, retries=None, job_id=None):
+    """Call ``job(tile)`` for every tile, ``workers`` at a time, retrying
+    failed tiles. Returns the results in the order of ``tiles``, or raises a
+    ProcessError for a tile that keeps failing.
+
+    The tiles of a ``job_id`` go to the task queue if it has live workers,
+    ``job`` must then be one of ``task_queue.JOBS`` (see
+    ``task_queue.encode_task``).
+    """
+    workers = workers or get_workers()
+    retries = get_retries() if retries is None else retries
+    if job_id is not None and task_queue.enabled():
+        if task_queue.live_workers():
+            return task_queue.run_tiles(job_id, job, tiles, retries)
+        util.logger.warning("No live workers on the task queue, running tiles here")
+
+    def run(tile):
+        for attempt in range(retries + 1):
+            try:
+                return job(tile)
+            except NO_RETRY:
+                raise
+            except Exception as e:
+                if attempt == retries:
+                    raise ProcessError(
+                        f"Tile {tile.index} failed after {retries + 1} attempts: "
+                        f"{type(e).__name__}: {e}"
+                    )
+                util.logger.warning(
+                    f"Tile {tile.index} failed ({type(e).__name__}: {e}), "
+                    f"retrying ({attempt + 1}/{retries})"
+                )
+
+    with ThreadPoolExecutor(max(1, min(workers, len(tiles)))) as executor:
+        futures = [executor.submit(run, tile) for tile in tiles]
+    return [future.result() for future in futures]
+
+
+@contextmanager
+def tile_workdir(workdir, job_id):
+    """Directory for the files of the tiles of a job: ``workdir``, or a
+    directory of ``task_dir`` visible to the workers, which is removed
+    afterwards"""
+    if not task_queue.enabled():
+        yield workdir
+        return
+    path = task_queue.get_task_dir(job_id)
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def tile_file(workdir, tile, name):
+    tile_dir = os.path.join(workdir, "tiles", str(tile.index))
+    os.makedirs(tile_dir, exist_ok=True)
+    return os.path.join(tile_dir, name)
+
+
+def stitch(tile_files, tiles, output_file, max_gb=1.0):
+    """Write the rows every tile owns from its file in ``tile_files`` to
+    ``output_file``"""
+    sources = [Dataset(path) for path in tile_files]
+    try:
+        first = sources[0]
+        lat_name = coordinate(first, "lat")
+        owned = []
+        for source, tile in zip(sources, tiles):
+            rows = np.flatnonzero(np.isin(source.variables[lat_name][:], tile.lat))
+            owned.append(slice(int(rows[0]), int(rows[-1]) + 1))
+        nlat = sum(rows.stop - rows.start for rows in owned)
+
+        with Dataset(output_file, "w", format="NETCDF4_CLASSIC") as out:
+            out.setncatts({k: first.getncattr(k) for k in first.ncattrs()})
+            for name, dim in first.dimensions.items():
+                size = nlat if name == lat_name else len(dim)
+                out.createDimension(name, None if dim.isunlimited() else size)
+
+            for name, var in first.variables.items():
+                attrs = {k: var.getncattr(k) for k in var.ncattrs()}
+                fill_value = attrs.pop("_FillValue", None)
+                new = out.createVariable(
+                    name, var.dtype, var.dimensions, fill_value=fill_value
+                )
+                new.set_auto_maskandscale(False)
+                new.setncatts(attrs)
+                if lat_name not in var.dimensions:
+                    var.set_auto_maskandscale(False)
+                    new[:] = var[:]
+                    continue
+
+                axis = var.dimensions.index(lat_name)
+                start = 0
+                for source, rows in zip(sources, owned):
+                    src = source.variables[name]
+                    src.set_auto_maskandscale(False)
+                    dest = slice(start, start + rows.stop - rows.start)
+                    start = dest.stop
+                    _copy_rows(src, new, axis, rows, dest, max_gb)
+    finally:
+        for source in sources:
+            source.close()
+    return output_file
+
+
+def _copy_rows(src, out, axis, rows, dest, max_gb):
+    """Copy ``rows`` along ``axis`` of ``src`` to ``dest`` of ``out``, a
+    block of the first dimension at a time"""
+    blocks = [slice(None)]
+    if axis > 0:
+        row_bytes = src.dtype.itemsize * int(np.prod(src.shape[1:]))
+        size = netcdf.rows_per_block(max_gb, row_bytes, 1)
+        blocks = netcdf.row_blocks(src.shape[0], size)
+    for steps in blocks:
+        src_index = [steps] + [slice(None)] * (src.ndim - 1)
+        out_index = list(src_index)
+        src_index[axis], out_index[axis] = rows, dest
+        out[tuple(out_index)] = src[tuple(src_index)]
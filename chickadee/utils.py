@@ -1,14 +1,15 @@
-import pytest, logging, io, re
+import pytest, logging, io, re, os, stat
 from rpy2 import robjects
 from rpy2.rinterface_lib import callbacks
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, gettempdir
 from urllib.request import urlretrieve
 from importlib.resources import files
 from pywps.response.status import WPS_STATUS
 from pywps.app.exceptions import ProcessError
 from contextlib import redirect_stderr
-from pywps.dblog import get_session, ProcessInstance
+from pywps import configuration
 from wps_tools.testing import run_wps_process
+from chickadee import cancellation
 
 
 logger = logging.getLogger("PYWPS")
@@ -22,8 +23,43 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 
 
+def default_runtime_dir():
+    """Runtime directory of the user running the service"""
+    if os.environ.get("XDG_RUNTIME_DIR"):
+        return os.path.join(os.environ["XDG_RUNTIME_DIR"], "chickadee")
+    return os.path.join(gettempdir(), f"chickadee-{os.getuid()}")
+
+
+def check_runtime_dir(path):
+    """Refuse a runtime directory other users could tamper with"""
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode):
+        raise PermissionError(f"Runtime directory {path} is not a directory")
+    if info.st_uid != os.getuid():
+        raise PermissionError(f"Runtime directory {path} is owned by another user")
+    if info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise PermissionError(f"Runtime directory {path} is writable by other users")
+
+
+def get_runtime_dir(*subdirs):
+    """Directory for runtime state shared by the processes of the service"""
+    runtime_dir = (
+        configuration.get_config_value("chickadee", "runtime_dir")
+        or default_runtime_dir()
+    )
+    os.makedirs(runtime_dir, mode=0o700, exist_ok=True)
+    check_runtime_dir(runtime_dir)
+    path = os.path.join(runtime_dir, *subdirs)
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    return path
+
+
 def select_args_from_input_list(args, inputs):
-    return (args[input_.identifier] for input_ in inputs)
+    return (args.get(input_.identifier) for input_ in inputs)
+
+
+def select_options_from_input_list(args, inputs):
+    return {input_.identifier: args[input_.identifier] for input_ in inputs}
 
 
 def r_boolean(python_bool):
@@ -150,34 +186,25 @@ def raise_if_failed(response):
         response.clean()
         raise ProcessError("Process failed.")
 
-    uuid = response.uuid
-
-    session = get_session()
-    try:
-        process = session.query(ProcessInstance).filter_by(uuid=uuid).first()
-        if process and process.status == WPS_STATUS.FAILED:
-            response.update_status(WPS_STATUS.FAILED, "Process failed.", 100)
-            response.clean()
-            raise ProcessError("Process failed.")
-    finally:
-        session.close()
+    if cancellation.is_cancelled(response.uuid):
+        response.update_status(WPS_STATUS.FAILED, "Process failed.", 100)
+        response.clean()
+        raise ProcessError("Process failed.")
 
 
 def update_status_with_check(response, message, percentage):
-    session = get_session()
-    try:
-        process = session.query(ProcessInstance).filter_by(uuid=response.uuid).first()
-        if process and process.status == WPS_STATUS.FAILED:
-            response.update_status(WPS_STATUS.FAILED, message, percentage)
-        else:
-            response.update_status(message, percentage)
-    finally:
-        session.close()
-
-
-# Using Rpy2 callbacks to monitor process progress.
+    if cancellation.is_cancelled(response.uuid):
+        response.update_status(WPS_STATUS.FAILED, message, percentage)
+    else:
+        response.update_status(message, percentage)
+
+
+# Monitor process progress from the R console output of an R worker job.
+# Progress is handed to a StatusWriter, which persists it in the background.
 # See https://rpy2.github.io/doc/latest/html/callbacks.html#write-console
-def create_r_progress_monitor(process_instance, response, logger, log_level):
+def create_r_progress_monitor(
+    process_instance, response, logger, log_level, status_writer
+):
     original_console_write = callbacks.consolewrite_print
 
     progress_markers = {
@@ -194,22 +221,15 @@ def create_r_progress_monitor(process_instance, response, logger, log_level):
     def custom_console_write(text):
         original_console_write(text)
 
-        session = get_session()
-        try:
-            process = (
-                session.query(ProcessInstance).filter_by(uuid=response.uuid).first()
-            )
-            if process and process.status == WPS_STATUS.FAILED:
-                logger.info("Process was cancelled. Sending interrupt to R.")
-                response.clean()
-                robjects.r("stop('Process cancelled by user')")
-                raise ProcessError("Process failed.")
-        finally:
-            session.close()
+        if cancellation.is_cancelled(response.uuid):
+            # Raising here makes the R worker pool interrupt the job
+            logger.info("Process was cancelled. Sending interrupt to R.")
+            response.clean()
+            raise ProcessError("Process failed.")
         # Check for fixed progress markers
         for marker, percentage in progress_markers.items():
             if marker in text:
-                update_status_with_check(response, marker, percentage)
+                status_writer.update(marker, percentage, stage=marker)
                 logger.info(marker)
                 return
 
@@ -221,7 +241,7 @@ def create_r_progress_monitor(process_instance, response, logger, log_level):
                 progress = end / int(total)
                 percentage = 29 + (progress * 26)  # 26 = (55 - 29)
                 message = f"Interpolating timesteps {start}-{end} of {total}"
-                update_status_with_check(response, message, int(percentage))
+                status_writer.update(message, int(percentage), stage="interpolate")
                 logger.info(message)
                 return
 
@@ -238,16 +258,8 @@ def create_r_progress_monitor(process_instance, response, logger, log_level):
                 message = (
                     f"Applying climatologies to timesteps {start}-{end} of {total}"
                 )
-                update_status_with_check(response, message, int(percentage))
+                status_writer.update(message, int(percentage), stage="apply")
                 logger.info(message)
                 return
 
-    def set_monitor():
-        # Set the R console monitoring callback
-        callbacks.consolewrite_print = custom_console_write
-
-    def remove_monitor():
-        # Restore the original R console callback
-        callbacks.consolewrite_print = original_console_write
-
-    return set_monitor, remove_monitor
+    return custom_console_write
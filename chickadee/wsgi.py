@@ -3,6 +3,8 @@ import logging
 from pywps.app.Service import Service
 from .processes import processes
 from .cancel_process import handle_cancel
+from .cores import get_max_cores
+from .admission import get_budget_gb
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -21,6 +23,9 @@ def create_app(cfgfiles=None):
         logger.error(f"Service initialization failed: {str(e)}")
         raise
 
+    logger.info(f"Jobs may use up to {get_max_cores()} cores")
+    logger.info(f"Jobs may use up to {get_budget_gb():.1f} GB")
+
     def application(environ, start_response):
         try:
             path_info = environ.get("PATH_INFO", "")
@@ -0,0 +1,117 @@
+import time
+import pytest
+import threading
+from pywps.app.exceptions import ProcessError
+
+from chickadee import admission, cores
+
+
+@pytest.fixture
+def ledger(tmp_path, monkeypatch):
+    monkeypatch.setattr(admission.util, "get_runtime_dir", lambda: str(tmp_path))
+    monkeypatch.setattr(admission, "get_budget_gb", lambda: 10.0)
+    monkeypatch.setattr(admission, "WAIT_POLL", 0.01)
+    monkeypatch.setattr(admission.cancellation, "is_cancelled", lambda uuid: False)
+    return tmp_path
+
+
+def test_memory_limit_gb(tmp_path):
+    host = admission.memory_limit_gb(str(tmp_path))
+    (tmp_path / "memory.max").write_text("max\n")
+    assert admission.memory_limit_gb(str(tmp_path)) == host
+    (tmp_path / "memory.max").write_text(f"{2**30}\n")
+    assert admission.memory_limit_gb(str(tmp_path)) == 1.0
+
+
+def test_get_budget_gb_follows_config(monkeypatch):
+    # A configuration loaded after the first call is picked up
+    config = {"max_memory_gb": "4"}
+    monkeypatch.setattr(
+        admission.configuration, "get_config_value", lambda section, opt: config[opt]
+    )
+    assert admission.get_budget_gb() == 4.0
+    config["max_memory_gb"] = "6.5"
+    assert admission.get_budget_gb() == 6.5
+
+
+def test_estimate_gb():
+    gcm, obs = (1000, 64, 128), (1000, 1024, 2048)
+    base = admission.BASE_GB
+    assert admission.estimate_gb("qdm", "numpy", gcm, obs, 2.0, 8) == base + 2.0
+    # Every doParallel process holds a chunk
+    assert admission.estimate_gb("qdm", "climdown", gcm, obs, 2.0, 4) == base + 10.0
+    ci = admission.estimate_gb("ci", "numpy", gcm, obs, 2.0, 1)
+    ca = admission.estimate_gb("ca", "numpy", gcm, obs, 2.0, 1)
+    assert ci == pytest.approx(base + 2.0 + 8 * (1000 * 64 * 128 + 12 * 2**21) / 2**30)
+    assert ca == pytest.approx(base + 2.0 + 8 * 2 * 1000 * 64 * 128 / 2**30)
+    bccaq = admission.estimate_gb("bccaq", "numpy", gcm, obs, 2.0, 1)
+    assert bccaq == pytest.approx(ci + ca - base)
+
+
+def test_auto_cores_estimated_from_free_cores(ledger, monkeypatch):
+    monkeypatch.setattr(cores, "get_max_cores", lambda: 8)
+    gcm, obs = (100, 8, 8), (100, 64, 64)
+    # A ClimDown job on all the cores would not fit next to a running job
+    assert admission.estimate_gb("qdm", "climdown", gcm, obs, 0.5, 8) > 6.0
+    with cores.reserve(6), admission.admit(4.0, "running"):
+        with cores.reserve("auto") as num_cores:
+            assert num_cores == 2
+            gb = admission.estimate_gb("qdm", "climdown", gcm, obs, 0.5, num_cores)
+            with admission.admit(gb, "auto"):
+                pass
+
+
+def test_jobs_wait_for_memory(ledger):
+    events = []
+
+    def job(name, gb, duration):
+        with admission.admit(gb, name):
+            events.append(f"start {name}")
+            time.sleep(duration)
+            events.append(f"end {name}")
+
+    with admission.admit(6.0, "first"):
+        second = threading.Thread(target=job, args=("second", 6.0, 0))
+        second.start()
+        time.sleep(0.2)
+        # The second job does not fit until the first one finished
+        assert events == []
+    second.join(10)
+    assert events == ["start second", "end second"]
+
+
+def test_jobs_start_in_order(ledger):
+    events = []
+
+    def job(name, gb):
+        with admission.admit(gb, name):
+            events.append(name)
+
+    with admission.admit(8.0, "running"):
+        big = threading.Thread(target=job, args=("big", 9.5))
+        big.start()
+        time.sleep(0.1)
+        small = threading.Thread(target=job, args=("small", 1.0))
+        small.start()
+        time.sleep(0.1)
+        # The small job would fit, but waits behind the big one
+        assert events == []
+    big.join(10)
+    small.join(10)
+    assert events == ["big", "small"]
+
+
+def test_job_above_budget_runs_alone(ledger):
+    with admission.admit(50.0, "huge"):
+        pass
+
+
+def test_cancelled_while_waiting(ledger, monkeypatch):
+    with admission.admit(8.0, "running"):
+        monkeypatch.setattr(admission.cancellation, "is_cancelled", lambda uuid: True)
+        with pytest.raises(ProcessError):
+            with admission.admit(8.0, "cancelled"):
+                pass
+    # The cancelled job left the queue
+    with admission.admit(8.0, "next"):
+        pass
@@ -0,0 +1,102 @@
+import os
+import pytest
+
+from chickadee import cache
+
+
+def write(path, size):
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+    return str(path)
+
+
+def test_get_and_put(tmp_path):
+    disk_cache = cache.DiskCache(str(tmp_path / "cache"), 1000)
+    key = cache.make_key("analogues", "abc", {"tol": 0.1})
+
+    assert disk_cache.get(key, str(tmp_path / "out")) is None
+    disk_cache.put(key, write(tmp_path / "src", 10))
+    assert disk_cache.get(key, str(tmp_path / "out")) == str(tmp_path / "out")
+    assert os.path.getsize(tmp_path / "out") == 10
+
+
+def test_lru_eviction(tmp_path):
+    disk_cache = cache.DiskCache(str(tmp_path / "cache"), 250)
+    keys = [cache.make_key(i) for i in range(3)]
+    for i, key in enumerate(keys[:2]):
+        disk_cache.put(key, write(tmp_path / "src", 100))
+        os.utime(disk_cache.path(key), (i, i))
+
+    # Reading the oldest entry makes the other one least recently used
+    disk_cache.get(keys[0], str(tmp_path / "out"))
+    disk_cache.put(keys[2], write(tmp_path / "src", 100))
+
+    assert os.path.exists(disk_cache.path(keys[0]))
+    assert not os.path.exists(disk_cache.path(keys[1]))
+    assert os.path.exists(disk_cache.path(keys[2]))
+
+
+def test_entry_survives_eviction_once_handed_out(tmp_path):
+    disk_cache = cache.DiskCache(str(tmp_path / "cache"), 150)
+    first, second = cache.make_key(1), cache.make_key(2)
+    disk_cache.put(first, write(tmp_path / "src", 100))
+    out = disk_cache.get(first, str(tmp_path / "out"))
+    disk_cache.put(second, write(tmp_path / "src", 100))
+
+    assert not os.path.exists(disk_cache.path(first))
+    assert os.path.getsize(out) == 100
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "get_cache_dir", lambda: str(tmp_path / "cache"))
+    monkeypatch.setattr(cache, "_file_digests", {})
+    return tmp_path / "cache"
+
+
+def test_read_and_write(tmp_path):
+    disk_cache = cache.DiskCache(str(tmp_path / "cache"), 1000)
+    key = cache.make_key("digest")
+    assert disk_cache.read(key) is None
+    disk_cache.write(key, b"abc")
+    assert disk_cache.read(key) == b"abc"
+
+
+def test_file_digest_follows_contents(tmp_path, cache_dir):
+    path = write(tmp_path / "input.nc", 10)
+    digest = cache.file_digest(path)
+    assert cache.input_digest(path) == digest
+
+    with open(path, "ab") as f:
+        f.write(b"y")
+    assert cache.file_digest(path) != digest
+    assert cache.input_digest("https://example.org/data.nc") == (
+        "https://example.org/data.nc"
+    )
+
+
+def test_file_digest_shared_on_disk(tmp_path, cache_dir, monkeypatch):
+    path = write(tmp_path / "input.nc", 10)
+    digest = cache.file_digest(path)
+
+    # Another process finds the digest on disk without hashing the file
+    monkeypatch.setattr(cache, "_file_digests", {})
+    stat = os.stat(path)
+    with open(path, "wb") as f:
+        f.write(b"y" * 10)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert cache.file_digest(path) == digest
+
+
+def test_remember_digest(tmp_path, cache_dir, monkeypatch):
+    path = write(tmp_path / "input.nc", 10)
+    cache.remember_digest(path, "abc")
+    monkeypatch.setattr(cache, "_file_digests", {})
+    assert cache.file_digest(path) == "abc"
+
+
+@pytest.mark.parametrize("key", ["", "../secret", "ABC"])
+def test_invalid_key(tmp_path, key):
+    disk_cache = cache.DiskCache(str(tmp_path / "cache"), 100)
+    with pytest.raises(ValueError):
+        disk_cache.get(key, str(tmp_path / "out"))
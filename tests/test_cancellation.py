@@ -0,0 +1,82 @@
+import os
+import pytest
+from pywps.response.status import WPS_STATUS
+
+from chickadee import cancellation
+
+
+class FakeSession:
+    def __init__(self, status, queries):
+        self.status = status
+        self.queries = queries
+
+    def query(self, model):
+        self.queries.append(model)
+        return self
+
+    def filter_by(self, **kwargs):
+        return self
+
+    def first(self):
+        return type("Process", (), {"status": self.status})
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def runtime_dir(tmp_path, monkeypatch):
+    def get_runtime_dir(*subdirs):
+        path = os.path.join(tmp_path, *subdirs)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    monkeypatch.setattr(cancellation.util, "get_runtime_dir", get_runtime_dir)
+    return tmp_path
+
+
+def test_db_polled_at_bounded_rate(runtime_dir, monkeypatch):
+    queries = []
+    monkeypatch.setattr(
+        cancellation, "get_session", lambda: FakeSession(WPS_STATUS.STARTED, queries)
+    )
+
+    for _ in range(1000):
+        assert not cancellation.is_cancelled("abcd")
+
+    assert len(queries) == 1
+    cancellation.clear("abcd")
+
+
+def test_cancel_flag_is_shared(runtime_dir, monkeypatch):
+    monkeypatch.setattr(
+        cancellation, "get_session", lambda: FakeSession(WPS_STATUS.STARTED, [])
+    )
+    cancellation.request_cancel("efgh")
+    # Another process only sees the flag file, not the in-memory state
+    cancellation._cancelled.clear()
+    assert cancellation.is_cancelled("efgh")
+
+    cancellation.clear("efgh")
+    assert not os.path.exists(os.path.join(runtime_dir, "cancelled", "efgh"))
+
+
+def test_cancelled_in_db(runtime_dir, monkeypatch):
+    monkeypatch.setattr(
+        cancellation, "get_session", lambda: FakeSession(WPS_STATUS.FAILED, [])
+    )
+    assert cancellation.is_cancelled("ijkl")
+    cancellation.clear("ijkl")
+
+
+def test_tracking_clears_failed_handlers(runtime_dir, monkeypatch):
+    monkeypatch.setattr(
+        cancellation, "get_session", lambda: FakeSession(WPS_STATUS.STARTED, [])
+    )
+    with pytest.raises(RuntimeError):
+        with cancellation.tracking("mnop"):
+            cancellation.request_cancel("mnop")
+            raise RuntimeError("handler failed")
+
+    assert "mnop" not in cancellation._cancelled
+    assert not os.path.exists(os.path.join(runtime_dir, "cancelled", "mnop"))
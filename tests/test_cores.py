@@ -0,0 +1,92 @@
+import os
+import json
+import pytest
+
+from chickadee import cores
+
+
+def write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(text)
+
+
+@pytest.fixture
+def ledger(tmp_path, monkeypatch):
+    monkeypatch.setattr(cores.util, "get_runtime_dir", lambda: str(tmp_path))
+    monkeypatch.setattr(cores, "get_max_cores", lambda: 4)
+    return tmp_path / "cores.json"
+
+
+def test_cgroup_quota(tmp_path):
+    assert cores.cgroup_quota(str(tmp_path)) is None
+
+    write(tmp_path / "v1" / "cpu" / "cpu.cfs_quota_us", "250000\n")
+    write(tmp_path / "v1" / "cpu" / "cpu.cfs_period_us", "100000\n")
+    assert cores.cgroup_quota(str(tmp_path / "v1")) == 2.5
+    write(tmp_path / "v1" / "cpu" / "cpu.cfs_quota_us", "-1\n")
+    assert cores.cgroup_quota(str(tmp_path / "v1")) is None
+
+    write(tmp_path / "v2" / "cpu.max", "150000 100000\n")
+    assert cores.cgroup_quota(str(tmp_path / "v2")) == 1.5
+    write(tmp_path / "v2" / "cpu.max", "max 100000\n")
+    assert cores.cgroup_quota(str(tmp_path / "v2")) is None
+
+
+def test_get_max_cores_follows_config(monkeypatch):
+    # A configuration loaded after the first call is picked up
+    config = {"max_cores": "3"}
+    monkeypatch.setattr(
+        cores.configuration, "get_config_value", lambda section, opt: config[opt]
+    )
+    assert cores.get_max_cores() == 3
+    config["max_cores"] = "5"
+    assert cores.get_max_cores() == 5
+
+
+def test_detect_cores(tmp_path):
+    available = len(os.sched_getaffinity(0))
+    assert cores.detect_cores(str(tmp_path)) == available
+    write(tmp_path / "cpu.max", "50000 100000\n")
+    # A quota below one CPU still runs jobs
+    assert cores.detect_cores(str(tmp_path)) == 1
+    write(tmp_path / "cpu.max", f"{(available + 1) * 100000} 100000\n")
+    assert cores.detect_cores(str(tmp_path)) == available
+
+
+@pytest.mark.parametrize(
+    ("num_cores", "available", "expected"),
+    [("auto", 6, 6), ("AUTO", 0, 1), ("4", 6, 4), (8, 6, 6), (2, -3, 1)],
+)
+def test_clamp(num_cores, available, expected):
+    assert cores.clamp(num_cores, available) == expected
+
+
+@pytest.mark.parametrize("num_cores", ["0", "-2", "many", "1.5"])
+def test_invalid_num_cores(num_cores):
+    with pytest.raises(ValueError, match="num_cores"):
+        cores.parse(num_cores)
+
+
+def test_reserve(ledger):
+    with cores.reserve(3) as first:
+        assert first == 3
+        with cores.reserve("auto") as second:
+            assert second == 1
+            assert cores.committed() == 4
+            # The host is fully committed, jobs still get a core
+            with cores.reserve(2) as third:
+                assert third == 1
+        assert cores.committed() == 3
+    assert cores.committed() == 0
+
+    with cores.reserve("auto") as num_cores:
+        assert num_cores == 4
+
+
+def test_reservations_of_dead_processes_are_dropped(ledger):
+    with open(ledger, "w") as f:
+        json.dump({"gone": {"pid": 2**22 + 1, "cores": 4}}, f)
+    assert cores.committed() == 0
+    with cores.reserve("auto") as num_cores:
+        assert num_cores == 4
@@ -0,0 +1,126 @@
+import os
+import json
+import pytest
+from datetime import date
+from click.testing import CliRunner
+
+from chickadee import admission, cost_model
+from chickadee.cli import cli
+from chickadee.engines.subset import Subset
+
+
+DATA = os.path.join(os.path.dirname(__file__), "data")
+GCM_FILE = os.path.join(DATA, "tiny_gcm.nc")
+OBS_FILE = os.path.join(DATA, "tiny_obs.nc")
+
+
+@pytest.fixture
+def history(tmp_path, monkeypatch):
+    history_file = tmp_path / "cache" / "timings.jsonl"
+    monkeypatch.setattr(cost_model, "get_history_file", lambda: str(history_file))
+    monkeypatch.setattr(cost_model.cores, "get_max_cores", lambda: 2)
+    return history_file
+
+
+def test_describe(history):
+    job = cost_model.describe("qdm", "climdown", GCM_FILE, OBS_FILE, 1.0, "auto")
+    assert job == cost_model.Job("qdm", "climdown", (3651, 4, 4), (751, 26, 26), 1.0, 2)
+    assert cost_model.peak_gb(job) == admission.estimate_gb(
+        "qdm", "climdown", (3651, 4, 4), (751, 26, 26), 1.0, 2
+    )
+    assert cost_model.output_gb(job) == pytest.approx(4 * 3651 * 26 * 26 / 2**30)
+    # Rerank only runs in ClimDown
+    assert cost_model.describe("rerank", "numpy", GCM_FILE, OBS_FILE, 1.0, 1)[1] == (
+        "climdown"
+    )
+
+
+def test_describe_subset(history):
+    subset = Subset.from_inputs(time_range="1970-01-01/1970-12-31")
+    calibration = (date(1966, 1, 1), date(1966, 12, 31))
+    job = cost_model.describe(
+        "ci",
+        "numpy",
+        GCM_FILE,
+        OBS_FILE,
+        1.0,
+        1,
+        "tasmax",
+        "tasmax",
+        subset,
+        calibration,
+    )
+    # The GCM keeps the time range and the calibration period
+    assert job.gcm_shape == (730, 4, 4)
+    # The observations are never subset in time
+    assert job.obs_shape == (751, 26, 26)
+
+
+def test_default_rates_until_enough_runs(history):
+    job = cost_model.Job("qdm", "numpy", (1000, 4, 4), (100, 10, 10), 1.0, 2)
+    for _ in range(cost_model.MIN_RUNS - 1):
+        cost_model.record(job, 1000.0)
+    estimate = cost_model.estimate(job)
+    assert estimate["runs"] == 0
+    assert estimate["wall_time"] == pytest.approx(
+        cost_model.DEFAULT_OVERHEAD["numpy"]
+        + cost_model.DEFAULT_RATES["qdm", "numpy"] * 1000 * 100 / 2
+    )
+
+
+def test_fit_recovers_rate(history):
+    overhead, rate = 12.0, 3e-4
+    for steps, num_cores in [(1000, 1), (2000, 2), (4000, 1), (8000, 4)]:
+        job = cost_model.Job(
+            "ci", "numpy", (steps, 4, 4), (100, 10, 10), 1.0, num_cores
+        )
+        cost_model.record(job, overhead + rate * steps * 100 / num_cores)
+    # Lines of a job killed while writing are skipped
+    with open(history, "a") as f:
+        f.write('{"process": "ci", "eng')
+    assert len(cost_model.load_history("ci", "numpy")) == 4
+    assert cost_model.load_history("ci", "climdown") == []
+
+    job = cost_model.Job("ci", "numpy", (10000, 4, 4), (100, 10, 10), 1.0, 2)
+    estimate = cost_model.estimate(job)
+    assert estimate["runs"] == 4
+    assert estimate["wall_time"] == pytest.approx(overhead + rate * 10000 * 100 / 2)
+
+
+def test_timed_records_finished_jobs(history):
+    job = cost_model.Job("ca", "numpy", (10, 4, 4), (100, 10, 10), 1.0, 1)
+    with pytest.raises(ValueError):
+        with cost_model.timed(job):
+            raise ValueError("failed")
+    assert not history.exists()
+
+    with cost_model.timed(job):
+        pass
+    (entry,) = [json.loads(line) for line in history.read_text().splitlines()]
+    assert entry["process"] == "ca"
+    assert entry["gcm_shape"] == [10, 4, 4]
+    assert entry["seconds"] >= 0
+
+
+def test_cli(history):
+    result = CliRunner().invoke(
+        cli,
+        [
+            "estimate",
+            "qdm",
+            GCM_FILE,
+            OBS_FILE,
+            "--varname",
+            "tasmax",
+            "--engine",
+            "numpy",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert "(default)" in result.output
+    assert "peak memory" in result.output
+
+    result = CliRunner().invoke(
+        cli, ["estimate", "qdm", GCM_FILE, "missing.nc", "--varname", "tasmax"]
+    )
+    assert result.exit_code == 1
@@ -0,0 +1,176 @@
+import os
+import pytest
+import numpy as np
+from datetime import date
+
+from chickadee import cache
+from chickadee.engines import ca, analogue_index, obs_cache
+
+
+DATA = os.path.join(os.path.dirname(__file__), "data")
+
+
+@pytest.fixture
+def obs_statistics(tmp_path, monkeypatch):
+    disk_cache = cache.DiskCache(str(tmp_path / "cache"), 2**30)
+    monkeypatch.setattr(obs_cache, "get_cache", lambda: disk_cache)
+    return disk_cache
+
+
+def options(**kwargs):
+    return dict(
+        {
+            "units_bool": True,
+            "n_pr_bool": True,
+            "tasmax_units": "celsius",
+            "max_gb": 1.0,
+            "start_date": date(1971, 1, 1),
+            "end_date": date(2005, 12, 31),
+            "num_analogues": 30,
+            "delta_days": 45,
+            "trimmed_mean": 0.0,
+            "tol": 0.1,
+        },
+        **kwargs,
+    )
+
+
+def test_find_analogues_matches_loop():
+    rng = np.random.default_rng(0)
+    targets = rng.normal(size=(7, 12))
+    candidates = rng.normal(size=(90, 12))
+
+    nearest, weights = ca.find_analogues(targets, candidates, 5, 0.1)
+
+    for target, idx, w in zip(targets, nearest, weights):
+        distances = ((candidates - target) ** 2).sum(axis=1)
+        np.testing.assert_array_equal(idx, np.argsort(distances)[:5])
+        q = candidates[idx].T
+        expected = np.linalg.solve(q.T @ q + 0.1 * np.eye(5), q.T @ target)
+        np.testing.assert_allclose(w, expected)
+
+
+def test_candidate_days_wrap_around_new_year():
+    obs_doy = np.arange(366)
+    days = ca.candidate_days(obs_doy, 2, 5)
+    assert set(days) == {0, 1, 2, 3, 4, 5, 6, 7, 363, 364, 365}
+
+
+def test_aggregation_matrix():
+    matrix = ca.aggregation_matrix(
+        obs_lat=[0.25, 0.75, 1.25],
+        obs_lon=[-0.75, -0.25, 0.25],
+        gcm_lat=[0.5, 1.5],
+        gcm_lon=[359.5, 0.5],
+    )
+    assert matrix.shape == (9, 4)
+    assert (matrix.sum(axis=1) == 1).all()
+    # obs cell (0.25, -0.75) lies in GCM cell (0.5, 359.5)
+    assert matrix[0, 0] == 1
+
+
+@pytest.mark.parametrize("num_cores", [1, 2])
+def test_ca_netcdf(num_cores, obs_statistics):
+    analogues = ca.ca_netcdf(
+        os.path.join(DATA, "tiny_gcm.nc"),
+        os.path.join(DATA, "tiny_obs.nc"),
+        "tasmax",
+        options(),
+        num_cores,
+    )
+    assert len(analogues["indices"]) == len(analogues["weights"]) == 3651
+    assert all(len(i) == 30 for i in analogues["indices"])
+    # Indices are 1-based positions in the observations
+    indices = np.concatenate(analogues["indices"])
+    assert indices.min() >= 1 and indices.max() <= 751
+
+
+def test_ca_netcdf_uses_cached_aggregate(obs_statistics, monkeypatch):
+    args = (
+        os.path.join(DATA, "tiny_gcm.nc"),
+        os.path.join(DATA, "tiny_obs.nc"),
+        "tasmax",
+        options(),
+    )
+    first = ca.ca_netcdf(*args)
+
+    def fail(*args):
+        raise AssertionError("observations were aggregated again")
+
+    monkeypatch.setattr(ca, "aggregate_obs", fail)
+    second = ca.ca_netcdf(*args)
+    for a, b in zip(first["indices"], second["indices"]):
+        np.testing.assert_array_equal(a, b)
+
+
+def test_ca_netcdf_too_few_candidates(obs_statistics):
+    with pytest.raises(ValueError):
+        ca.ca_netcdf(
+            os.path.join(DATA, "tiny_gcm.nc"),
+            os.path.join(DATA, "tiny_obs.nc"),
+            "tasmax",
+            options(num_analogues=500),
+        )
+
+
+def low_rank_days(n, cells, rank, seed):
+    rng = np.random.default_rng(seed)
+    return rng.normal(size=(n, rank)) @ rng.normal(size=(rank, cells))
+
+
+def test_analogue_index_matches_exact_search():
+    obs = low_rank_days(366 * 5, 40, 3, 0)
+    obs_doy = np.tile(np.arange(366), 5)
+    gcm = low_rank_days(366, 40, 3, 1)
+    gcm_doy = np.arange(366)
+
+    index = analogue_index.AnalogueIndex(obs, obs_doy, 10)
+    assert index.components.shape[1] <= 3
+
+    exact, _ = ca.analogue_search(gcm, gcm_doy, obs, obs_doy, 5, 10, 0.1)
+    approximate, _ = ca.analogue_search(
+        gcm, gcm_doy, obs, obs_doy, 5, 10, 0.1, index=index
+    )
+    np.testing.assert_array_equal(exact, approximate)
+
+
+def test_analogue_index_is_cached(obs_statistics, monkeypatch):
+    obs = low_rank_days(366 * 3, 40, 3, 0)
+    obs_doy = np.tile(np.arange(366), 3)
+    gcm = low_rank_days(10, 40, 3, 1)
+
+    def cache_key(name, **params):
+        return cache.make_key(name, params)
+
+    index = analogue_index.AnalogueIndex(obs, obs_doy, 10, cache_key=cache_key)
+    expected = index.query(gcm, 5, 5)
+
+    # A second index reads the components and trees from the cache
+    def fail(*args, **kwargs):
+        raise AssertionError("rebuilt")
+
+    monkeypatch.setattr(analogue_index.np.linalg, "svd", fail)
+    monkeypatch.setattr(analogue_index, "cKDTree", fail)
+    cached = analogue_index.AnalogueIndex(obs, obs_doy, 10, cache_key=cache_key)
+    np.testing.assert_array_equal(cached.query(gcm, 5, 5), expected)
+
+
+@pytest.mark.parametrize(("fallback", "expected"), [(True, None), (False, "index")])
+def test_analogue_index_fallback(fallback, expected):
+    obs = low_rank_days(366 * 3, 40, 40, 0)
+    obs_doy = np.tile(np.arange(366), 3)
+    settings = dict(
+        analogue_index.DEFAULT_SETTINGS,
+        ann_variance=0.1,
+        ann_oversample=1,
+        ann_min_recall=1.0,
+        ann_fallback=fallback,
+    )
+
+    index = analogue_index.build_index(
+        obs[:366], obs_doy[:366], obs, obs_doy, 10, 15, settings
+    )
+    if expected is None:
+        assert index is None
+    else:
+        assert isinstance(index, analogue_index.AnalogueIndex)
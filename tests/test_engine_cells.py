@@ -0,0 +1,148 @@
+import pytest
+import numpy as np
+from netCDF4 import Dataset
+
+from chickadee import cache
+from chickadee.engines import cells, ci, obs_cache, qdm, regrid
+from tests.test_engine_qdm import make_dataset, options
+
+
+# Row 0 is all ocean, row 2 only has data at the end of the record
+LAND = np.array([[0, 0, 0], [1, 1, 0], [0, 0, 1], [1, 1, 1]], bool)
+
+
+@pytest.fixture(autouse=True)
+def disk_cache(tmp_path, monkeypatch):
+    disk_cache = cache.DiskCache(str(tmp_path / "cache"), 2**30)
+    monkeypatch.setattr(obs_cache, "get_cache", lambda: disk_cache)
+    monkeypatch.setattr(regrid.cache, "get_cache", lambda *args: disk_cache)
+    return disk_cache
+
+
+def coastal(rng, loc=0.0, scale=1.0):
+    def values(ntime, nlat, nlon):
+        values = rng.normal(loc, scale, size=(ntime, nlat, nlon))
+        values[:, ~LAND] = np.nan
+        values[: ntime // 2, 2, 2] = np.nan
+        return values
+
+    return values
+
+
+def test_find_valid(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    path = make_dataset(tmp_path / "obs.nc", 1971, 2, coastal(rng), nlat=4)
+    with Dataset(path) as nc:
+        var = nc.variables["tasmax"]
+        np.testing.assert_array_equal(cells.find_valid(var, 100), LAND)
+        np.testing.assert_array_equal(cells.load_valid(path, var, "tasmax", 1.0), LAND)
+
+    def fail(*args):
+        raise AssertionError("valid cells were searched again")
+
+    monkeypatch.setattr(cells, "find_valid", fail)
+    with Dataset(path) as nc:
+        valid = cells.load_valid(path, nc.variables["tasmax"], "tasmax", 1.0)
+    np.testing.assert_array_equal(valid, LAND)
+
+
+def test_row_blocks():
+    np.testing.assert_array_equal(cells.row_offsets(LAND), [0, 0, 2, 3, 6])
+    assert cells.row_blocks(LAND, 100, 1) == [slice(1, 4)]
+    # Rows without valid cells split blocks and are skipped
+    valid = LAND.copy()
+    valid[2] = False
+    assert cells.row_blocks(valid, 100, 1) == [slice(1, 2), slice(3, 4)]
+    # Blocks are sized by their valid cells and the rows they read
+    assert cells.row_blocks(LAND, 6, 1, 1) == [slice(1, 2), slice(2, 3), slice(3, 4)]
+    assert cells.row_blocks(LAND, 9, 1, 1) == [slice(1, 3), slice(3, 4)]
+    assert cells.row_blocks(LAND, 1, 1, 1) == [slice(1, 2), slice(2, 3), slice(3, 4)]
+
+
+def test_row_blocks_follow_chunks():
+    land = np.ones((8, 1), bool)
+    assert cells.row_blocks(land, 3, 1) == [slice(0, 3), slice(3, 6), slice(6, 8)]
+    # Blocks cut short by the budget end on the edge of a chunk of 2 rows
+    assert cells.row_blocks(land, 3, 1, chunks=(2, 0)) == [
+        slice(0, 2),
+        slice(2, 4),
+        slice(4, 6),
+        slice(6, 8),
+    ]
+    # of a window starting at row 1 of the file
+    assert cells.row_blocks(land, 3, 1, chunks=(2, 1)) == [
+        slice(0, 3),
+        slice(3, 5),
+        slice(5, 8),
+    ]
+    # Chunks larger than a block are not followed
+    assert cells.row_blocks(land, 3, 1, chunks=(4, 0)) == [
+        slice(0, 3),
+        slice(3, 6),
+        slice(6, 8),
+    ]
+
+
+def test_scatter():
+    values = np.arange(12.0).reshape(2, 6)
+    grid = cells.scatter(values, LAND)
+    assert grid.shape == (2, 12)
+    np.testing.assert_array_equal(grid[:, LAND.ravel()], values)
+    assert np.isnan(grid[:, ~LAND.ravel()]).all()
+
+
+@pytest.mark.parametrize("num_cores", [1, 2])
+def test_qdm_netcdf_skips_ocean(tmp_path, num_cores):
+    rng = np.random.default_rng(1)
+    obs_file = make_dataset(tmp_path / "obs.nc", 1971, 30, coastal(rng), nlat=4)
+    gcm_file = make_dataset(
+        tmp_path / "gcm.nc",
+        1971,
+        40,
+        lambda *shape: rng.normal(1, 2, size=shape),
+        nlat=4,
+    )
+    output_file = str(tmp_path / "out.nc")
+
+    qdm.qdm_netcdf(
+        obs_file,
+        gcm_file,
+        output_file,
+        "tasmax",
+        options(max_gb=1e-3, jitter_factor=0.0),
+        num_cores,
+    )
+
+    with Dataset(output_file) as nc:
+        tasmax = nc.variables["tasmax"][:]
+    assert tasmax.shape == (40 * 365, 4, 3)
+    assert np.ma.getmaskarray(tasmax)[:, ~LAND].all()
+    # Cells with missing observations stay missing, as before
+    assert np.ma.getmaskarray(tasmax)[:, 2, 2].all()
+    corrected = tasmax[:, [1, 1, 3, 3, 3], [0, 1, 0, 1, 2]]
+    assert not np.ma.getmaskarray(corrected).any()
+    assert abs(corrected.mean()) < 0.5
+
+
+def test_ci_netcdf_skips_ocean(tmp_path):
+    rng = np.random.default_rng(2)
+    obs_file = make_dataset(tmp_path / "obs.nc", 1971, 2, coastal(rng), nlat=4)
+    gcm_file = make_dataset(
+        tmp_path / "gcm.nc", 1971, 3, lambda *shape: rng.normal(size=shape), nlat=4
+    )
+    output_file = str(tmp_path / "out.nc")
+    ci_options = {
+        "units_bool": True,
+        "tasmax_units": "celsius",
+        "max_gb": 1e-3,
+        "start_date": options()["start_date"],
+        "end_date": options()["end_date"],
+    }
+    ci.ci_netcdf(gcm_file, obs_file, output_file, "tasmax", "tasmax", ci_options)
+
+    with Dataset(output_file) as nc:
+        tasmax = nc.variables["tasmax"][:]
+    assert tasmax.shape == (3 * 365, 4, 3)
+    mask = np.ma.getmaskarray(tasmax)
+    assert mask[:, ~LAND].all()
+    assert not mask[:, LAND].any()
@@ -0,0 +1,113 @@
+import os
+import pytest
+import numpy as np
+from datetime import date
+from netCDF4 import Dataset
+
+from chickadee import cache
+from chickadee.engines import ci, regrid, obs_cache
+
+
+DATA = os.path.join(os.path.dirname(__file__), "data")
+
+
+@pytest.fixture
+def regrid_cache(tmp_path, monkeypatch):
+    disk_cache = cache.DiskCache(str(tmp_path / "cache"), 2**20)
+    monkeypatch.setattr(regrid.cache, "get_cache", lambda *args: disk_cache)
+    return disk_cache
+
+
+@pytest.fixture
+def obs_statistics(tmp_path, monkeypatch):
+    disk_cache = cache.DiskCache(str(tmp_path / "obs_cache"), 2**20)
+    monkeypatch.setattr(obs_cache, "get_cache", lambda: disk_cache)
+    return disk_cache
+
+
+def test_bilinear_weights_reproduce_linear_field():
+    src_lat, src_lon = np.array([0.0, 1.0, 2.0]), np.array([350.0, 355.0, 0.0, 5.0])
+    dst_lat, dst_lon = np.array([0.25, 1.5]), np.array([-8.0, -1.0, 2.5])
+    lon = np.where(src_lon > 180, src_lon - 360, src_lon)
+    field = 2 * src_lat[:, None] + 0.5 * lon[None, :]
+
+    weights = regrid.bilinear_weights(src_lat, src_lon, dst_lat, dst_lon)
+
+    expected = 2 * dst_lat[:, None] + 0.5 * dst_lon[None, :]
+    np.testing.assert_allclose(weights @ field.ravel(), expected.ravel(), atol=1e-12)
+    np.testing.assert_allclose(weights.sum(axis=1), 1)
+
+
+def test_bilinear_weights_wrap_around_global_grid():
+    src_lon = np.arange(0, 360, 90.0)
+    weights = regrid.bilinear_weights([0.0], src_lon, [0.0], [-45.0, 135.0])
+    np.testing.assert_allclose(weights.toarray(), [[0.5, 0, 0, 0.5], [0, 0.5, 0.5, 0]])
+
+
+def test_regrid_ignores_missing_values():
+    weights = regrid.bilinear_weights([0.0], [0.0, 1.0], [0.0], [0.5])
+    values = np.array([[1.0, np.nan], [1.0, 3.0]])
+    np.testing.assert_allclose(regrid.regrid(values, weights), [[1.0], [2.0]])
+
+
+def test_weights_are_cached(regrid_cache, monkeypatch):
+    axes = ([0.0, 1.0], [0.0, 1.0], [0.5], [0.5])
+    first = regrid.get_weights(*axes)
+
+    def fail(*args):
+        raise AssertionError("weights were rebuilt")
+
+    monkeypatch.setattr(regrid, "bilinear_weights", fail)
+    second = regrid.get_weights(*axes)
+    assert (first != second).nnz == 0
+
+
+def test_ci_netcdf(tmp_path, regrid_cache, obs_statistics):
+    messages = []
+    output_file = str(tmp_path / "ci.nc")
+    options = {
+        "units_bool": True,
+        "tasmax_units": "celsius",
+        "max_gb": 1e-3,
+        "start_date": date(1950, 1, 1),
+        "end_date": date(1975, 12, 31),
+    }
+
+    ci.ci_netcdf(
+        os.path.join(DATA, "tiny_gcm.nc"),
+        os.path.join(DATA, "tiny_obs.nc"),
+        output_file,
+        "tasmax",
+        "tasmax",
+        options,
+        messages.append,
+    )
+
+    with Dataset(output_file) as nc:
+        tasmax = nc.variables["tasmax"]
+        assert tasmax.shape == (3651, 26, 26)
+        assert tasmax.units == "celsius"
+        assert -80 < tasmax[:].mean() < 40
+    assert any(m.startswith("Applying climatologies to file") for m in messages)
+
+
+def test_obs_climatology_is_cached(obs_statistics, monkeypatch):
+    key = obs_cache.make_key(
+        "monthly_climatology",
+        os.path.join(DATA, "tiny_obs.nc"),
+        date(1970, 1, 1),
+        date(1970, 12, 31),
+        varname="tasmax",
+    )
+    first = obs_cache.load(key, lambda: np.arange(12.0))
+    second = obs_cache.load(key, lambda: pytest.fail("statistic was rebuilt"))
+    np.testing.assert_array_equal(first, second)
+
+    other = obs_cache.make_key(
+        "monthly_climatology",
+        os.path.join(DATA, "tiny_obs.nc"),
+        date(1970, 1, 1),
+        date(1971, 12, 31),
+        varname="tasmax",
+    )
+    assert other != key
@@ -0,0 +1,124 @@
+import time
+import pytest
+import logging
+import threading
+import numpy as np
+from netCDF4 import Dataset
+
+from chickadee.engines import netcdf
+
+
+def test_prefetch_reads_ahead():
+    events = []
+
+    def read(block):
+        events.append(f"read {block}")
+        return block * 10
+
+    results = []
+    for block, data in netcdf.prefetch(read, range(4)):
+        time.sleep(0.05)
+        events.append(f"compute {block}")
+        results.append(data)
+    assert results == [0, 10, 20, 30]
+    # The next block is read while one is computed, but no further
+    assert events.index("read 1") < events.index("compute 0")
+    assert events.index("read 2") > events.index("compute 0")
+
+
+def test_prefetch_errors():
+    def read(block):
+        if block == 2:
+            raise ValueError("bad block")
+        return block
+
+    with pytest.raises(ValueError, match="bad block"):
+        list(netcdf.prefetch(read, range(4)))
+
+
+def test_prefetch_stops_early():
+    reads = []
+    blocks = netcdf.prefetch(reads.append, range(100))
+    next(blocks)
+    blocks.close()
+    assert len(reads) <= 2
+    assert threading.active_count() == 1
+
+
+def test_write_behind():
+    written = []
+
+    def write(block, data):
+        time.sleep(0.02)
+        written.append((block, data))
+
+    with netcdf.write_behind(write) as submit:
+        for block in range(4):
+            submit(block, block * 10)
+    assert written == [(0, 0), (1, 10), (2, 20), (3, 30)]
+
+    def fail(block):
+        raise OSError("disk full")
+
+    with pytest.raises(OSError, match="disk full"):
+        with netcdf.write_behind(fail) as submit:
+            submit(0)
+
+
+def make_chunked(path, chunks, shape=(20, 6, 4)):
+    with Dataset(path, "w") as nc:
+        for name, size in zip(("time", "lat", "lon"), shape):
+            nc.createDimension(name, size)
+        var = nc.createVariable(
+            "tasmax", "f4", ("time", "lat", "lon"), chunksizes=chunks
+        )
+        var[:] = np.zeros(shape)
+    return str(path)
+
+
+def test_aligned_blocks():
+    assert netcdf.aligned_blocks(10, 4) == [slice(0, 4), slice(4, 8), slice(8, 10)]
+    assert netcdf.aligned_blocks(10, 4, (3, 0)) == [
+        slice(0, 3),
+        slice(3, 6),
+        slice(6, 9),
+        slice(9, 10),
+    ]
+    # A window starting at index 2 of the file
+    assert netcdf.aligned_blocks(10, 7, (3, 2)) == [slice(0, 7), slice(7, 10)]
+    # Chunks larger than a block are not followed
+    assert netcdf.aligned_blocks(10, 4, (5, 0)) == netcdf.row_blocks(10, 4)
+
+
+def test_chunk_layout(tmp_path):
+    path = make_chunked(tmp_path / "chunked.nc", (5, 2, 4))
+    with netcdf.open_dataset(path) as nc:
+        var = nc.variables["tasmax"]
+        assert netcdf.chunk_layout(var, 0) == (5, 0)
+        assert netcdf.chunk_layout(var, 1) == (2, 0)
+        assert netcdf.chunking(var) == ("tasmax of chunked.nc", (5, 2, 4))
+    with netcdf.open_dataset(path, {"lat": slice(3, 6)}) as nc:
+        assert netcdf.chunk_layout(nc.variables["tasmax"], 1) == (2, 3)
+    with netcdf.open_dataset(path, {"lat": np.array([0, 5])}) as nc:
+        assert netcdf.chunk_layout(nc.variables["tasmax"], 1) is None
+
+    with Dataset(tmp_path / "classic.nc", "w", format="NETCDF3_CLASSIC") as nc:
+        nc.createDimension("time", 2)
+        var = nc.createVariable("tasmax", "f4", ("time",))
+        assert netcdf.chunk_layout(var, 0) is None
+
+
+def test_time_blocks_plan(tmp_path, caplog):
+    caplog.set_level(logging.INFO, "PYWPS")
+    path = make_chunked(tmp_path / "time_major.nc", (4, 6, 4))
+    with netcdf.open_dataset(path) as nc:
+        blocks = netcdf.time_blocks(nc.variables["tasmax"], 10)
+    assert blocks == [slice(0, 8), slice(8, 16), slice(16, 20)]
+    assert "chunked (4, 6, 4), in blocks of up to 8 timesteps" in caplog.text
+    assert "decompressed" not in caplog.text
+
+    # Whole series of a cell in every chunk
+    path = make_chunked(tmp_path / "cell_major.nc", (20, 1, 4))
+    with netcdf.open_dataset(path) as nc:
+        netcdf.time_blocks(nc.variables["tasmax"], 5)
+    assert "decompressed about 4 times" in caplog.text
@@ -0,0 +1,176 @@
+import pytest
+import numpy as np
+from datetime import date
+from netCDF4 import Dataset
+
+from chickadee import cache
+from chickadee.engines import qdm, obs_cache
+
+
+@pytest.fixture
+def obs_statistics(tmp_path, monkeypatch):
+    disk_cache = cache.DiskCache(str(tmp_path / "cache"), 2**30)
+    monkeypatch.setattr(obs_cache, "get_cache", lambda: disk_cache)
+    return disk_cache
+
+
+def make_dataset(path, start_year, years, values, units="celsius", nlat=2, nlon=3):
+    ntime = 365 * years
+    with Dataset(path, "w") as nc:
+        nc.createDimension("time", None)
+        nc.createDimension("lat", nlat)
+        nc.createDimension("lon", nlon)
+        time = nc.createVariable("time", "f8", ("time",))
+        time.units = f"days since {start_year}-01-01"
+        time.calendar = "365_day"
+        time[:] = np.arange(ntime)
+        nc.createVariable("lat", "f4", ("lat",))[:] = np.arange(nlat)
+        nc.createVariable("lon", "f4", ("lon",))[:] = np.arange(nlon)
+        var = nc.createVariable(
+            "tasmax", "f4", ("time", "lat", "lon"), fill_value=np.float32(1e20)
+        )
+        var.units = units
+        var[:] = values(ntime, nlat, nlon)
+    return str(path)
+
+
+def options(**kwargs):
+    return dict(
+        {
+            "units_bool": True,
+            "n_pr_bool": True,
+            "tasmax_units": "celsius",
+            "max_gb": 1.0,
+            "start_date": date(1971, 1, 1),
+            "end_date": date(2000, 12, 31),
+            "multiyear": True,
+            "expand_multiyear": True,
+            "multiyear_window_length": 30,
+            "trace": 0.005,
+            "jitter_factor": 0.01,
+            "tasmax_tau": 101,
+            "tasmax_seasonal": False,
+            "tasmax_ratio": False,
+        },
+        **kwargs,
+    )
+
+
+def test_additive_shift():
+    rng = np.random.default_rng(0)
+    m_c = rng.normal(10, 3, size=(3000, 5))
+    m_p = rng.normal(12, 3, size=(3000, 5))
+    mhat_p = qdm.quantile_delta_mapping(m_c - 4, m_c, m_p, n_tau=101, rng=rng)
+    np.testing.assert_allclose(mhat_p, m_p - 4, atol=0.5)
+
+
+def test_ratio_scaling():
+    rng = np.random.default_rng(0)
+    m_c = rng.gamma(2, 2, size=(3000, 4))
+    m_p = rng.gamma(2, 2, size=(3000, 4))
+    mhat_p = qdm.quantile_delta_mapping(m_c * 2, m_c, m_p, ratio=True, rng=rng)
+    wet = m_p > 1
+    np.testing.assert_allclose(mhat_p[wet], 2 * m_p[wet], rtol=0.1)
+
+
+def test_jitter_only_constant_cells():
+    rng = np.random.default_rng(0)
+    m_c = rng.normal(10, 3, size=(1000, 2))
+    m_p = rng.normal(12, 3, size=(1000, 2))
+    m_p[:, 1] = 5.0
+    mhat_p = qdm.quantile_delta_mapping(m_c - 4, m_c, m_p, n_tau=101, rng=rng)
+    # A constant cell elsewhere in the block leaves this one unjittered
+    alone = qdm.quantile_delta_mapping(
+        m_c[:, :1] - 4, m_c[:, :1], m_p[:, :1], n_tau=101, rng=rng
+    )
+    np.testing.assert_array_equal(mhat_p[:, 0], alone[:, 0])
+    assert np.isfinite(mhat_p[:, 1]).all()
+
+
+def test_correct_cells_uncorrected_timesteps():
+    rng = np.random.default_rng(0)
+    gcm = rng.normal(10, 3, size=(20, 2))
+    quantiles = np.quantile(gcm, np.linspace(0, 1, 11), axis=0)[np.newaxis]
+    groups = [(0, np.arange(10), np.arange(10))]
+    params = {"ratio": False, "trace": 0.05, "jitter_factor": 0.0, "n_tau": 11}
+    out = qdm.correct_cells(quantiles, gcm, groups, params, rng)
+    assert np.isfinite(out[:10]).all()
+    assert np.isnan(out[10:]).all()
+
+
+@pytest.mark.parametrize(
+    ("expand_multiyear", "seasonal", "expected"),
+    [(True, False, 2), (False, False, 3), (True, True, 24)],
+)
+def test_qdm_groups(expand_multiyear, seasonal, expected):
+    days = np.arange(365 * 70)
+    dates = np.column_stack(
+        [1971 + days // 365, (days % 365) // 31 % 12 + 1, days % 31 + 1]
+    )
+    windows, groups = qdm.qdm_groups(
+        dates[: 365 * 30],
+        dates,
+        date(1971, 1, 1),
+        date(2000, 12, 31),
+        expand_multiyear=expand_multiyear,
+        seasonal=seasonal,
+    )
+    assert len(groups) == expected
+    assert sum(len(p) for _, _, p in groups) == len(dates)
+    assert len(windows) == (12 if seasonal else 1)
+
+
+@pytest.mark.parametrize("num_cores", [1, 2])
+def test_qdm_netcdf(tmp_path, num_cores, obs_statistics, monkeypatch):
+    def seasonal_cycle(offset):
+        def values(ntime, nlat, nlon):
+            rng = np.random.default_rng(offset)
+            cycle = 10 * np.sin(np.arange(ntime) / 365 * 2 * np.pi)
+            data = offset + cycle[:, None, None] + rng.normal(size=(ntime, nlat, nlon))
+            data = np.ma.masked_array(data)
+            data[:, 0, 0] = np.ma.masked
+            return data
+
+        return values
+
+    obs_file = make_dataset(tmp_path / "obs.nc", 1971, 30, seasonal_cycle(0))
+    gcm_file = make_dataset(
+        tmp_path / "gcm.nc", 1971, 60, seasonal_cycle(280), units="K"
+    )
+    output_file = str(tmp_path / "out.nc")
+
+    qdm.qdm_netcdf(
+        obs_file,
+        gcm_file,
+        output_file,
+        "tasmax",
+        options(max_gb=1e-4),
+        num_cores,
+    )
+
+    with Dataset(output_file) as nc:
+        tasmax = nc.variables["tasmax"]
+        assert tasmax.units == "celsius"
+        assert tasmax.shape == (365 * 60, 2, 3)
+        values = tasmax[:]
+    assert values[:, 0, 0].mask.all()
+    # The 280 K bias of the GCM is removed
+    assert abs(values[:, 1:, :].mean()) < 0.5
+
+    # The quantiles of the observations now come from the cache
+    def fail(*args):
+        raise AssertionError("observations were read again")
+
+    monkeypatch.setattr(qdm, "window_quantiles", fail)
+    qdm.qdm_netcdf(obs_file, gcm_file, output_file, "tasmax", options(max_gb=1e-4), 1)
+    with Dataset(output_file) as nc:
+        cached_values = nc.variables["tasmax"][:]
+    assert cached_values[:, 0, 0].mask.all()
+    np.testing.assert_allclose(cached_values, values, atol=0.1)
+
+
+def test_qdm_netcdf_missing_variable(tmp_path):
+    values = lambda ntime, nlat, nlon: np.zeros((ntime, nlat, nlon))
+    obs_file = make_dataset(tmp_path / "obs.nc", 1971, 30, values)
+    with pytest.raises(ValueError):
+        qdm.qdm_netcdf(obs_file, obs_file, str(tmp_path / "out.nc"), "pr", options(), 1)
@@ -0,0 +1,168 @@
+import os
+import pytest
+import numpy as np
+from datetime import date
+from netCDF4 import Dataset
+
+from chickadee import cache
+from chickadee.engines import ca, ci, qdm, regrid, obs_cache, netcdf
+from chickadee.engines.subset import (
+    Subset,
+    lat_index,
+    lon_index,
+    parse_bbox,
+    parse_time_range,
+    write_subset,
+)
+from tests.test_engine_qdm import make_dataset, options as qdm_options
+
+
+DATA = os.path.join(os.path.dirname(__file__), "data")
+GCM_FILE = os.path.join(DATA, "tiny_gcm.nc")
+OBS_FILE = os.path.join(DATA, "tiny_obs.nc")
+
+
+@pytest.fixture(autouse=True)
+def disk_caches(tmp_path, monkeypatch):
+    disk_cache = cache.DiskCache(str(tmp_path / "cache"), 2**30)
+    monkeypatch.setattr(regrid.cache, "get_cache", lambda *args: disk_cache)
+    monkeypatch.setattr(obs_cache, "get_cache", lambda: disk_cache)
+    return disk_cache
+
+
+@pytest.mark.parametrize(
+    "text", ["1,2,3", "a,b,c,d", "0,10,5,0", "1971-01-01", "2000-01-01/1971-01-01"]
+)
+def test_invalid_inputs(text):
+    with pytest.raises(ValueError):
+        Subset.from_inputs(*(text, None) if "," in text else (None, text))
+
+
+def test_from_inputs():
+    assert Subset.from_inputs(None, None) is None
+    subset = Subset.from_inputs("-93,68.5,-92,69", "1966-01-01/1966-12-31")
+    assert subset.bbox == parse_bbox("-93,68.5,-92,69") == (-93.0, 68.5, -92.0, 69.0)
+    assert subset.time_range == parse_time_range("1966-01-01 / 1966-12-31")
+
+
+def test_lat_index_keeps_neighbours():
+    lat = np.arange(-90, 91, 10.0)
+    assert lat_index(lat, 15, 35) == slice(10, 14)
+    assert lat_index(lat[::-1], 15, 35) == slice(5, 9)
+
+
+@pytest.mark.parametrize("lon", [np.arange(0, 360, 10.0), np.arange(-180, 180, 10.0)])
+def test_lon_index_across_antimeridian(lon):
+    index = lon_index(lon, 165, -165)
+    assert sorted(lon[index] % 360) == [160, 170, 180, 190, 200]
+    index = lon_index(lon, -15, 15)
+    assert sorted(lon[index] % 360) == [0, 10, 20, 340, 350]
+    assert lon_index(lon, -180, 180) == slice(0, 36)
+
+
+def test_view_reads_hyperslabs():
+    window = {"lat": slice(2, 9), "lon": np.array([0, 3, 4, 10]), "time": slice(5, 50)}
+    with Dataset(OBS_FILE) as nc:
+        expected = nc.variables["tasmax"][5:50, 2:9][:, :, [0, 3, 4, 10]]
+        lat = nc.variables["lat"][2:9]
+    with netcdf.open_dataset(OBS_FILE, window) as nc:
+        tasmax = nc.variables["tasmax"]
+        assert tasmax.shape == (45, 7, 4)
+        assert len(nc.dimensions["lat"]) == 7
+        np.testing.assert_array_equal(tasmax[:], expected)
+        np.testing.assert_array_equal(tasmax[3:10, 1, ::2], expected[3:10, 1, ::2])
+        np.testing.assert_array_equal(nc.variables["lat"][:], lat)
+        assert tasmax.units == "degC"
+
+
+def test_write_subset(tmp_path):
+    subset = Subset.from_inputs("-92.5,68.5,-92,69", "1966-01-01/1966-12-31")
+    assert write_subset(None, GCM_FILE, str(tmp_path / "none.nc")) == GCM_FILE
+
+    output_file = write_subset(
+        subset,
+        GCM_FILE,
+        str(tmp_path / "gcm.nc"),
+        (date(1970, 1, 1), date(1970, 12, 31)),
+    )
+    with Dataset(output_file) as nc:
+        # The calibration year and the time range, around two GCM cells
+        assert nc.variables["tasmax"].shape == (730, 2, 2)
+        dates = netcdf.read_dates(nc, "tasmax")
+        assert sorted(set(dates[:, 0])) == [1966, 1970]
+
+
+def test_ci_netcdf_subset(tmp_path):
+    options = {
+        "units_bool": True,
+        "tasmax_units": "celsius",
+        "max_gb": 1e-3,
+        "start_date": date(1970, 1, 1),
+        "end_date": date(1971, 12, 31),
+    }
+    full_file, subset_file = str(tmp_path / "full.nc"), str(tmp_path / "subset.nc")
+    ci.ci_netcdf(GCM_FILE, OBS_FILE, full_file, "tasmax", "tasmax", options)
+    subset = Subset.from_inputs("-92.5,68.5,-92,69", "1966-01-01/1966-12-31")
+    ci.ci_netcdf(
+        GCM_FILE, OBS_FILE, subset_file, "tasmax", "tasmax", options, subset=subset
+    )
+
+    with Dataset(full_file) as full, Dataset(subset_file) as nc:
+        lat, lon = nc.variables["lat"][:], nc.variables["lon"][:]
+        assert len(lat) < 26 and len(lon) < 26
+        assert nc.variables["tasmax"].shape == (3 * 365, len(lat), len(lon))
+        rows = np.flatnonzero(np.isin(full.variables["lat"][:], lat))
+        cols = np.flatnonzero(np.isin(full.variables["lon"][:], lon))
+        keep = netcdf.in_period(
+            netcdf.read_dates(full, "tasmax"), date(1970, 1, 1), date(1971, 12, 31)
+        ) | netcdf.in_period(
+            netcdf.read_dates(full, "tasmax"), date(1966, 1, 1), date(1966, 12, 31)
+        )
+        expected = full.variables["tasmax"][keep][:, rows][:, :, cols]
+        np.testing.assert_allclose(nc.variables["tasmax"][:], expected, rtol=1e-6)
+
+
+def test_ca_netcdf_subset():
+    options = {
+        "units_bool": True,
+        "n_pr_bool": True,
+        "tasmax_units": "celsius",
+        "max_gb": 1.0,
+        "start_date": date(1971, 1, 1),
+        "end_date": date(2005, 12, 31),
+        "num_analogues": 30,
+        "delta_days": 45,
+        "trimmed_mean": 0.0,
+        "tol": 0.1,
+    }
+    subset = Subset.from_inputs("-93,68.5,-92,69", "1966-01-01/1966-12-31")
+    analogues = ca.ca_netcdf(GCM_FILE, OBS_FILE, "tasmax", options, subset=subset)
+    # The calibration period (1971 to 1975) and the time range
+    assert len(analogues["indices"]) == 1461 + 365
+    indices = np.concatenate(analogues["indices"])
+    assert indices.min() >= 1 and indices.max() <= 751
+
+
+def test_qdm_netcdf_subset(tmp_path):
+    rng = np.random.default_rng(0)
+    obs_file = make_dataset(
+        tmp_path / "obs.nc", 1971, 30, lambda *shape: rng.normal(size=shape), nlat=4
+    )
+    gcm_file = make_dataset(
+        tmp_path / "gcm.nc",
+        1971,
+        40,
+        lambda *shape: rng.normal(1, 2, size=shape),
+        nlat=4,
+    )
+    options = qdm_options(jitter_factor=0.0)
+    full_file, subset_file = str(tmp_path / "full.nc"), str(tmp_path / "subset.nc")
+    qdm.qdm_netcdf(obs_file, gcm_file, full_file, "tasmax", options)
+    subset = Subset.from_inputs("2,3,2,3")
+    qdm.qdm_netcdf(obs_file, gcm_file, subset_file, "tasmax", options, subset=subset)
+
+    with Dataset(full_file) as full, Dataset(subset_file) as nc:
+        assert nc.variables["tasmax"].shape == (40 * 365, 2, 2)
+        np.testing.assert_allclose(
+            nc.variables["tasmax"][:], full.variables["tasmax"][:, 2:4, 1:3]
+        )
@@ -0,0 +1,176 @@
+import os
+import time
+import hashlib
+import pytest
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+from pywps.exceptions import FileSizeExceeded
+
+from chickadee import cache, input_cache
+
+
+class StandInHandler(SimpleHTTPRequestHandler):
+    """Static file server that sends ETags and records its downloads"""
+
+    downloads = []
+    with_etag = True
+    refuse_head = False
+    send_length = True
+
+    def end_headers(self):
+        path = self.translate_path(self.path)
+        if self.with_etag and os.path.isfile(path):
+            with open(path, "rb") as f:
+                self.send_header("ETag", f'"{hashlib.md5(f.read()).hexdigest()}"')
+        super().end_headers()
+
+    def send_header(self, keyword, value):
+        if keyword == "Content-Length" and not self.send_length:
+            return
+        super().send_header(keyword, value)
+
+    def do_HEAD(self):
+        if self.refuse_head:
+            self.send_error(405)
+            return
+        super().do_HEAD()
+
+    def do_GET(self):
+        self.downloads.append(self.path)
+        time.sleep(0.1)
+        super().do_GET()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(tmp_path):
+    root = tmp_path / "remote"
+    root.mkdir()
+    StandInHandler.downloads = []
+    httpd = ThreadingHTTPServer(
+        ("127.0.0.1", 0), partial(StandInHandler, directory=str(root))
+    )
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield root, f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def inputs_cache(tmp_path, monkeypatch):
+    disk_cache = cache.DiskCache(str(tmp_path / "cache"), 2**20)
+    monkeypatch.setattr(input_cache, "get_input_cache", lambda: disk_cache)
+    return disk_cache
+
+
+def test_fetch_reuses_cached_download(tmp_path, server, inputs_cache):
+    root, url = server
+    (root / "gcm.nc").write_bytes(b"a" * 100)
+
+    for i in range(2):
+        dest = input_cache.fetch(f"{url}/gcm.nc", str(tmp_path / f"gcm{i}.nc"))
+        assert open(dest, "rb").read() == b"a" * 100
+    assert StandInHandler.downloads == ["/gcm.nc"]
+
+
+def test_changed_etag_is_downloaded_again(tmp_path, server, inputs_cache):
+    root, url = server
+    (root / "gcm.nc").write_bytes(b"a" * 100)
+    input_cache.fetch(f"{url}/gcm.nc", str(tmp_path / "first.nc"))
+
+    (root / "gcm.nc").write_bytes(b"b" * 100)
+    dest = input_cache.fetch(f"{url}/gcm.nc", str(tmp_path / "second.nc"))
+    assert open(dest, "rb").read() == b"b" * 100
+    assert len(StandInHandler.downloads) == 2
+
+
+def test_concurrent_jobs_download_once(tmp_path, server, inputs_cache):
+    root, url = server
+    (root / "obs.nc").write_bytes(b"o" * 1000)
+
+    threads = [
+        threading.Thread(
+            target=input_cache.fetch,
+            args=(f"{url}/obs.nc", str(tmp_path / f"obs{i}.nc")),
+        )
+        for i in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert StandInHandler.downloads == ["/obs.nc"]
+    assert all(os.path.getsize(tmp_path / f"obs{i}.nc") == 1000 for i in range(4))
+
+
+def test_quota_evicts_least_recently_used(tmp_path, server, monkeypatch):
+    disk_cache = cache.DiskCache(str(tmp_path / "cache"), 250)
+    monkeypatch.setattr(input_cache, "get_input_cache", lambda: disk_cache)
+    root, url = server
+    for name in ("a.nc", "b.nc", "c.nc"):
+        (root / name).write_bytes(b"x" * 100)
+        input_cache.fetch(f"{url}/{name}", str(tmp_path / name))
+        time.sleep(0.01)
+
+    input_cache.fetch(f"{url}/a.nc", str(tmp_path / "again.nc"))
+    assert StandInHandler.downloads.count("/a.nc") == 2
+    assert sum(size for _, size, _ in disk_cache._entries()) <= 250
+
+
+def test_no_validator_is_not_cached(tmp_path, server, inputs_cache, monkeypatch):
+    monkeypatch.setattr(input_cache, "http_validator", lambda url: None)
+    root, url = server
+    (root / "gcm.nc").write_bytes(b"a")
+    for i in range(2):
+        input_cache.fetch(f"{url}/gcm.nc", str(tmp_path / f"gcm{i}.nc"))
+    assert len(StandInHandler.downloads) == 2
+    assert inputs_cache._entries() == []
+
+
+def test_refused_head_is_downloaded(tmp_path, server, inputs_cache, monkeypatch):
+    monkeypatch.setattr(StandInHandler, "refuse_head", True)
+    root, url = server
+    (root / "gcm.nc").write_bytes(b"a")
+    dest = input_cache.fetch(f"{url}/gcm.nc", str(tmp_path / "gcm.nc"))
+    assert open(dest, "rb").read() == b"a"
+    assert inputs_cache._entries() == []
+
+
+def test_dap_validator_follows_dds(server):
+    root, url = server
+    (root / "gcm.nc.dds").write_text("Dataset { Float32 tasmax[time = 10]; } gcm;")
+    (root / "gcm.nc.das").write_text("Attributes {}")
+    first = input_cache.dap_validator(f"{url}/gcm.nc")
+
+    (root / "gcm.nc.dds").write_text("Dataset { Float32 tasmax[time = 11]; } gcm;")
+    assert input_cache.dap_validator(f"{url}/gcm.nc") != first
+
+
+@pytest.mark.parametrize("send_length", [True, False])
+def test_large_input_is_refused(
+    tmp_path, server, inputs_cache, monkeypatch, send_length
+):
+    # Without a Content-Length the download stops once it read too much
+    monkeypatch.setattr(StandInHandler, "send_length", send_length)
+    monkeypatch.setattr(input_cache, "get_max_bytes", lambda: 2**10)
+    monkeypatch.setattr(cache, "CHUNK_SIZE", 2**8)
+    root, url = server
+    (root / "gcm.nc").write_bytes(b"a" * 2**11)
+    dest = tmp_path / "gcm.nc"
+    with pytest.raises(FileSizeExceeded):
+        input_cache.fetch(f"{url}/gcm.nc", str(dest))
+    assert not dest.exists() and not (tmp_path / "gcm.nc.part").exists()
+    assert inputs_cache._entries() == []
+
+
+def test_dap_url_keeps_constraint():
+    assert (
+        input_cache.dap_url("http://host/dodsC/gcm.nc?tasmax[0:1]#top", ".dds")
+        == "http://host/dodsC/gcm.nc.dds?tasmax[0:1]#top"
+    )
@@ -0,0 +1,85 @@
+import os
+import pytest
+import numpy as np
+from click.testing import CliRunner
+from netCDF4 import Dataset
+
+from chickadee import cache, obs_registry
+from chickadee.engines import netcdf
+from chickadee.cli import cli
+
+
+OBS_FILE = os.path.join(os.path.dirname(__file__), "data", "tiny_obs.nc")
+
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch):
+    registry_dir = str(tmp_path / "registry")
+    os.makedirs(registry_dir)
+    monkeypatch.setattr(obs_registry, "get_registry_dir", lambda: registry_dir)
+    return registry_dir
+
+
+def test_chunk_shape():
+    assert netcdf.chunk_shape((10, 20, 30), 4, "time_major") == (10, 20, 30)
+    assert netcdf.chunk_shape((2**20, 20, 30), 4, "cell_major") == (
+        2**20,
+        1,
+        1,
+    )
+    assert netcdf.chunk_shape((10, 20, 30), 4, "cell_major") == (10, 1, 30)
+
+
+def test_ingest_layouts(registry):
+    entry = obs_registry.ingest(OBS_FILE, "tiny", max_gb=1e-4)
+    assert entry["digest"] == cache.file_digest(OBS_FILE)
+    assert entry["variables"] == {"tasmax": [751, 26, 26]}
+
+    with Dataset(OBS_FILE) as source:
+        expected = source.variables["tasmax"][:]
+    for layout, chunks in (("time_major", [751, 26, 26]), ("cell_major", [751, 1, 26])):
+        with Dataset(obs_registry.resolve("tiny", layout)) as nc:
+            tasmax = nc.variables["tasmax"]
+            assert tasmax.chunking() == chunks
+            np.testing.assert_array_equal(tasmax[:], expected)
+            assert nc.variables["time"].units.startswith("days since")
+
+
+def test_resolve_reuses_digest(registry):
+    entry = obs_registry.ingest(OBS_FILE, "tiny")
+    path = obs_registry.resolve("tiny", "cell_major")
+    assert cache.input_digest(path) == entry["digest"]
+
+
+def test_get_obs_file(registry):
+    obs_registry.ingest(OBS_FILE, "tiny")
+    assert obs_registry.get_obs_file(OBS_FILE, None, "time_major") == OBS_FILE
+    assert obs_registry.get_obs_file(None, "tiny", "time_major").endswith(
+        "time_major.nc"
+    )
+    with pytest.raises(ValueError):
+        obs_registry.get_obs_file(None, "missing", "time_major")
+    with pytest.raises(ValueError):
+        obs_registry.get_obs_file(None, None, "time_major")
+
+
+@pytest.mark.parametrize("obs_id", ["../escape", ".hidden", ""])
+def test_invalid_id(registry, obs_id):
+    with pytest.raises(ValueError):
+        obs_registry.get_entry(obs_id)
+
+
+def test_cli(registry):
+    runner = CliRunner()
+    result = runner.invoke(cli, ["obs", "ingest", OBS_FILE, "--id", "tiny"])
+    assert result.exit_code == 0 and result.output.strip() == "tiny"
+
+    result = runner.invoke(cli, ["obs", "ingest", OBS_FILE, "--id", "tiny"])
+    assert result.exit_code != 0 and "already registered" in result.output
+
+    result = runner.invoke(cli, ["obs", "list"])
+    assert result.output.startswith("tiny\ttasmax\t")
+
+    result = runner.invoke(cli, ["obs", "remove", "tiny"])
+    assert result.exit_code == 0
+    assert obs_registry.list_entries() == []
@@ -0,0 +1,109 @@
+import os
+import pytest
+import numpy as np
+from datetime import date
+from netCDF4 import Dataset
+
+from chickadee import preflight
+from tests.test_engine_qdm import make_dataset, options
+
+
+DATA = os.path.join(os.path.dirname(__file__), "data")
+GCM_FILE = os.path.join(DATA, "tiny_gcm.nc")
+OBS_FILE = os.path.join(DATA, "tiny_obs.nc")
+
+
+def values(ntime, nlat, nlon):
+    return np.zeros((ntime, nlat, nlon))
+
+
+@pytest.fixture
+def files(tmp_path):
+    gcm = make_dataset(tmp_path / "gcm.nc", 1961, 60, values, units="K")
+    obs = make_dataset(tmp_path / "obs.nc", 1961, 40, values)
+    return gcm, obs
+
+
+@pytest.mark.parametrize("process", ["ca", "ci", "qdm", "rerank", "bccaq"])
+def test_valid_inputs(files, process):
+    preflight.check(process, *files, "tasmax", "tasmax", options())
+
+
+def test_tiny_inputs():
+    calibration = {"start_date": date(1971, 1, 1), "end_date": date(1972, 12, 31)}
+    preflight.check(
+        "ca", GCM_FILE, OBS_FILE, "tasmax", "tasmax", options(**calibration)
+    )
+
+
+def test_missing_variable(files):
+    with pytest.raises(ValueError, match="'tasmin' not found in GCM file.*tasmax"):
+        preflight.check("qdm", *files, "tasmin", "tasmax", options())
+    with pytest.raises(ValueError, match="'tx' not found in observations file"):
+        preflight.check("ci", *files, "tasmax", "tx", options())
+
+
+def test_not_a_grid(files):
+    with pytest.raises(ValueError, match="time, lat and lon"):
+        preflight.check("ci", *files, "lat", "tasmax", options())
+
+
+def test_unreadable_file(files, tmp_path):
+    (tmp_path / "text.nc").write_text("not netcdf")
+    with pytest.raises(ValueError, match="Cannot read the observations file"):
+        preflight.check(
+            "ci", files[0], str(tmp_path / "text.nc"), "tasmax", "tasmax", options()
+        )
+
+
+@pytest.mark.parametrize(
+    ("start", "end", "match"),
+    [
+        (date(2005, 1, 1), date(2010, 12, 31), "observations file .* does not cover"),
+        (date(1940, 1, 1), date(1950, 12, 31), "GCM file .* does not cover"),
+        (date(1990, 1, 1), date(1980, 12, 31), "starts after it ends"),
+    ],
+)
+def test_calibration_period(files, start, end, match):
+    with pytest.raises(ValueError, match=match):
+        preflight.check(
+            "qdm", *files, "tasmax", "tasmax", options(start_date=start, end_date=end)
+        )
+
+
+def test_calendar(files):
+    with Dataset(files[0], "a") as nc:
+        nc.variables["time"].calendar = "martian"
+    with pytest.raises(ValueError, match="time axis of the GCM file"):
+        preflight.check("qdm", *files, "tasmax", "tasmax", options())
+
+
+def test_units(files):
+    with Dataset(files[1], "a") as nc:
+        nc.variables["tasmax"].units = "mm/day"
+    with pytest.raises(ValueError, match="'K' of the GCM file .* 'mm/day'"):
+        preflight.check("qdm", *files, "tasmax", "tasmax", options())
+    # Only converted with units_bool
+    preflight.check("qdm", *files, "tasmax", "tasmax", options(units_bool=False))
+
+    with Dataset(files[1], "a") as nc:
+        nc.variables["tasmax"].units = "degree_Celsius"
+    # Left to ClimDown
+    preflight.check("qdm", *files, "tasmax", "tasmax", options())
+    with pytest.raises(ValueError, match="target units 'mm'"):
+        preflight.check("qdm", *files, "tasmax", "tasmax", options(tasmax_units="mm"))
+
+    with Dataset(files[1], "a") as nc:
+        nc.variables["tasmax"].delncattr("units")
+    with pytest.raises(ValueError, match="no units"):
+        preflight.check("qdm", *files, "tasmax", "tasmax", options())
+
+
+def test_grid(files, tmp_path):
+    coarse = make_dataset(tmp_path / "coarse.nc", 1961, 60, values, nlat=1, nlon=1)
+    # CA and CI regrid the GCM
+    preflight.check("ca", coarse, files[1], "tasmax", "tasmax", options())
+    with pytest.raises(ValueError, match="grid of the observations"):
+        preflight.check("qdm", coarse, files[1], "tasmax", "tasmax", options())
+    with pytest.raises(ValueError, match="QDM file must be on the grid"):
+        preflight.check("rerank", coarse, files[1], "tasmax", "tasmax", options())
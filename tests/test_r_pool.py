@@ -0,0 +1,102 @@
+import os
+import pickle
+import pytest
+
+robjects = pytest.importorskip("rpy2.robjects")
+
+from chickadee import r_pool
+
+
+def r_sum(values):
+    robjects.r("print('summing')")
+    return sum(robjects.r["sum"](robjects.FloatVector(values)))
+
+
+def set_option(value):
+    robjects.r(f"options(chickadee.test = {value})")
+
+
+def get_option():
+    return robjects.r("getOption('chickadee.test', 0)")[0]
+
+
+def unpicklable_result():
+    return lambda: None
+
+
+def fail_to_load():
+    raise AttributeError("gone")
+
+
+class FailsToLoad:
+    def __reduce__(self):
+        return fail_to_load, ()
+
+
+@pytest.fixture
+def pool(tmp_path, monkeypatch):
+    def get_runtime_dir(*subdirs):
+        path = tmp_path.joinpath(*subdirs)
+        path.mkdir(parents=True, exist_ok=True)
+        return str(path)
+
+    monkeypatch.setattr(r_pool.util, "get_runtime_dir", get_runtime_dir)
+    pool = r_pool.RWorkerPool(1)
+    yield pool
+    pool.stop()
+
+
+@pytest.fixture
+def cluster():
+    yield
+    r_pool.stop_parallel()
+
+
+def test_restore_options():
+    saved = robjects.r("options()")
+    robjects.r("options(chickadee.test = 1, digits = 3)")
+    r_pool._restore_options(saved)
+    assert robjects.r("getOption('digits')")[0] == 7
+    assert robjects.r("is.null(getOption('chickadee.test'))")[0]
+
+
+def test_register_parallel(cluster, monkeypatch):
+    monkeypatch.setitem(r_pool._settings, "cluster_max_jobs", 2)
+    monkeypatch.setitem(r_pool._settings, "cluster_cores", 2)
+    r_pool.register_parallel(1)
+    first = r_pool._cluster
+    assert robjects.r("foreach::getDoParWorkers()")[0] == 1
+    # A job asking for more cores shares the cluster
+    r_pool.register_parallel(2)
+    assert r_pool._cluster is first
+    assert robjects.r("foreach::getDoParWorkers()")[0] == 2
+    # Recycled once it served cluster_max_jobs jobs
+    r_pool.register_parallel(2)
+    assert r_pool._cluster is not first
+    assert r_pool._cluster_jobs == 1
+
+
+def test_pool_run(pool):
+    console = []
+    assert pool.run(r_sum, [1, 2, 3], on_console=console.append) == 6
+    assert "summing" in "".join(console)
+
+
+def test_pool_isolates_options(pool):
+    pool.run(set_option, 2)
+    assert pool.run(get_option) == 0
+
+
+def test_pool_survives_pickling_errors(pool):
+    with pytest.raises((pickle.PicklingError, AttributeError)):
+        pool.run(unpicklable_result)
+    with pytest.raises(AttributeError):
+        pool.run(r_sum, FailsToLoad())
+    # The worker is still serving
+    assert pool.run(r_sum, [1, 2]) == 3
+
+
+def test_pool_stop(pool):
+    pool.start()
+    pool.stop()
+    assert not os.path.exists(pool.runtime_dir)
@@ -0,0 +1,105 @@
+import os
+import pytest
+from pywps.app.exceptions import ProcessError
+
+from chickadee import staging
+
+
+class FakeInput:
+    def __init__(self, prop, file=None, url=None, data=None):
+        self.prop = prop
+        self.file = file
+        self.url = url
+        self.data = data
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    (data_dir / "gcm.nc").write_bytes(b"x" * 10)
+    monkeypatch.setattr(staging, "allowed_input_paths", lambda: [str(data_dir)])
+    monkeypatch.setattr(
+        staging.io,
+        "collect_args",
+        lambda inputs, workdir: {k: v[0].data for k, v in inputs.items()},
+    )
+    return data_dir
+
+
+@pytest.mark.parametrize("mode", ["path", "symlink", "copy"])
+def test_local_paths_are_not_copied(tmp_path, data_dir, monkeypatch, mode):
+    monkeypatch.setattr(staging, "get_staging_mode", lambda: mode)
+    workdir = tmp_path / "workdir"
+    workdir.mkdir()
+    gcm_file = str(data_dir / "gcm.nc")
+    inputs = {
+        "gcm_file": [FakeInput("url", url=gcm_file)],
+        "varname": [FakeInput("data", data="tasmax")],
+    }
+
+    args = staging.collect_args(inputs, str(workdir))
+
+    assert list(args) == ["gcm_file", "varname"]
+    assert args["varname"] == "tasmax"
+    if mode == "path":
+        assert args["gcm_file"] == gcm_file
+    else:
+        assert os.path.dirname(args["gcm_file"]) == str(workdir)
+        assert os.path.islink(args["gcm_file"]) == (mode == "symlink")
+        assert os.path.getsize(args["gcm_file"]) == 10
+
+
+@pytest.mark.parametrize("mode", ["symlink", "copy"])
+def test_same_file_names_do_not_collide(tmp_path, data_dir, monkeypatch, mode):
+    monkeypatch.setattr(staging, "get_staging_mode", lambda: mode)
+    workdir = tmp_path / "workdir"
+    workdir.mkdir()
+    (data_dir / "obs").mkdir()
+    (data_dir / "obs" / "gcm.nc").write_bytes(b"y" * 20)
+    inputs = {
+        "gcm_file": [FakeInput("url", url=str(data_dir / "gcm.nc"))],
+        "obs_file": [FakeInput("url", url=str(data_dir / "obs" / "gcm.nc"))],
+    }
+
+    args = staging.collect_args(inputs, str(workdir))
+
+    assert args["gcm_file"] != args["obs_file"]
+    assert os.path.getsize(args["gcm_file"]) == 10
+    assert os.path.getsize(args["obs_file"]) == 20
+
+
+def test_file_reference_resolves_pywps_link(tmp_path, data_dir):
+    workdir = tmp_path / "workdir"
+    workdir.mkdir()
+    link = workdir / "gcm.nc"
+    os.symlink(data_dir / "gcm.nc", link)
+
+    source = staging.local_source(FakeInput("file", file=str(link)), str(workdir))
+    assert source == str(data_dir / "gcm.nc")
+
+    # A copy pywps made in the workdir is left to wps_tools
+    copy = workdir / "copy.nc"
+    copy.write_bytes(b"x")
+    assert staging.local_source(FakeInput("file", file=str(copy)), str(workdir)) is None
+
+
+def test_remote_inputs_are_left_to_wps_tools(tmp_path):
+    url = FakeInput("url", url="https://example.org/dodsC/gcm.nc")
+    assert staging.local_source(url, str(tmp_path)) is None
+
+
+@pytest.mark.parametrize("name", ["../outside.nc", "link.nc"])
+def test_paths_outside_allowed_are_rejected(tmp_path, data_dir, name):
+    outside = tmp_path / "outside.nc"
+    outside.write_bytes(b"x")
+    os.symlink(outside, data_dir / "link.nc")
+    with pytest.raises(ProcessError):
+        staging.stage(str(data_dir / name), "gcm_file", str(tmp_path), "path")
+
+
+def test_remote_inputs_in_place(tmp_path, data_dir):
+    url = "https://example.org/dodsC/gcm.nc"
+    inputs = {"gcm_file": [FakeInput("url", url=url)]}
+    args = staging.collect_args(inputs, str(tmp_path), remote_in_place=True)
+    assert args["gcm_file"] == url
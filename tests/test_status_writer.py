@@ -0,0 +1,79 @@
+import pytest
+import time
+
+from chickadee import cancellation
+from chickadee.status_writer import StatusWriter
+
+
+class FakeResponse:
+    uuid = "abcd"
+
+    def __init__(self):
+        self.updates = []
+
+    def update_status(self, message, percentage):
+        self.updates.append((message, percentage))
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def response(monkeypatch):
+    monkeypatch.setattr(cancellation, "is_cancelled", lambda uuid: False)
+    return FakeResponse()
+
+
+def test_updates_are_coalesced(response):
+    with StatusWriter(response, interval=60) as status_writer:
+        for i in range(1000):
+            status_writer.update(f"Interpolating timesteps {i}", 30, stage="interp")
+
+    # The first update of the stage and the last one on close
+    assert len(response.updates) <= 2
+    assert response.updates[-1] == ("Interpolating timesteps 999", 30)
+
+
+def test_stage_change_flushes(response):
+    with StatusWriter(response, interval=60) as status_writer:
+        status_writer.update("Check observations file", 58, stage="check")
+        wait_for(lambda: len(response.updates) == 1)
+        status_writer.update("Reading the monthly climatologies", 61, stage="read")
+        wait_for(lambda: len(response.updates) == 2)
+
+        assert response.updates == [
+            ("Check observations file", 58),
+            ("Reading the monthly climatologies", 61),
+        ]
+
+
+class SlowResponse(FakeResponse):
+    """Response that records whether two updates ever overlapped"""
+
+    def __init__(self):
+        super().__init__()
+        self.active = 0
+        self.overlapped = False
+
+    def update_status(self, message, percentage):
+        self.active += 1
+        self.overlapped |= self.active > 1
+        time.sleep(0.001)
+        super().update_status(message, percentage)
+        self.active -= 1
+
+
+def test_handler_updates_are_serialized(monkeypatch):
+    monkeypatch.setattr(cancellation, "is_cancelled", lambda uuid: False)
+    response = SlowResponse()
+    with StatusWriter(response, interval=0) as status_writer:
+        for i in range(200):
+            status_writer.update(f"Step {i}", 50, stage=i)
+            # What log_handler does from the handler thread
+            response.update_status(f"Handler {i}", 50)
+
+    assert not response.overlapped
+    assert "update_status" not in response.__dict__
@@ -0,0 +1,126 @@
+import os
+import time
+import pytest
+import threading
+import numpy as np
+from datetime import date
+from functools import partial
+from click.testing import CliRunner
+from pywps.app.exceptions import ProcessError
+
+from chickadee import task_queue, tiling
+from chickadee.cli import cli
+from chickadee.engines.subset import Subset
+from chickadee.processes.wps_QDM import qdm_tile
+
+
+OBS_FILE = os.path.join(os.path.dirname(__file__), "data", "tiny_obs.nc")
+
+
+# Workers only run the jobs listed in task_queue.JOBS
+def scale(tile, factor):
+    return tile.index * factor
+
+
+def fail_on(tile, index, error):
+    if tile.index == index:
+        raise {"OSError": OSError, "ValueError": ValueError}[error]("tile failed")
+    return tile.index
+
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    url = f"sqlite:///{tmp_path / 'tasks.sqlite'}"
+    monkeypatch.setattr(task_queue, "get_url", lambda: url)
+    monkeypatch.setattr(task_queue.cancellation, "is_cancelled", lambda uuid: False)
+    for job in (scale, fail_on):
+        monkeypatch.setitem(
+            task_queue.JOBS, job.__name__, f"{job.__module__}:{job.__name__}"
+        )
+    return url
+
+
+def test_tasks_are_json():
+    tile = tiling.make_tiles(OBS_FILE, 2, Subset(None, (date(1971, 1, 1), None)))[1]
+    options = {"start_date": date(1971, 1, 1), "max_gb": 0.5}
+    job = partial(qdm_tile, workdir="/tasks/job", options=options)
+
+    fn, kwargs, decoded = task_queue.decode_task(task_queue.encode_task(job, tile))
+    assert fn is qdm_tile
+    assert kwargs == {"workdir": "/tasks/job", "options": options}
+    assert (decoded.index, decoded.bbox) == (tile.index, tile.bbox)
+    assert decoded.time_range == tile.time_range
+    np.testing.assert_array_equal(decoded.lat, tile.lat)
+
+
+def test_only_known_jobs_are_sent(queue):
+    tiles = tiling.make_tiles(OBS_FILE, 1)
+    with pytest.raises(ValueError, match="not a job workers can run"):
+        task_queue.submit("job", partial(sorted, key=None), tiles, 0)
+
+
+def test_worker_runs_tasks(queue):
+    tiles = tiling.make_tiles(OBS_FILE, 3)
+    task_ids = task_queue.submit("job", partial(scale, factor=10), tiles, 0)
+    assert task_queue.work("worker", poll=0.01, max_tasks=3) == 3
+    assert task_queue.wait("job", task_ids) == [0, 10, 20]
+    # Finished jobs are removed from the queue
+    assert task_queue.claim("worker") is None
+
+
+def test_failed_tasks_are_retried(queue):
+    tiles = tiling.make_tiles(OBS_FILE, 2)
+    task_ids = task_queue.submit(
+        "job", partial(fail_on, index=1, error="OSError"), tiles, 1
+    )
+    task_queue.work("worker", poll=0.01, max_tasks=3)
+    with pytest.raises(ProcessError, match="Tile 1 failed after 2 attempts: OSError"):
+        task_queue.wait("job", task_ids)
+
+
+def test_invalid_inputs_are_not_retried(queue):
+    tiles = tiling.make_tiles(OBS_FILE, 1)
+    task_ids = task_queue.submit(
+        "job", partial(fail_on, index=0, error="ValueError"), tiles, 3
+    )
+    task_queue.work("worker", poll=0.01, max_tasks=1)
+    with pytest.raises(ProcessError, match="after 1 attempts: ValueError"):
+        task_queue.wait("job", task_ids)
+
+
+def test_lost_tasks_are_requeued(queue):
+    tiles = tiling.make_tiles(OBS_FILE, 1)
+    task_queue.submit("job", partial(scale, factor=1), tiles, 1)
+    task_queue.register("lost")
+    assert task_queue.claim("lost")["attempts"] == 1
+    assert task_queue.claim("other") is None
+
+    task_queue.requeue_lost()
+    assert task_queue.claim("other") is None
+    # The heartbeat of "lost" is too old
+    task_queue.requeue_lost(timeout=-1)
+    assert task_queue.claim("other")["attempts"] == 2
+
+
+def test_run_tiles_on_workers(queue):
+    tiles = tiling.make_tiles(OBS_FILE, 4)
+    job = partial(scale, factor=2)
+    # Without live workers tiles run here
+    assert tiling.run_tiles(job, tiles, 2, 0, job_id="job") == [0, 2, 4, 6]
+
+    worker = threading.Thread(
+        target=task_queue.work, args=("worker", 0.01, 4), daemon=True
+    )
+    worker.start()
+    while not task_queue.live_workers():
+        time.sleep(0.01)
+    assert tiling.run_tiles(job, tiles, 2, 0, job_id="job") == [0, 2, 4, 6]
+    worker.join(10)
+    assert not worker.is_alive()
+    assert task_queue.live_workers() == []
+
+
+def test_worker_needs_a_queue():
+    result = CliRunner().invoke(cli, ["worker", "--max-tasks", "1"])
+    assert result.exit_code == 1
+    assert "task_queue" in result.output
@@ -0,0 +1,195 @@
+import os
+import pytest
+import numpy as np
+from datetime import date
+from netCDF4 import Dataset
+from pywps.app.exceptions import ProcessError
+
+from chickadee import cache, tiling
+from chickadee.engines import ci, netcdf, obs_cache, qdm, regrid
+from chickadee.engines.subset import Subset, write_subset
+from tests.test_engine_qdm import make_dataset, options
+
+
+DATA = os.path.join(os.path.dirname(__file__), "data")
+GCM_FILE = os.path.join(DATA, "tiny_gcm.nc")
+OBS_FILE = os.path.join(DATA, "tiny_obs.nc")
+
+
+@pytest.fixture(autouse=True)
+def disk_cache(tmp_path, monkeypatch):
+    disk_cache = cache.DiskCache(str(tmp_path / "cache"), 2**30)
+    monkeypatch.setattr(obs_cache, "get_cache", lambda: disk_cache)
+    monkeypatch.setattr(regrid.cache, "get_cache", lambda *args: disk_cache)
+    return disk_cache
+
+
+def test_make_tiles():
+    tiles = tiling.make_tiles(OBS_FILE, 4)
+    with Dataset(OBS_FILE) as nc:
+        lat = nc.variables["lat"][:]
+    assert [len(tile.lat) for tile in tiles] == [7, 7, 6, 6]
+    np.testing.assert_array_equal(np.concatenate([tile.lat for tile in tiles]), lat)
+    assert [tile.index for tile in tiles] == [0, 1, 2, 3]
+
+    subset = Subset.from_inputs("-93,68.5,-92,69", "1970-01-01/1970-12-31")
+    tiles = tiling.make_tiles(OBS_FILE, 100, subset)
+    assert sum(len(tile.lat) for tile in tiles) == len(tiles) < 26
+    assert all(tile.time_range == subset.time_range for tile in tiles)
+
+
+def test_stitch_restores_the_grid(tmp_path):
+    tiles = tiling.make_tiles(OBS_FILE, 3)
+    tile_files = [
+        write_subset(tile, OBS_FILE, tiling.tile_file(str(tmp_path), tile, "obs.nc"))
+        for tile in tiles
+    ]
+    with Dataset(tile_files[0]) as nc:
+        # Tiles keep the neighbouring row
+        assert len(nc.dimensions["lat"]) == len(tiles[0].lat) + 1
+
+    output_file = tiling.stitch(tile_files, tiles, str(tmp_path / "out.nc"), 1e-4)
+    with Dataset(OBS_FILE) as source, Dataset(output_file) as out:
+        for name in ("lat", "lon", "time", "tasmax"):
+            np.testing.assert_array_equal(
+                out.variables[name][:], source.variables[name][:]
+            )
+        assert out.variables["tasmax"].units == source.variables["tasmax"].units
+
+
+def test_run_tiles_retries():
+    tiles = tiling.make_tiles(OBS_FILE, 3)
+    attempts = []
+
+    def flaky(tile):
+        attempts.append(tile.index)
+        if attempts.count(tile.index) < 2 and tile.index == 1:
+            raise OSError("worker died")
+        return tile.index * 10
+
+    assert tiling.run_tiles(flaky, tiles, workers=2, retries=1) == [0, 10, 20]
+    assert sorted(attempts) == [0, 1, 1, 2]
+
+    attempts.clear()
+    with pytest.raises(ProcessError, match="Tile 1 failed after 1 attempts"):
+        tiling.run_tiles(flaky, tiles, workers=2, retries=0)
+
+
+def test_run_tiles_does_not_retry_invalid_inputs():
+    attempts = []
+
+    def invalid(tile):
+        attempts.append(tile.index)
+        raise ValueError("bad input")
+
+    with pytest.raises(ValueError):
+        tiling.run_tiles(invalid, tiling.make_tiles(OBS_FILE, 1), retries=3)
+    assert attempts == [0]
+
+
+def test_climdown_tiles_write_subsets_concurrently(tmp_path, monkeypatch):
+    from functools import partial
+    from chickadee.processes import wps_QDM
+
+    rng = np.random.default_rng(0)
+    obs_file = make_dataset(
+        tmp_path / "obs.nc", 1971, 30, lambda *s: rng.normal(size=s), nlat=8
+    )
+    gcm_file = make_dataset(
+        tmp_path / "gcm.nc", 1971, 40, lambda *s: rng.normal(size=s), nlat=8
+    )
+
+    def run(fn, gcm_subset, obs_subset, *args):
+        # Stands in for the R worker, which reads the subsets in its own
+        # process
+        for path in (gcm_subset, obs_subset):
+            with netcdf.LOCK, Dataset(path) as nc:
+                assert nc.variables["tasmax"].shape[1] < 8
+
+    monkeypatch.setattr(wps_QDM.r_pool, "run", run)
+    tiles = tiling.make_tiles(obs_file, 4)
+    job = partial(
+        wps_QDM.qdm_tile,
+        workdir=str(tmp_path),
+        engine="climdown",
+        obs_file=obs_file,
+        gcm_file=gcm_file,
+        varname="tasmax",
+        options=options(),
+    )
+    for _ in range(5):
+        assert len(tiling.run_tiles(job, tiles, workers=4, retries=0)) == 4
+
+
+def test_tile_options():
+    assert tiling.tile_options({"max_gb": 4.0, "tol": 0.1}, 8) == {
+        "max_gb": 0.5,
+        "tol": 0.1,
+    }
+
+
+def test_tiled_qdm_matches_whole_grid(tmp_path):
+    rng = np.random.default_rng(0)
+    obs_file = make_dataset(
+        tmp_path / "obs.nc", 1971, 30, lambda *s: rng.normal(size=s), nlat=5
+    )
+    gcm_file = make_dataset(
+        tmp_path / "gcm.nc", 1971, 40, lambda *s: rng.normal(1, 2, size=s), nlat=5
+    )
+    qdm_options = options(jitter_factor=0.0)
+    whole_file = str(tmp_path / "whole.nc")
+    qdm.qdm_netcdf(obs_file, gcm_file, whole_file, "tasmax", qdm_options)
+
+    tiles = tiling.make_tiles(obs_file, 3)
+
+    def job(tile):
+        output_file = tiling.tile_file(str(tmp_path), tile, "qdm.nc")
+        tiling.in_process(
+            qdm.qdm_netcdf,
+            obs_file,
+            gcm_file,
+            output_file,
+            "tasmax",
+            tiling.tile_options(qdm_options, 2),
+            1,
+            tile,
+        )
+        return output_file
+
+    tile_files = tiling.run_tiles(job, tiles, workers=2)
+    output_file = tiling.stitch(tile_files, tiles, str(tmp_path / "tiled.nc"))
+    with Dataset(whole_file) as whole, Dataset(output_file) as tiled:
+        np.testing.assert_allclose(
+            tiled.variables["tasmax"][:], whole.variables["tasmax"][:]
+        )
+
+
+def test_tiled_ci_matches_whole_grid(tmp_path):
+    ci_options = {
+        "units_bool": True,
+        "tasmax_units": "celsius",
+        "max_gb": 1e-3,
+        "start_date": date(1970, 1, 1),
+        "end_date": date(1971, 12, 31),
+    }
+    whole_file = str(tmp_path / "whole.nc")
+    ci.ci_netcdf(GCM_FILE, OBS_FILE, whole_file, "tasmax", "tasmax", ci_options)
+
+    tiles = tiling.make_tiles(OBS_FILE, 2)
+    tile_files = []
+    for tile in tiles:
+        tile_files.append(tiling.tile_file(str(tmp_path), tile, "ci.nc"))
+        ci.ci_netcdf(
+            GCM_FILE,
+            OBS_FILE,
+            tile_files[-1],
+            "tasmax",
+            "tasmax",
+            ci_options,
+            subset=tile,
+        )
+    output_file = tiling.stitch(tile_files, tiles, str(tmp_path / "tiled.nc"))
+    with Dataset(whole_file) as whole, Dataset(output_file) as tiled:
+        np.testing.assert_allclose(
+            tiled.variables["tasmax"][:], whole.variables["tasmax"][:], rtol=1e-6
+        )
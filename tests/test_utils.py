@@ -1,6 +1,8 @@
 import pytest
 from collections import OrderedDict
 from pywps import LiteralInput
+import os
+from chickadee import utils
 from chickadee.utils import (
     set_general_options,
     set_ca_options,
@@ -210,3 +212,39 @@ def test_set_qdm_options(
         tasmax_ratio,
         tasmin_ratio,
     ]
+
+
+@pytest.fixture
+def runtime_dir(tmp_path, monkeypatch):
+    path = tmp_path / "runtime"
+    monkeypatch.setattr(
+        utils.configuration, "get_config_value", lambda section, opt: str(path)
+    )
+    return path
+
+
+def test_get_runtime_dir(runtime_dir):
+    assert utils.get_runtime_dir("tasks") == str(runtime_dir / "tasks")
+    assert (runtime_dir / "tasks").is_dir()
+    assert runtime_dir.stat().st_mode & 0o777 == 0o700
+
+
+def test_get_runtime_dir_writable_by_others(runtime_dir):
+    runtime_dir.mkdir()
+    runtime_dir.chmod(0o777)
+    with pytest.raises(PermissionError):
+        utils.get_runtime_dir()
+
+
+def test_get_runtime_dir_symlink(runtime_dir, tmp_path):
+    (tmp_path / "elsewhere").mkdir(mode=0o700)
+    runtime_dir.symlink_to(tmp_path / "elsewhere")
+    with pytest.raises(PermissionError):
+        utils.get_runtime_dir()
+
+
+def test_default_runtime_dir(monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path))
+    assert utils.default_runtime_dir() == str(tmp_path / "chickadee")
+    monkeypatch.delenv("XDG_RUNTIME_DIR")
+    assert utils.default_runtime_dir().endswith(f"chickadee-{os.getuid()}")
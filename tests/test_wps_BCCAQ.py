@@ -1,9 +1,10 @@
+import time
 import pytest
 from tempfile import NamedTemporaryFile
 from datetime import date
 
 from wps_tools.testing import run_wps_process, local_path, process_err_test, url_path
-from chickadee.processes.wps_BCCAQ import BCCAQ
+from chickadee.processes.wps_BCCAQ import BCCAQ, run_branches
 
 
 def build_params(gcm_file, obs_file, var, end_date, num_cores, out_file):
@@ -71,3 +72,28 @@ def test_wps_bccaq_err(gcm_file, obs_file, var, end_date, num_cores):
             gcm_file, obs_file, var, end_date, num_cores, out_file.name
         )
         process_err_test(BCCAQ, datainputs)
+
+
+def test_run_branches_concurrently():
+    calls = []
+
+    def step(name):
+        calls.append((name, time.monotonic()))
+        time.sleep(0.2)
+
+    start = time.monotonic()
+    run_branches([(step, "ci"), (step, "qdm")], [(step, "ca")])
+
+    assert time.monotonic() - start < 0.6
+    order = [fn for fn, _ in calls]
+    assert order.index("ci") < order.index("qdm")
+    assert sorted(order) == ["ca", "ci", "qdm"]
+
+
+def test_run_branches_error():
+    def step(name):
+        if name == "ca":
+            raise RuntimeError("CA failed")
+
+    with pytest.raises(RuntimeError, match="CA failed"):
+        run_branches([(step, "ci"), (step, "qdm")], [(step, "ca")])
@@ -14,6 +14,7 @@ def test_wps_caps():
         "bccaq",
         "ca",
         "ci",
+        "estimate",
         "qdm",
         "rerank",
     ]